@@ -0,0 +1 @@
+"""Benchmarks for Nourish. Run each module with python3 -m from the project root."""
@@ -0,0 +1,137 @@
+"""Measure the cost of the date filters for one rendered feed page.
+
+A page is modelled without a database: posts with comments, and the month
+dropdown. Each filter call the feed templates make is replayed two ways:
+
+    strftime    formatting every call, as the filters did before
+    memoized    the filters as they are, with a cold cache for each page
+
+The memoized rows also report a warm page, as every view after the first is.
+
+    python3 -m benchmarks.date_filters [--posts 10] [--comments 5] [--months 24]
+"""
+
+import argparse
+import json
+import statistics
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from jinja_filters import (format_date, datetimeformat, htmldateformat,
+                           monthyearformat, DATETIME_FORMAT,
+                           HTMLDATETIME_FORMAT, MONTHYEAR_FORMAT)
+
+
+def create_page(num_posts, num_comments, num_months):
+    """Return (posts, months) shaped like a feed page's template data."""
+
+    start = datetime(2020, 2, 1, 8, 0)
+    posts = []
+
+    for post_number in range(num_posts):
+        time_stamp = start + timedelta(hours=7 * post_number, minutes=13)
+        comments = [SimpleNamespace(time_stamp=time_stamp +
+                                    timedelta(minutes=31 * comment_number))
+                    for comment_number in range(1, num_comments + 1)]
+        posts.append(SimpleNamespace(time_stamp=time_stamp,
+                                     meal_time=time_stamp - timedelta(hours=1),
+                                     comments=comments))
+
+    months = [datetime(2020 - month // 12, 12 - month % 12, 1)
+              for month in range(num_months)]
+
+    return posts, months
+
+
+def render_dates(posts, months, datetime_filter, htmldatetime_filter,
+                 monthyear_filter):
+    """Make the filter calls that posts.html and post-card.html make."""
+
+    for month in months:
+        monthyear_filter(month)
+
+    for post in posts:
+        datetime_filter(post.time_stamp)
+        datetime_filter(post.meal_time)
+
+        for comment in post.comments:
+            datetime_filter(comment.time_stamp)
+
+        # The patient's hidden edit form repeats the header and meal time.
+        datetime_filter(post.time_stamp)
+        htmldatetime_filter(post.meal_time)
+
+
+def render_with_strftime(posts, months):
+    render_dates(posts, months,
+                 lambda value: value.strftime(DATETIME_FORMAT),
+                 lambda value: value.strftime(HTMLDATETIME_FORMAT),
+                 lambda value: value.strftime(MONTHYEAR_FORMAT))
+
+
+def render_memoized(posts, months):
+    render_dates(posts, months, datetimeformat, htmldateformat,
+                 monthyearformat)
+
+
+def time_page(render, posts, months, repeat, cold):
+    """Return the median microseconds to render a page's dates."""
+
+    timings = []
+
+    for _ in range(repeat):
+        if cold:
+            format_date.cache_clear()
+
+        start = time.perf_counter()
+        render(posts, months)
+        timings.append((time.perf_counter() - start) * 1_000_000)
+
+    return statistics.median(timings)
+
+
+def run_benchmark(num_posts, num_comments, num_months, repeat):
+    """Return median microseconds per page for each way of formatting."""
+
+    posts, months = create_page(num_posts, num_comments, num_months)
+
+    return {"strftime": time_page(render_with_strftime, posts, months,
+                                  repeat, cold=True),
+            "memoized, cold": time_page(render_memoized, posts, months,
+                                        repeat, cold=True),
+            "memoized, warm": time_page(render_memoized, posts, months,
+                                        repeat, cold=False)}
+
+
+def print_report(results, num_calls):
+    """Print filter cost per page for each way of formatting."""
+
+    print(f"{num_calls} filter calls per page")
+    print(f"{'formatting':<18}{'us/page':>10}{'us/call':>10}")
+
+    for name, microseconds in results.items():
+        print(f"{name:<18}{microseconds:>10.1f}"
+              f"{microseconds / num_calls:>10.2f}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure date filter cost per rendered feed page.")
+    parser.add_argument("--posts", type=int, default=10)
+    parser.add_argument("--comments", type=int, default=5)
+    parser.add_argument("--months", type=int, default=24)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.posts, args.comments, args.months,
+                            args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        num_calls = args.months + args.posts * (4 + args.comments)
+        print_report(results, num_calls)
@@ -0,0 +1,122 @@
+"""Report compression ratio and encode time for each image format and quality.
+
+Each image is transcoded the way images.py does it for the widest variant:
+loaded upright without metadata, scaled to at most 1280px wide, then encoded.
+The ratio compares the original upload's size with the encoded copy.
+
+    python3 -m benchmarks.image_encoding [--images 'photos/*.jpg'] [--repeat 3]
+
+Without --images, a synthetic 3000x2000 photo-like JPEG is used.
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from PIL import Image, ImageFilter
+
+from images import load_image, encode_image, VARIANT_WIDTHS
+
+
+FORMATS = ["JPEG", "WEBP"]
+QUALITIES = [60, 70, 80, 90]
+
+
+def create_sample_image(path):
+    """Write a noisy, blurred gradient that compresses roughly like a photo."""
+
+    noise = Image.effect_noise((3000, 2000), 48).filter(
+        ImageFilter.GaussianBlur(2))
+    gradient = Image.linear_gradient("L").resize((3000, 2000))
+    image = Image.merge("RGB", (noise, gradient, noise.transpose(
+        Image.FLIP_LEFT_RIGHT)))
+
+    image.save(path, "JPEG", quality=95)
+
+
+def measure_encoding(path, image_format, quality, repeat):
+    """Return (median seconds, encoded bytes) for one image and setting."""
+
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        image = load_image(path, image_format)
+        width = min(max(VARIANT_WIDTHS), image.width)
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+        image_bytes = encode_image(image, image_format, quality)
+
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings), len(image_bytes)
+
+
+def run_benchmark(paths, repeat):
+    """Return results for every format and quality, totalled over images."""
+
+    original_bytes = sum(os.path.getsize(path) for path in paths)
+    results = []
+
+    for image_format in FORMATS:
+        for quality in QUALITIES:
+            seconds = encoded_bytes = 0
+
+            for path in paths:
+                image_seconds, image_bytes = measure_encoding(
+                    path, image_format, quality, repeat)
+                seconds += image_seconds
+                encoded_bytes += image_bytes
+
+            results.append({"format": image_format,
+                            "quality": quality,
+                            "encoded_bytes": encoded_bytes,
+                            "original_bytes": original_bytes,
+                            "ratio": round(original_bytes / encoded_bytes, 2),
+                            "ms_per_image": round(seconds / len(paths) * 1000,
+                                                  1)})
+
+    return results
+
+
+def print_report(results, num_images):
+    """Print compression ratio and encode time per setting."""
+
+    print(f"{num_images} image(s), "
+          f"{results[0]['original_bytes'] / 1024:.0f} KB originally")
+    print(f"{'format':<8}{'quality':>8}{'KB':>10}{'ratio':>8}{'ms/image':>10}")
+
+    for result in results:
+        print(f"{result['format']:<8}{result['quality']:>8}"
+              f"{result['encoded_bytes'] / 1024:>10.1f}"
+              f"{result['ratio']:>8.2f}{result['ms_per_image']:>10.1f}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare image formats and qualities for post images.")
+    parser.add_argument("--images", help="glob of images to encode")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as sample_dir:
+        if args.images:
+            paths = sorted(glob.glob(args.images))
+        else:
+            paths = [os.path.join(sample_dir, "sample.jpg")]
+            create_sample_image(paths[0])
+
+        results = run_benchmark(paths, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results, len(paths))
@@ -0,0 +1,103 @@
+"""Measure password checks per second for each hash cost, inline and pooled.
+
+Simulates a burst of logins arriving on several request threads at once. The
+"inline" rows verify on the request threads, as the app did before
+passwords.py; the "pool" rows hand each check to a process pool.
+
+    python3 -m benchmarks.logins [--logins 200] [--threads 8] [--workers 4]
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from passwords import HASH_METHOD, SALT_LENGTH
+
+
+HASH_METHODS = ["pbkdf2:sha256:50000",
+                "pbkdf2:sha256:150000",
+                "pbkdf2:sha256:260000",
+                "pbkdf2:sha512:150000"]
+
+
+def measure_logins(password_hash, num_logins, num_threads, pool=None):
+    """Return logins per second for a burst of checks against one hash."""
+
+    def log_in(_):
+        if pool:
+            return pool.submit(check_password_hash, password_hash,
+                               "password").result()
+        return check_password_hash(password_hash, "password")
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=num_threads) as request_threads:
+        results = list(request_threads.map(log_in, range(num_logins)))
+
+    elapsed = time.perf_counter() - start
+    assert all(results)
+
+    return num_logins / elapsed
+
+
+def run_benchmark(num_logins, num_threads, num_workers):
+    """Return logins per second for every hash method, inline and pooled."""
+
+    methods = HASH_METHODS + [HASH_METHOD] * (HASH_METHOD not in HASH_METHODS)
+    results = []
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for method in methods:
+            password_hash = generate_password_hash("password", method,
+                                                   SALT_LENGTH)
+            # Start the workers before timing anything.
+            pool.submit(check_password_hash, password_hash, "password").result()
+
+            results.append({
+                "method": method,
+                "configured": method == HASH_METHOD,
+                "inline": measure_logins(password_hash, num_logins,
+                                         num_threads),
+                "pool": measure_logins(password_hash, num_logins, num_threads,
+                                       pool),
+            })
+
+    return results
+
+
+def print_report(results, num_workers):
+    """Print logins per second for each hash method."""
+
+    print(f"{'method':<24}{'inline/s':>12}{f'pool({num_workers})/s':>14}")
+
+    for result in results:
+        marker = " *" if result["configured"] else ""
+        print(f"{result['method']:<24}{result['inline']:>12.1f}"
+              f"{result['pool']:>14.1f}{marker}")
+
+    print("* configured with PASSWORD_HASH_METHOD")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure login throughput at each password hash cost.")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8,
+                        help="concurrent request threads")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="hashing processes")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.logins, args.threads, args.workers)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results, args.workers)
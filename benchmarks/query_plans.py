@@ -0,0 +1,182 @@
+"""Show query plans and latencies for the hot queries, with and without the
+composite indexes built by the migrations in migrations/.
+
+Run from the project root against a database with realistic data:
+
+    python3 -m benchmarks.query_plans [--db-uri postgresql:///nourish]
+
+The "before" numbers are taken inside a transaction that drops the indexes and
+is then rolled back, so nothing is changed permanently. Dropping an index takes
+an exclusive lock on its table, so don't point this at production.
+"""
+
+import argparse
+import json
+import time
+
+from sqlalchemy import text
+
+from model import connect_to_db, db
+from ratings import SUNDAYS_WITH_DATA_SQL
+from server import app
+
+
+INDEX_NAMES = ["ix_patients_dietitian_id",
+               "ix_posts_patient_id_time_stamp",
+               "ix_posts_patient_id_time_stamp_post_id",
+               "ix_posts_patient_id_meal_time",
+               "ix_posts_patient_id_rated_meal_time",
+               "ix_goals_patient_id_time_stamp",
+               "ix_comments_post_id"]
+
+HOT_QUERIES = {
+    "patient feed": """
+        SELECT * FROM posts
+        WHERE patient_id = :patient_id
+        ORDER BY time_stamp DESC LIMIT 10""",
+    "patient feed, later page": """
+        SELECT * FROM posts
+        WHERE patient_id = :patient_id
+          AND (time_stamp, post_id) < (:to_date, :post_id)
+        ORDER BY time_stamp DESC, post_id DESC LIMIT 11""",
+    "dietitian feed": """
+        SELECT posts.* FROM posts
+        JOIN patients ON patients.patient_id = posts.patient_id
+        WHERE patients.dietitian_id = :dietitian_id
+        ORDER BY posts.time_stamp DESC LIMIT 10""",
+    "patient months": """
+        SELECT time_stamp FROM posts
+        WHERE patient_id = :patient_id""",
+    "ratings range": """
+        SELECT meal_time, hunger FROM posts
+        WHERE patient_id = :patient_id
+          AND hunger IS NOT NULL
+          AND meal_time BETWEEN :from_date AND :to_date
+        ORDER BY time_stamp DESC""",
+    "sundays with data": SUNDAYS_WITH_DATA_SQL.text,
+    "goals": """
+        SELECT * FROM goals
+        WHERE patient_id = :patient_id
+        ORDER BY time_stamp DESC LIMIT 10""",
+    "post comments": """
+        SELECT * FROM comments
+        WHERE post_id = :post_id""",
+}
+
+
+def get_sample_params(conn):
+    """Pick the busiest patient and one of their posts to query against."""
+
+    patient_id, dietitian_id, last_meal = conn.execute(text("""
+        SELECT posts.patient_id, patients.dietitian_id, max(posts.meal_time)
+        FROM posts JOIN patients ON patients.patient_id = posts.patient_id
+        GROUP BY posts.patient_id, patients.dietitian_id
+        ORDER BY count(*) DESC LIMIT 1""")).first()
+
+    post_id = conn.execute(text("""SELECT max(post_id) FROM posts
+                                    WHERE patient_id = :patient_id"""),
+                           patient_id=patient_id).scalar()
+
+    return {"patient_id": patient_id,
+            "dietitian_id": dietitian_id,
+            "post_id": post_id,
+            "from_date": last_meal.replace(hour=0, minute=0, second=0),
+            "to_date": last_meal}
+
+
+def find_scan_nodes(plan, nodes=None):
+    """Return a list of the scan node types used anywhere in a plan."""
+
+    if nodes is None:
+        nodes = []
+
+    if "Scan" in plan["Node Type"]:
+        node = plan["Node Type"]
+        if "Index Name" in plan:
+            node += f" using {plan['Index Name']}"
+        if "Relation Name" in plan:
+            node += f" on {plan['Relation Name']}"
+        nodes.append(node)
+
+    for child in plan.get("Plans", []):
+        find_scan_nodes(child, nodes)
+
+    return nodes
+
+
+def measure_queries(conn, params, repeat):
+    """Explain and time every hot query, returning a dictionary of results."""
+
+    results = {}
+
+    for name, sql in HOT_QUERIES.items():
+        plan_json, = conn.execute(text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+                                       + sql), **params).first()
+        plan = plan_json[0]["Plan"]
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(text(sql), **params).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+
+        timings.sort()
+        results[name] = {"scans": find_scan_nodes(plan),
+                         "median_ms": timings[len(timings) // 2],
+                         "plan": plan}
+
+    return results
+
+
+def run_benchmark(repeat):
+    """Measure the hot queries without and then with the composite indexes."""
+
+    conn = db.engine.connect()
+
+    try:
+        params = get_sample_params(conn)
+
+        transaction = conn.begin()
+        for index_name in INDEX_NAMES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+        before = measure_queries(conn, params, repeat)
+        transaction.rollback()
+
+        after = measure_queries(conn, params, repeat)
+
+    finally:
+        conn.close()
+
+    return {"before": before, "after": after}
+
+
+def print_report(results):
+    """Print a before/after summary of each hot query."""
+
+    for name in HOT_QUERIES:
+        before = results["before"][name]
+        after = results["after"][name]
+
+        print(f"{name}:")
+        print(f"  before: {before['median_ms']:8.2f} ms  "
+              f"{', '.join(before['scans'])}")
+        print(f"  after:  {after['median_ms']:8.2f} ms  "
+              f"{', '.join(after['scans'])}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare hot query plans with and without indexes.")
+    parser.add_argument("--db-uri", default="postgresql:///nourish")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", help="write full plans to this file")
+    args = parser.parse_args()
+
+    connect_to_db(app, db_uri=args.db_uri)
+    results = run_benchmark(args.repeat)
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2, default=str)
@@ -0,0 +1,307 @@
+"""Measure latency and SQL cost for each route, and catch regressions.
+
+Every route is driven through the Flask test client against a generated
+dataset (see synthetic_data.py), logged in as the busiest dietitian or their
+busiest patient. After a few warm-up requests, each route records its p50,
+p95 and p99 latency and the median SQL queries, rows returned and SQL time
+per request.
+
+Save a run as the baseline, then compare later runs against it. A route
+regresses when its p50 or p95 grows by more than --latency-threshold
+percent, it issues more than --query-threshold extra queries, or it returns
+more than --rows-threshold percent more rows. The exit status is 1 if any
+route regressed.
+
+    python3 -m benchmarks.routes --db-uri postgresql:///nourish_bench \\
+        --output benchmarks/routes_baseline.json
+    python3 -m benchmarks.routes --db-uri postgresql:///nourish_bench \\
+        --baseline benchmarks/routes_baseline.json [--latency-threshold 20]
+
+The comment routes write to the database; the comments they add are deleted
+at the end of the run.
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from flask import request_finished
+
+
+def get_sample(db):
+    """Return the ids and email addresses the routes are driven with."""
+
+    dietitian_id, patient_id = db.session.execute(
+        """SELECT patients.dietitian_id, patients.patient_id
+           FROM posts JOIN patients USING (patient_id)
+           GROUP BY patients.patient_id
+           ORDER BY count(*) DESC
+           LIMIT 1""").first()
+
+    return {"dietitian_id": dietitian_id,
+            "patient_id": patient_id,
+            "post_id": db.session.execute(
+                """SELECT max(post_id) FROM posts
+                   WHERE patient_id = :patient_id""",
+                {"patient_id": patient_id}).scalar(),
+            "num_posts": db.session.execute(
+                "SELECT count(*) FROM posts WHERE patient_id = :patient_id",
+                {"patient_id": patient_id}).scalar(),
+            "patient_email": db.session.execute(
+                "SELECT email FROM patients WHERE patient_id = :patient_id",
+                {"patient_id": patient_id}).scalar(),
+            "dietitian_email": db.session.execute(
+                """SELECT email FROM dietitians
+                   WHERE dietitian_id = :dietitian_id""",
+                {"dietitian_id": dietitian_id}).scalar(),
+            "max_comment_id": db.session.execute(
+                "SELECT coalesce(max(comment_id), 0) FROM comments").scalar()}
+
+
+def get_routes(sample, password):
+    """Return (name, user, method, url, form data) for each route measured.
+
+    user is "patient", "dietitian" or None for a logged-out client. The
+    sample also needs a chart_date to ask for past ratings and the
+    comment_id of a comment to edit.
+    """
+
+    patient_url = f"/patient/{sample['patient_id']}"
+
+    return [
+        ("patient login", None, "POST", "/patient-login",
+         {"email": sample["patient_email"], "password": password}),
+        ("dietitian login", None, "POST", "/dietitian-login",
+         {"email": sample["dietitian_email"], "password": password}),
+        ("dietitian feed", "dietitian", "GET",
+         f"/dietitian/{sample['dietitian_id']}", None),
+        ("patient homepage", "patient", "GET", patient_url, None),
+        ("patient posts", "patient", "GET", f"{patient_url}/posts", None),
+        ("patient posts, dietitian", "dietitian", "GET",
+         f"{patient_url}/posts", None),
+        ("goals", "patient", "GET", f"{patient_url}/goals", None),
+        ("recent ratings", "patient", "GET",
+         f"{patient_url}/recent-ratings.json", None),
+        ("past ratings", "patient", "GET",
+         f"{patient_url}/past-ratings.json?chart-date={sample['chart_date']}",
+         None),
+        ("weekly ratings", "patient", "GET",
+         f"{patient_url}/weekly-ratings.json", None),
+        ("add comment", "dietitian", "POST",
+         f"/post/{sample['post_id']}/add-comment.json",
+         {"comment": "Nice work on this meal."}),
+        ("edit comment", "dietitian", "POST",
+         f"/comment/{sample['comment_id']}/edit.json",
+         {"comment": "Nice work on this meal!"}),
+    ]
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of some values."""
+
+    ordered = sorted(values)
+    rank = max(round(percent / 100 * len(ordered) + 0.5), 1)
+
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def measure_route(client, method, url, data, num_requests, num_warm_ups,
+                  query_stats):
+    """Return latency percentiles and median SQL cost for one route."""
+
+    timings = []
+    stats = []
+
+    for request_number in range(num_warm_ups + num_requests):
+        start = time.perf_counter()
+        response = client.open(url, method=method, data=data)
+        elapsed = time.perf_counter() - start
+
+        assert response.status_code in (200, 302), (url, response.status)
+
+        if request_number >= num_warm_ups:
+            timings.append(elapsed * 1000)
+            stats.append(dict(query_stats))
+
+    return {"p50_ms": round(percentile(timings, 50), 2),
+            "p95_ms": round(percentile(timings, 95), 2),
+            "p99_ms": round(percentile(timings, 99), 2),
+            "queries": statistics.median(stat["queries"] for stat in stats),
+            "rows": statistics.median(stat["rows"] for stat in stats),
+            "sql_ms": round(statistics.median(stat["seconds"] * 1000
+                                              for stat in stats), 2)}
+
+
+def run_benchmark(db_uri, num_requests, num_warm_ups, password):
+    """Return the dataset sample and measurements for every route."""
+
+    from model import connect_to_db, db
+    from query_stats import get_query_stats
+    from server import app
+
+    connect_to_db(app, db_uri=db_uri)
+
+    sample = get_sample(db)
+    db.session.remove()
+
+    # The last request's SQL totals, read before its app context ends.
+    query_stats = {}
+
+    def record_query_stats(sender, response, **extra):
+        query_stats.update(get_query_stats())
+
+    request_finished.connect(record_query_stats, app)
+
+    clients = {None: app.test_client()}
+
+    for user in ["patient", "dietitian"]:
+        clients[user] = app.test_client()
+
+        with clients[user].session_transaction() as session:
+            session[f"{user}_id"] = sample[f"{user}_id"]
+
+    # The past week charted is the oldest in the recent ratings' dropdown.
+    recent_ratings = clients["patient"].get(
+        f"/patient/{sample['patient_id']}/recent-ratings.json").get_json()
+    chart_dates = recent_ratings.get("dropdown", {}).get("dropdown_dates")
+    sample["chart_date"] = chart_dates[-1] if chart_dates else "2020-01-05"
+
+    routes = {}
+
+    try:
+        # The comment edited is one the benchmark adds, so the dataset's
+        # comments are left alone.
+        comment = clients["dietitian"].post(
+            f"/post/{sample['post_id']}/add-comment.json",
+            data={"comment": "Nice work on this meal."}).get_json()
+        sample["comment_id"] = comment["comment"]["comment_id"]
+
+        for name, user, method, url, data in get_routes(sample, password):
+            routes[name] = measure_route(clients[user], method, url, data,
+                                         num_requests, num_warm_ups,
+                                         query_stats)
+    finally:
+        request_finished.disconnect(record_query_stats, app)
+        db.session.execute("DELETE FROM comments WHERE comment_id > :id",
+                           {"id": sample["max_comment_id"]})
+        db.session.commit()
+
+    return {"dataset": {"dietitian_id": sample["dietitian_id"],
+                        "patient_id": sample["patient_id"],
+                        "patient_posts": sample["num_posts"]},
+            "requests": num_requests,
+            "routes": routes}
+
+
+def compare_results(results, baseline, latency_threshold, query_threshold,
+                    rows_threshold):
+    """Return {route: [regression, ...]} for routes worse than the baseline.
+
+    Thresholds are percentages for latency and rows, and a number of
+    queries.
+    """
+
+    regressions = {}
+
+    for name, measured in results["routes"].items():
+        expected = baseline["routes"].get(name)
+
+        if not expected:
+            continue
+
+        found = []
+
+        for key in ["p50_ms", "p95_ms"]:
+            if measured[key] > expected[key] * (1 + latency_threshold / 100):
+                found.append(f"{key} {expected[key]} -> {measured[key]}")
+
+        if measured["queries"] > expected["queries"] + query_threshold:
+            found.append(f"queries {expected['queries']} -> "
+                         f"{measured['queries']}")
+
+        if measured["rows"] > expected["rows"] * (1 + rows_threshold / 100):
+            found.append(f"rows {expected['rows']} -> {measured['rows']}")
+
+        if found:
+            regressions[name] = found
+
+    return regressions
+
+
+def print_report(results, baseline=None, regressions=None):
+    """Print each route's measurements, with p95 change from the baseline."""
+
+    dataset = results["dataset"]
+    print(f"patient {dataset['patient_id']} ({dataset['patient_posts']} posts),"
+          f" dietitian {dataset['dietitian_id']},"
+          f" {results['requests']} requests per route")
+    header = (f"{'route':<26}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+              f"{'queries':>9}{'rows':>8}{'sql ms':>9}")
+    print(header + f"{'p95 vs base':>13}" if baseline else header)
+
+    for name, measured in results["routes"].items():
+        line = (f"{name:<26}{measured['p50_ms']:>9.1f}"
+                f"{measured['p95_ms']:>9.1f}{measured['p99_ms']:>9.1f}"
+                f"{measured['queries']:>9g}{measured['rows']:>8g}"
+                f"{measured['sql_ms']:>9.1f}")
+        expected = baseline and baseline["routes"].get(name)
+
+        if expected:
+            change = (measured["p95_ms"] / expected["p95_ms"] - 1) * 100
+            line += f"{change:>+12.0f}%"
+
+        print(line)
+
+    for name, found in (regressions or {}).items():
+        print(f"REGRESSION {name}: {', '.join(found)}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure each route's latency and SQL cost.")
+    parser.add_argument("--db-uri", default="postgresql:///nourish")
+    parser.add_argument("--requests", type=int, default=50,
+                        help="measured requests per route")
+    parser.add_argument("--warm-ups", type=int, default=3,
+                        help="unmeasured requests per route first")
+    parser.add_argument("--password", default="password",
+                        help="the dataset's login password")
+    parser.add_argument("--output", help="save results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with results saved "
+                                           "by an earlier --output")
+    parser.add_argument("--latency-threshold", type=float, default=20,
+                        help="percent p50 or p95 may grow")
+    parser.add_argument("--query-threshold", type=float, default=0,
+                        help="extra queries a route may issue")
+    parser.add_argument("--rows-threshold", type=float, default=10,
+                        help="percent more rows a route may return")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.db_uri, args.requests, args.warm_ups,
+                            args.password)
+    baseline = regressions = None
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = compare_results(results, baseline,
+                                      args.latency_threshold,
+                                      args.query_threshold,
+                                      args.rows_threshold)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.json:
+        print(json.dumps({**results, "regressions": regressions}, indent=2))
+    else:
+        print_report(results, baseline, regressions)
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,145 @@
+"""Report time-to-first-response for a freshly started server process.
+
+Each run starts a new Python process, imports the app, and times its first
+and second requests for a patient's feed. Three kinds of start are compared:
+
+    cold          templates compiled lazily, no bytecode cache on disk
+    warm-up       every template compiled at start, bytecode cache empty
+    warm-up+disk  every template loaded at start from the bytecode cache
+
+Run from the project root against a database with realistic data:
+
+    python3 -m benchmarks.startup [--db-uri postgresql:///nourish] [--runs 5]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SCENARIOS = [("cold", False, False),
+             ("warm-up", True, False),
+             ("warm-up+disk", True, True)]
+
+
+def start_worker(db_uri, warm_up):
+    """Start the app in this process and time one page's first requests.
+
+    Returns a dictionary of milliseconds.
+    """
+
+    start = time.perf_counter()
+
+    from model import connect_to_db, db
+    from server import app, use_template_cache, warm_up_templates
+
+    connect_to_db(app, db_uri=db_uri)
+    use_template_cache()
+
+    if warm_up:
+        warm_up_templates()
+
+    started = time.perf_counter()
+
+    patient_id = db.session.execute("""SELECT patient_id FROM posts
+                                       GROUP BY patient_id
+                                       ORDER BY count(*) DESC
+                                       LIMIT 1""").scalar()
+    db.session.remove()
+
+    client = app.test_client()
+
+    with client.session_transaction() as session:
+        session["patient_id"] = patient_id
+
+    timings = []
+
+    for _ in range(2):
+        request_start = time.perf_counter()
+        response = client.get(f"/patient/{patient_id}/posts")
+        timings.append(time.perf_counter() - request_start)
+        assert response.status_code == 200, response.status_code
+
+    return {"startup_ms": (started - start) * 1000,
+            "first_response_ms": timings[0] * 1000,
+            "second_response_ms": timings[1] * 1000}
+
+
+def run_worker(db_uri, warm_up, template_cache_dir):
+    """Run start_worker in a new process and return its timings."""
+
+    command = [sys.executable, "-m", "benchmarks.startup",
+               "--db-uri", db_uri, "--worker"]
+
+    if warm_up:
+        command.append("--warm-up")
+
+    env = dict(os.environ, TEMPLATE_CACHE_DIR=template_cache_dir)
+    output = subprocess.run(command, env=env, check=True,
+                            stdout=subprocess.PIPE).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+
+def run_benchmark(db_uri, runs):
+    """Return median timings for each kind of start."""
+
+    results = {}
+
+    for name, warm_up, reuse_cache in SCENARIOS:
+        worker_timings = []
+
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as template_cache_dir:
+                if reuse_cache:
+                    run_worker(db_uri, True, template_cache_dir)
+
+                worker_timings.append(
+                    run_worker(db_uri, warm_up, template_cache_dir))
+
+        results[name] = {key: round(statistics.median(
+                             timings[key] for timings in worker_timings), 1)
+                         for key in worker_timings[0]}
+
+    return results
+
+
+def print_report(results):
+    """Print startup and first-response times for each kind of start."""
+
+    print(f"{'start':<14}{'startup ms':>12}{'first ms':>10}{'second ms':>11}")
+
+    for name, timings in results.items():
+        print(f"{name:<14}{timings['startup_ms']:>12.1f}"
+              f"{timings['first_response_ms']:>10.1f}"
+              f"{timings['second_response_ms']:>11.1f}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare first-response times for cold and warm starts.")
+    parser.add_argument("--db-uri", default="postgresql:///nourish")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    parser.add_argument("--worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--warm-up", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(start_worker(args.db_uri, args.warm_up)))
+    else:
+        results = run_benchmark(args.db_uri, args.runs)
+
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_report(results)
@@ -0,0 +1,195 @@
+"""Bulk load the pipe-delimited seed files into an empty database.
+
+Like seed.py, but built for large staging datasets: files are streamed in
+batches, passwords are hashed across a process pool, and rows go in through
+PostgreSQL COPY (or batched INSERTs with --executemany) instead of the ORM.
+
+    python3 bulk_seed.py --data-dir seed_data --workers 8
+"""
+
+import argparse
+import csv
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from psycopg2.extras import execute_values
+from werkzeug.security import generate_password_hash
+
+from model import connect_to_db, db
+from passwords import HASH_METHOD, SALT_LENGTH
+from rollups import backfill_weekly_ratings
+from server import app
+
+
+# (table, seed file, columns in file order, primary key column). Seed files
+# don't include ids; rows reference each other by line number, so each row's
+# id is its line number in the file.
+SEED_TABLES = [
+    ("user_types", "u.usertype", ["type_code", "user_type_name"], None),
+    ("dietitians", "u.dietitian",
+     ["fname", "lname", "email", "password_hash", "street_address", "city",
+      "state", "zipcode"],
+     "dietitian_id"),
+    ("patients", "u.patient",
+     ["dietitian_id", "fname", "lname", "email", "password_hash",
+      "street_address", "city", "state", "zipcode", "phone", "birthdate"],
+     "patient_id"),
+    ("goals", "u.goal", ["patient_id", "time_stamp", "goal_body"], "goal_id"),
+    ("posts", "u.post",
+     ["patient_id", "time_stamp", "meal_time", "img_path", "meal_setting",
+      "TEB", "hunger", "fullness", "satisfaction"],
+     "post_id"),
+    ("comments", "u.comment",
+     ["post_id", "author_id", "author_type", "time_stamp", "comment_body"],
+     "comment_id"),
+]
+
+# Columns the ORM fills with a default that the seed files leave out.
+DEFAULT_COLUMNS = {
+    "patients": {"hunger_visible": False, "fullness_visible": False,
+                 "satisfaction_visible": False},
+    "goals": {"edited": False},
+    "posts": {"edited": False},
+    "comments": {"edited": False},
+}
+
+
+def read_batches(filename, batch_size):
+    """Yield lists of split rows from a pipe-delimited file, batch by batch."""
+
+    with open(filename) as seed_file:
+        rows = (line.rstrip("\n").split("|") for line in seed_file if line.strip())
+
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+def hash_passwords(pool, batch, password_index, workers):
+    """Replace the plain-text passwords in a batch with hashes, in parallel."""
+
+    passwords = [row[password_index] for row in batch]
+    chunksize = max(1, len(passwords) // (workers * 4))
+    hash_function = partial(generate_password_hash, method=HASH_METHOD,
+                            salt_length=SALT_LENGTH)
+    hashes = pool.map(hash_function, passwords, chunksize=chunksize)
+
+    for row, password_hash in zip(batch, hashes):
+        row[password_index] = password_hash
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Insert rows with COPY FROM STDIN. Empty fields are loaded as NULL."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    quoted_columns = ", ".join(f'"{column}"' for column in columns)
+    cursor.copy_expert(f"COPY {table} ({quoted_columns}) FROM STDIN "
+                       "WITH (FORMAT csv)", buffer)
+
+
+def insert_rows(cursor, table, columns, rows):
+    """Insert rows with batched multi-row INSERTs. Empty fields become NULL."""
+
+    rows = [[value if value != "" else None for value in row] for row in rows]
+    quoted_columns = ", ".join(f'"{column}"' for column in columns)
+
+    execute_values(cursor, f"INSERT INTO {table} ({quoted_columns}) VALUES %s",
+                   rows, page_size=1000)
+
+
+def reset_sequence(cursor, table, id_column):
+    """Move a table's id sequence past the ids that were loaded explicitly."""
+
+    cursor.execute(f"""SELECT setval(pg_get_serial_sequence('{table}', '{id_column}'),
+                                     coalesce(max({id_column}), 1),
+                                     max({id_column}) IS NOT NULL)
+                       FROM {table}""")
+
+
+def load_table(conn, pool, workers, data_dir, table, filename, columns,
+               id_column, batch_size, use_copy):
+    """Stream one seed file into its table and return the number of rows."""
+
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+    if cursor.fetchone()[0]:
+        raise SystemExit(f"{table} already has rows; bulk_seed.py needs "
+                         "empty tables.")
+
+    defaults = DEFAULT_COLUMNS.get(table, {})
+    all_columns = ([id_column] if id_column else []) + columns + list(defaults)
+    password_index = (columns.index("password_hash")
+                      if "password_hash" in columns else None)
+    write_rows = copy_rows if use_copy else insert_rows
+    num_rows = 0
+
+    for batch in read_batches(os.path.join(data_dir, filename), batch_size):
+        if password_index is not None:
+            hash_passwords(pool, batch, password_index, workers)
+
+        rows = []
+        for row in batch:
+            num_rows += 1
+            row_id = [num_rows] if id_column else []
+            rows.append(row_id + row + list(defaults.values()))
+
+        write_rows(cursor, table, all_columns, rows)
+
+    if id_column:
+        reset_sequence(cursor, table, id_column)
+
+    conn.commit()
+
+    return num_rows
+
+
+def bulk_load(data_dir, workers, batch_size, use_copy=True):
+    """Load every seed file in data_dir and print throughput per table."""
+
+    conn = db.engine.raw_connection()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for table, filename, columns, id_column in SEED_TABLES:
+                start = time.perf_counter()
+                num_rows = load_table(conn, pool, workers, data_dir, table,
+                                      filename, columns, id_column, batch_size,
+                                      use_copy)
+                elapsed = time.perf_counter() - start
+
+                print(f"{table}: {num_rows} rows in {elapsed:.2f}s "
+                      f"({num_rows / elapsed:.0f} rows/s)")
+
+    finally:
+        conn.close()
+
+    start = time.perf_counter()
+    num_weeks = backfill_weekly_ratings()
+    print(f"weekly_ratings: {num_weeks} rows in "
+          f"{time.perf_counter() - start:.2f}s")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bulk load seed files into an empty database.")
+    parser.add_argument("--data-dir", default="seed_data")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--executemany", action="store_true",
+                        help="use batched INSERTs instead of COPY")
+    args = parser.parse_args()
+
+    connect_to_db(app)
+    db.create_all()
+    bulk_load(args.data_dir, args.workers, args.batch_size,
+              use_copy=not args.executemany)
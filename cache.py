@@ -0,0 +1,118 @@
+"""In-process caches for values derived from the database.
+
+Caches live in the memory of a single server process, which is how Nourish is
+deployed (see flask.service). Code that writes the underlying rows is
+responsible for keeping the matching cache entries up to date.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+_all_caches = []
+
+
+class Cache:
+    """A small thread-safe key/value cache."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = Lock()
+        _all_caches.append(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def increment(self, key, amount=1):
+        """Add to a counter, starting from zero, and return the new value."""
+
+        with self._lock:
+            value = self._data.get(key, 0) + amount
+            self._data[key] = value
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LRUCache:
+    """A thread-safe cache holding at most max_size worth of values.
+
+    Each value's size is measured with sizeof (len by default). Setting a
+    value evicts the least recently used entries until the total fits. Any
+    entry may be evicted, so unlike Cache this has no counters.
+    """
+
+    def __init__(self, max_size, sizeof=len):
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = Lock()
+        self.max_size = max_size
+        self.size = 0
+        self.sizeof = sizeof
+        _all_caches.append(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        value_size = self.sizeof(value)
+
+        with self._lock:
+            self._discard(key)
+
+            if value_size > self.max_size:
+                return
+
+            self._data[key] = value
+            self._sizes[key] = value_size
+            self.size += value_size
+
+            while self.size > self.max_size:
+                self._discard(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.size = 0
+
+    def _discard(self, key):
+        if key in self._data:
+            del self._data[key]
+            self.size -= self._sizes.pop(key)
+
+
+def clear_all_caches():
+    """Empty every cache, e.g. after the database has been reloaded."""
+
+    for cache in _all_caches:
+        cache.clear()
+
+
+# Months that have posts, newest first, keyed by ("patient", patient_id) or
+# ("dietitian", dietitian_id).
+months_cache = Cache()
+
+# Counters bumped whenever a patient's posts change, keyed by patient_id. See
+# data_versions.py.
+data_versions = Cache()
@@ -1,4 +1,5 @@
 from datetime import datetime
+from fragments import bump_post_version
 from model import db, Comment
 from users import (get_user_type_from_session, get_current_dietitian, 
                    get_current_patient)
@@ -31,6 +32,8 @@ def add_post_comment(post_id, form_data):
     db.session.add(new_comment)
     db.session.commit()
 
+    bump_post_version(post_id)
+
     return(new_comment)
 
 
@@ -46,6 +49,8 @@ def edit_post_comment(comment_id, form_data):
     db.session.add(comment)
     db.session.commit()
 
+    bump_post_version(comment.post_id)
+
     return comment
 
 
@@ -53,10 +58,13 @@ def delete_comment(comment_id):
     """Delete a comment in the database."""
 
     comment = Comment.query.get(comment_id)
+    post_id = comment.post_id
 
     db.session.delete(comment)
     db.session.commit()
 
+    bump_post_version(post_id)
+
     return "Success"
 
 
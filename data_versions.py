@@ -0,0 +1,43 @@
+"""Per-patient data versions, for answering conditional GETs cheaply.
+
+Every write to a patient's posts bumps their version. Responses built from
+that data carry an ETag derived from the version, so when a browser asks
+again with If-None-Match and nothing has changed, the server can answer
+304 Not Modified without running a single query.
+
+Versions live in process memory (see cache.py), so each ETag also includes
+an id for this server process; after a restart every old ETag misses once.
+"""
+
+from hashlib import sha1
+from uuid import uuid4
+
+from cache import data_versions
+
+
+PROCESS_ID = uuid4().hex[:12]
+
+
+def get_data_version(patient_id):
+    """Return the current data version for a patient."""
+
+    return data_versions.get(patient_id, 0)
+
+
+def bump_data_version(patient_id):
+    """Mark a patient's data as changed. Call after the write commits."""
+
+    return data_versions.increment(patient_id)
+
+
+def get_patient_data_etag(patient_id, variant=b""):
+    """Return a strong ETag for a patient's data at its current version.
+
+    variant distinguishes different responses built from the same data,
+    e.g. the request's query string.
+    """
+
+    variant_hash = sha1(variant).hexdigest()[:12]
+    version = get_data_version(patient_id)
+
+    return f"{PROCESS_ID}-{patient_id}-{version}-{variant_hash}"
@@ -1,11 +1,26 @@
+from datetime import date
 from functools import wraps
 
-from flask import render_template, session, request, redirect
+from flask import render_template, request, redirect, make_response
 
-from users import (check_dietitian_authorization, check_patient_authorization,
-                   get_user_type_from_session, get_dietitian_and_patients_list,
-                   get_current_dietitian, get_current_patient)
-from model import Patient
+from data_versions import get_patient_data_etag
+
+from users import (check_dietitian_authorization, get_user_type_from_session,
+                   get_current_patient, get_authorized_patient)
+
+
+def render_unauthorized():
+    """Render the unauthorized page for whoever is logged in.
+
+    The navbar only needs a patient object for patients; dietitian links come
+    straight from the session, so no dietitian is loaded.
+    """
+
+    if get_user_type_from_session() == "patient":
+        patient = get_current_patient()
+        return render_template("unauthorized.html", patient=patient)
+
+    return render_template("unauthorized.html")
 
 
 def dietitian_auth(fn):
@@ -14,13 +29,11 @@ def dietitian_auth(fn):
     def decorated_view(*args, **kwargs):
         user_type = get_user_type_from_session()
         if user_type == "patient":
-            patient = get_current_patient()
-            return render_template("unauthorized.html", patient=patient)
+            return render_unauthorized()
 
         dietitian_id = kwargs["dietitian_id"]
         if not check_dietitian_authorization(dietitian_id):
-            dietitian = get_current_dietitian()
-            return render_template("unauthorized.html", dietitian=dietitian)
+            return render_unauthorized()
                 
         return fn(*args, **kwargs)
     return decorated_view
@@ -32,8 +45,7 @@ def dietitians_only(fn):
     def decorated_view(*args, **kwargs):
         user_type = get_user_type_from_session()
         if user_type != "dietitian":
-            patient = get_current_patient()
-            return render_template("unauthorized.html", patient=patient)
+            return render_unauthorized()
         return fn(*args, **kwargs)
     return decorated_view
 
@@ -43,20 +55,10 @@ def patient_or_dietitian_auth(fn):
     @wraps(fn)
     def decorated_view(*args, **kwargs):
         
-        user_type = get_user_type_from_session()
         patient_id = kwargs["patient_id"]
         
-        if user_type == "dietitian":
-            patient = Patient.query.get(patient_id)
-            dietitian = get_current_dietitian()
-            
-            if not patient or (patient.dietitian_id != session.get("dietitian_id")):
-                return render_template("unauthorized.html", dietitian=dietitian)
-
-        else:
-            if not check_patient_authorization(patient_id):
-                patient = get_current_patient()
-                return render_template("unauthorized.html", patient=patient)
+        if not get_authorized_patient(patient_id):
+            return render_unauthorized()
 
         return fn(*args, **kwargs)
     return decorated_view
@@ -70,15 +72,12 @@ def patient_belongs_to_dietitian(fn):
         user_type = get_user_type_from_session()
 
         if user_type == "patient":
-            patient = get_current_patient()
-            return render_template("unauthorized.html", patient=patient)
+            return render_unauthorized()
 
         patient_id = kwargs["patient_id"]
-        patient = Patient.query.get(patient_id)
 
-        if not patient or (patient.dietitian_id != session.get("dietitian_id")):
-            dietitian = get_current_dietitian()
-            return render_template("unauthorized.html", dietitian=dietitian)
+        if not get_authorized_patient(patient_id):
+            return render_unauthorized()
 
         return fn(*args, **kwargs)
     return decorated_view
@@ -91,13 +90,11 @@ def patient_auth(fn):
 
         user_type = get_user_type_from_session()
         if user_type == "dietitian":
-            dietitian = get_current_dietitian()
-            return render_template("unauthorized.html", dietitian=dietitian)
+            return render_unauthorized()
         
         patient_id = kwargs["patient_id"]
-        if not check_patient_authorization(patient_id):
-            patient = get_current_patient()
-            return render_template("unauthorized.html", patient=patient)
+        if not get_authorized_patient(patient_id):
+            return render_unauthorized()
 
         return fn(*args, **kwargs)
     return decorated_view
@@ -115,4 +112,28 @@ def dietitian_redirect(fn):
     return decorated_view
 
 
+def patient_data_etag(fn):
+    """Answer conditional GETs for a patient's data from its data version.
+
+    When the browser's cached copy is still current, return 304 Not Modified
+    before the view (and its queries) runs.
+    """
+    @wraps(fn)
+    def decorated_view(*args, **kwargs):
+
+        # Read the version before the view runs, so a write made while it
+        # runs can only make the ETag stale, never wrong. Views like recent
+        # ratings depend on today's date too.
+        variant = f"{request.full_path} {date.today().isoformat()}"
+        etag = get_patient_data_etag(kwargs["patient_id"], variant.encode())
 
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+        else:
+            response = make_response(fn(*args, **kwargs))
+
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+
+        return response
+    return decorated_view
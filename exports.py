@@ -0,0 +1,144 @@
+"""Stream a patient's whole food journal as CSV or NDJSON.
+
+Posts, then comments, then goals are read through server-side cursors
+(yield_per), written out a batch of rows at a time and, when the client
+accepts it, gzipped on the fly. Memory use stays the same however long the
+journal is, and the first bytes go out as soon as the first batch is read.
+"""
+
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+
+from model import db, Comment, Goal, Post
+
+
+YIELD_PER = 1000
+CHUNK_SIZE = 64 * 1024
+GZIP_LEVEL = 6
+
+EXPORT_MIMETYPES = {"csv": "text/csv",
+                    "ndjson": "application/x-ndjson"}
+
+# The columns exported for each kind of record, in order.
+RECORD_COLUMNS = {
+    "post": [Post.post_id, Post.time_stamp, Post.edited, Post.meal_time,
+             Post.meal_setting, Post.TEB, Post.hunger, Post.fullness,
+             Post.satisfaction, Post.meal_notes, Post.img_path],
+    "comment": [Comment.comment_id, Comment.post_id, Comment.time_stamp,
+                Comment.edited, Comment.author_type, Comment.comment_body],
+    "goal": [Goal.goal_id, Goal.time_stamp, Goal.edited, Goal.goal_body],
+}
+
+# A CSV file has one header, so it has every record's columns, plus one
+# saying which kind of record each row is.
+CSV_FIELDS = ["record"] + list(dict.fromkeys(
+    column.key for columns in RECORD_COLUMNS.values() for column in columns))
+
+
+def query_records(patient_id):
+    """Yield (record type, row) for a patient's posts, comments and goals."""
+
+    queries = {
+        "post": (db.session.query(*RECORD_COLUMNS["post"])
+                           .filter(Post.patient_id == patient_id)
+                           .order_by(Post.time_stamp, Post.post_id)),
+        "comment": (db.session.query(*RECORD_COLUMNS["comment"])
+                              .join(Post)
+                              .filter(Post.patient_id == patient_id)
+                              .order_by(Comment.time_stamp,
+                                        Comment.comment_id)),
+        "goal": (db.session.query(*RECORD_COLUMNS["goal"])
+                           .filter(Goal.patient_id == patient_id)
+                           .order_by(Goal.time_stamp, Goal.goal_id)),
+    }
+
+    # Rows are plain tuples, not ORM objects, so the session doesn't keep
+    # them, and yield_per streams them through a named cursor.
+    for record_type, query in queries.items():
+        for row in query.yield_per(YIELD_PER):
+            yield record_type, row._asdict()
+
+
+def format_value(value):
+    """Return a value as JSON and CSV can hold it."""
+
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return value
+
+
+def write_csv(records):
+    """Yield the text of a CSV export, a chunk at a time."""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+
+    # Send the header before the first query runs.
+    writer.writeheader()
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+    for record_type, row in records:
+        writer.writerow({"record": record_type,
+                         **{key: format_value(value)
+                            for key, value in row.items()}})
+
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_ndjson(records):
+    """Yield the text of an NDJSON export, a chunk at a time."""
+
+    lines = []
+    size = 0
+
+    for record_type, row in records:
+        line = json.dumps({"record": record_type,
+                           **{key: format_value(value)
+                              for key, value in row.items()}})
+        lines.append(line)
+        size += len(line) + 1
+
+        if size >= CHUNK_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+            size = 0
+
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def gzip_chunks(chunks):
+    """Gzip a stream of bytes, flushing after each chunk so it goes out."""
+
+    # 16 + MAX_WBITS asks zlib for a gzip header and trailer.
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    yield compressor.flush()
+
+
+def generate_export(patient_id, export_format, gzip=False):
+    """Return a stream of bytes of a patient's journal, as "csv" or "ndjson"."""
+
+    write = write_csv if export_format == "csv" else write_ndjson
+    chunks = (text.encode() for text in write(query_records(patient_id)))
+
+    if gzip:
+        chunks = gzip_chunks(chunks)
+
+    return chunks
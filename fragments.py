@@ -0,0 +1,235 @@
+"""Cache rendered post cards, so feed pages are mostly assembled from HTML.
+
+A post card (templates/post-card.html) shows the image, ratings, notes and
+comment thread. Its HTML is cached under the post's id and a version that is
+bumped whenever the post or one of its comments is edited or deleted, plus a
+digest of everything else the card shows: who is looking, the author's and
+dietitian's names and the patient's rating settings. Stale entries are never
+served; they just age out of the cache.
+
+Versions come from one sequence shared by all posts. A feed notes the latest
+version before querying its posts, and a card whose post changed after that
+is rendered but not cached, since the feed may have loaded it mid-change.
+
+Cards are kept in an in-process LRU cache. Settings are read from the
+environment (see secrets.sh):
+
+    FRAGMENT_CACHE_BYTES  size of the in-process cache
+    FRAGMENT_CACHE_URL    redis:// URL of a cache shared by every server
+                          process; needs the redis package
+"""
+
+import hashlib
+import os
+from threading import Lock
+
+from flask import current_app, g, has_app_context, Markup, session
+from jinja2 import contextfunction
+
+from cache import Cache, LRUCache
+
+
+FRAGMENT_CACHE_BYTES = int(os.environ.get("FRAGMENT_CACHE_BYTES",
+                                          32 * 1024 * 1024))
+FRAGMENT_CACHE_URL = os.environ.get("FRAGMENT_CACHE_URL")
+
+LATEST_VERSION_KEY = "latest"
+
+# Shared entries expire eventually, so old versions don't pile up.
+SHARED_TTL_SECONDS = 7 * 24 * 60 * 60
+
+POST_CARD_TEMPLATE = "post-card.html"
+
+# Rendered cards keyed by their full cache key, and post versions by post_id.
+post_cards = LRUCache(FRAGMENT_CACHE_BYTES,
+                      sizeof=lambda html: len(html.encode()))
+post_versions = Cache()
+_versions_lock = Lock()
+
+_shared = None
+_shared_lock = Lock()
+_template_digest = None
+
+
+class RedisFragmentStore:
+    """Post cards and versions kept in Redis, shared by server processes."""
+
+    # Take the next version and give it to the post in one atomic step.
+    BUMP_SCRIPT = """
+        local version = redis.call("INCR", KEYS[1])
+        redis.call("SET", KEYS[2], version)
+        return version
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.errors = (redis.RedisError,)
+        self.bump_script = self.client.register_script(self.BUMP_SCRIPT)
+
+    def get_version(self, post_id):
+        return int(self.client.get(f"post-version:{post_id}") or 0)
+
+    def bump_version(self, post_id):
+        return self.bump_script(keys=[f"post-version:{LATEST_VERSION_KEY}",
+                                      f"post-version:{post_id}"])
+
+    def get(self, key):
+        html = self.client.get(key)
+        return html.decode() if html is not None else None
+
+    def set(self, key, html):
+        self.client.set(key, html.encode(), ex=SHARED_TTL_SECONDS)
+
+
+def get_shared_store():
+    """Return the shared store, or None if FRAGMENT_CACHE_URL isn't set."""
+
+    global _shared
+
+    if not FRAGMENT_CACHE_URL:
+        return None
+
+    with _shared_lock:
+        if _shared is None:
+            _shared = RedisFragmentStore(FRAGMENT_CACHE_URL)
+
+        return _shared
+
+
+def get_post_version(post_id):
+    """Return the version of a post's card, or None if it can't be read.
+
+    Pass LATEST_VERSION_KEY for the newest version given to any post.
+    """
+
+    shared = get_shared_store()
+
+    if shared:
+        try:
+            return shared.get_version(post_id)
+        except shared.errors:
+            current_app.logger.exception("Couldn't read a post version")
+            return None
+
+    return post_versions.get(post_id, 0)
+
+
+def note_post_versions():
+    """Remember the latest post version. Call before querying a feed."""
+
+    if has_app_context():
+        g.post_versions_as_of = get_post_version(LATEST_VERSION_KEY)
+
+
+def bump_post_version(post_id):
+    """Mark a post's card as changed. Call after the write commits."""
+
+    shared = get_shared_store()
+
+    if shared:
+        try:
+            shared.bump_version(post_id)
+        except shared.errors:
+            current_app.logger.exception(f"Couldn't bump post {post_id}'s "
+                                         "version; its card may be stale")
+        return
+
+    with _versions_lock:
+        version = post_versions.increment(LATEST_VERSION_KEY)
+        post_versions.set(post_id, version)
+
+
+def get_template_digest(environment):
+    """Return a digest of the card template, so edits to it miss the cache."""
+
+    global _template_digest
+
+    if _template_digest is None:
+        source = environment.loader.get_source(environment,
+                                               POST_CARD_TEMPLATE)[0]
+        _template_digest = hashlib.sha1(source.encode()).hexdigest()[:12]
+
+    return _template_digest
+
+
+def get_post_card_key(context, post, version):
+    """Return the cache key for a post card as seen in a template context."""
+
+    patient = post.patient
+    dietitian = context.get("dietitian")
+    parts = [get_template_digest(context.environment),
+             bool(session.get("patient_id")),
+             bool(session.get("dietitian_id")),
+             patient.fname, patient.lname]
+
+    if dietitian:
+        parts += [dietitian.fname, dietitian.lname]
+
+    # Only patients see the edit form, which depends on their settings.
+    if session.get("patient_id"):
+        viewer = context["patient"]
+        parts += [viewer.hunger_visible, viewer.fullness_visible,
+                  viewer.satisfaction_visible]
+
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+    return f"post-card:{post.post_id}:{version}:{digest}"
+
+
+def get_cached_card(key):
+    """Return a card from the in-process cache, then the shared one."""
+
+    html = post_cards.get(key)
+    shared = get_shared_store()
+
+    if html is None and shared:
+        try:
+            html = shared.get(key)
+        except shared.errors:
+            return None
+
+        if html is not None:
+            post_cards.set(key, html)
+
+    return html
+
+
+def cache_card(key, html):
+    """Save a rendered card in the in-process and shared caches."""
+
+    post_cards.set(key, html)
+    shared = get_shared_store()
+
+    if shared:
+        try:
+            shared.set(key, html)
+        except shared.errors:
+            pass
+
+
+@contextfunction
+def render_post_card(context, post):
+    """Return a post's card as HTML, rendering it only if it isn't cached.
+
+    Registered as the post_card template global; posts.html calls it for
+    each post in a feed.
+    """
+
+    as_of = g.get("post_versions_as_of")
+    version = get_post_version(post.post_id) if as_of is not None else None
+    key = html = None
+
+    if version is not None and version <= as_of:
+        key = get_post_card_key(context, post, version)
+        html = get_cached_card(key)
+
+    if html is None:
+        template = context.environment.get_template(POST_CARD_TEMPLATE)
+        html = template.render(dict(context.get_all(), post=post))
+
+        if key:
+            cache_card(key, html)
+
+    return Markup(html)
@@ -0,0 +1,279 @@
+"""Transcode and resize post images for the feed and ratings chart.
+
+The uploaded file is kept untouched as an archival copy under "originals/".
+What pages actually show are copies at a few widths, re-encoded as WebP or
+optimized JPEG with EXIF and other metadata stripped, and recorded as
+PostImageVariant rows so pages can offer them in a srcset. The widest copy
+becomes the post's img_path.
+
+Encoding is CPU bound, so it runs in a process pool, rebuilt if a worker
+dies (see worker_pools.py). Settings are read from the environment (see
+secrets.sh):
+
+    IMAGE_FORMAT     "webp" (default) or "jpeg"
+    IMAGE_QUALITY    starting encoder quality, 1-100
+    IMAGE_MAX_BYTES  byte budget for each copy; quality is lowered to fit
+    IMAGE_WORKERS    encoding processes; 0 encodes inline
+
+Run this file to create copies for posts saved before they existed.
+"""
+
+import io
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+
+from fragments import bump_post_version
+from model import connect_to_db, db, Post, PostImageVariant
+from storage import get_storage, STORAGE_ERRORS
+from worker_pools import WorkerPool
+
+
+VARIANT_WIDTHS = [320, 640, 1280]
+
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "webp")
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 80))
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", 300 * 1024))
+WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+
+# Pillow format name and file extension for each IMAGE_FORMAT.
+FORMATS = {"webp": ("WEBP", ".webp"),
+           "jpeg": ("JPEG", ".jpg")}
+
+# Raised by Pillow for files it can't decode (OSError covers unknown formats).
+IMAGE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+
+MIN_QUALITY = 40
+QUALITY_STEP = 10
+ORIGINALS_PREFIX = "originals/"
+
+# EXIF orientations that rotate the image by 90 degrees.
+SIDEWAYS_ORIENTATIONS = {5, 6, 7, 8}
+EXIF_ORIENTATION = 0x0112
+
+pool = WorkerPool(WORKERS)
+
+
+def get_variant_widths(source_path):
+    """Return the widths to resize an image to, never wider than itself.
+
+    An image narrower than the largest variant also gets a copy at its own
+    width, so the srcset always has a candidate for large screens.
+    """
+
+    with Image.open(source_path) as image:
+        width, height = image.size
+
+        if image.getexif().get(EXIF_ORIENTATION) in SIDEWAYS_ORIENTATIONS:
+            width = height
+
+    return sorted({min(variant_width, width)
+                   for variant_width in VARIANT_WIDTHS})
+
+
+def load_image(source_path, image_format):
+    """Open an image upright, without metadata, in a mode the format takes."""
+
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or (
+        image.mode == "P" and "transparency" in image.info)
+
+    if has_alpha and image_format == "WEBP":
+        image = image.convert("RGBA")
+    elif has_alpha:
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image.convert("RGBA"), mask=image.convert("RGBA"))
+        image = background
+    else:
+        image = image.convert("RGB")
+
+    # Only the color profile is worth keeping; EXIF can hold GPS coordinates.
+    image.info = {key: value for key, value in image.info.items()
+                  if key == "icc_profile"}
+
+    return image
+
+
+def encode_image(image, image_format, quality, max_bytes=None):
+    """Return an image encoded as bytes, lowering quality to fit max_bytes.
+
+    Quality never drops below MIN_QUALITY, so an image that can't fit the
+    budget is returned at that quality rather than degraded further.
+    """
+
+    while True:
+        image_file = io.BytesIO()
+
+        if image_format == "JPEG":
+            image.save(image_file, "JPEG", quality=quality, optimize=True,
+                       progressive=True)
+        else:
+            image.save(image_file, image_format, quality=quality, method=4)
+
+        image_bytes = image_file.getvalue()
+
+        if (not max_bytes or len(image_bytes) <= max_bytes or
+            quality <= MIN_QUALITY):
+            return image_bytes
+
+        quality = max(MIN_QUALITY, quality - QUALITY_STEP)
+
+
+def resize_image(source_path, width, dest_path, image_format=None,
+                 quality=None, max_bytes=None):
+    """Save a transcoded copy of an image at width; return (width, height)."""
+
+    image_format = image_format or FORMATS[IMAGE_FORMAT][0]
+    image = load_image(source_path, image_format)
+
+    height = max(1, round(image.height * width / image.width))
+
+    if (width, height) != image.size:
+        image = image.resize((width, height), Image.LANCZOS)
+
+    image_bytes = encode_image(image, image_format, quality or IMAGE_QUALITY,
+                               max_bytes or IMAGE_MAX_BYTES)
+
+    with open(dest_path, "wb") as dest_file:
+        dest_file.write(image_bytes)
+
+    return width, height
+
+
+def get_original_key(key):
+    """Return the storage key for an upload's archival copy."""
+
+    return f"{ORIGINALS_PREFIX}{key}"
+
+
+def get_variant_key(key, width):
+    """Return the storage key for a variant, e.g. "a-lunch-640w.webp"."""
+
+    stem = os.path.splitext(key)[0]
+    extension = FORMATS[IMAGE_FORMAT][1]
+
+    return f"{stem}-{width}w{extension}"
+
+
+def encode_image_variants(source_path, key, variant_dir):
+    """Write transcoded copies of an image at each width into variant_dir.
+
+    Returns a list of (width, height, path), narrowest first. Raises one of
+    IMAGE_ERRORS if the image can't be decoded.
+    """
+
+    widths = get_variant_widths(source_path)
+    paths = [os.path.join(variant_dir, get_variant_key(key, width))
+             for width in widths]
+
+    if WORKERS:
+        jobs = [(source_path, width, path) for width, path in zip(widths, paths)]
+        sizes = pool.run_all(resize_image, jobs)
+    else:
+        sizes = [resize_image(source_path, width, path)
+                 for width, path in zip(widths, paths)]
+
+    return [(width, height, path) for (width, height), path in zip(sizes, paths)]
+
+
+def save_image_variants(encoded_variants, key):
+    """Store encoded copies and return their details for the database."""
+
+    storage = get_storage()
+
+    return [{"width": width,
+             "height": height,
+             "img_path": storage.save_file(get_variant_key(key, width), path)}
+            for width, height, path in encoded_variants]
+
+
+def store_post_image(source_path, key):
+    """Store an uploaded image and its transcoded copies.
+
+    Returns (img_path, variants). If the image can't be decoded, the
+    archival copy is served as-is and there are no variants.
+    """
+
+    original_path = get_storage().save_file(get_original_key(key),
+                                            source_path)
+
+    with tempfile.TemporaryDirectory() as variant_dir:
+        try:
+            encoded_variants = encode_image_variants(source_path, key,
+                                                     variant_dir)
+        except IMAGE_ERRORS:
+            return original_path, []
+
+        variants = save_image_variants(encoded_variants, key)
+
+    return variants[-1]["img_path"], variants
+
+
+def replace_post_image_variants(post, variants):
+    """Swap a post's variant rows for new ones. The caller commits."""
+
+    for variant in post.image_variants:
+        db.session.delete(variant)
+
+    post.image_variants = [PostImageVariant(width=variant["width"],
+                                            height=variant["height"],
+                                            img_path=variant["img_path"])
+                           for variant in variants]
+
+
+def backfill_image_variants():
+    """Create transcoded copies for every post with an image but no variants.
+
+    The image the post pointed at stays in storage as its archival copy,
+    and the post is switched to the widest transcoded copy. Returns
+    (posts updated, posts skipped); images that aren't in the configured
+    storage, or that can't be read, are skipped.
+    """
+
+    storage = get_storage()
+    posts = (Post.query.outerjoin(PostImageVariant)
+                       .filter(Post.img_path.isnot(None),
+                               PostImageVariant.variant_id.is_(None))
+                       .order_by(Post.post_id)
+                       .all())
+    num_updated = num_skipped = 0
+
+    for post in posts:
+        key = storage.get_key(post.img_path)
+
+        if not key:
+            num_skipped += 1
+            continue
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            source_path = os.path.join(work_dir, os.path.basename(key))
+
+            try:
+                storage.download(key, source_path)
+                encoded_variants = encode_image_variants(source_path, key,
+                                                         work_dir)
+                variants = save_image_variants(encoded_variants, key)
+            except STORAGE_ERRORS + IMAGE_ERRORS:
+                num_skipped += 1
+                continue
+
+        post.img_path = variants[-1]["img_path"]
+        replace_post_image_variants(post, variants)
+        db.session.commit()
+        bump_post_version(post.post_id)
+        num_updated += 1
+
+    return num_updated, num_skipped
+
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    num_updated, num_skipped = backfill_image_variants()
+    print(f"Created image copies for {num_updated} posts; "
+          f"skipped {num_skipped}.")
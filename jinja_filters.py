@@ -1,16 +1,43 @@
-"""Define custom jinja filters used for formatting datetime objects."""
+"""Define custom jinja filters used for formatting datetime objects and images.
 
-def datetimeformat(value, format="%b %-d, %Y at %-I:%M %p"):
-    return value.strftime(format)
+Formatted dates are memoized in a bounded cache: a feed shows the same
+timestamps on every view, and the month dropdown the same months.
+"""
 
-def datecommaformat(value, format="%b %-d, %Y"):
-    return value.strftime(format)
+from functools import lru_cache
 
-def dateformat(value, format="%m-%d-%Y"):
-    return value.strftime(format)
 
-def htmldateformat(value, format="%Y-%m-%dT%H:%M"):
-    return value.strftime(format)
+DATETIME_FORMAT = "%b %-d, %Y at %-I:%M %p"
+DATECOMMA_FORMAT = "%b %-d, %Y"
+DATE_FORMAT = "%m-%d-%Y"
+HTMLDATETIME_FORMAT = "%Y-%m-%dT%H:%M"
+MONTHYEAR_FORMAT = "%B %Y"
+
+DATE_CACHE_SIZE = 8192
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def format_date(value, format):
+    """Return value.strftime(format), remembering recent results."""
 
-def monthyearformat(value, format="%B %Y"):
     return value.strftime(format)
+
+
+def datetimeformat(value, format=DATETIME_FORMAT):
+    return format_date(value, format)
+
+def datecommaformat(value, format=DATECOMMA_FORMAT):
+    return format_date(value, format)
+
+def dateformat(value, format=DATE_FORMAT):
+    return format_date(value, format)
+
+def htmldateformat(value, format=HTMLDATETIME_FORMAT):
+    return format_date(value, format)
+
+def monthyearformat(value, format=MONTHYEAR_FORMAT):
+    return format_date(value, format)
+
+def srcsetformat(variants):
+    return ", ".join(f"{variant.img_path} {variant.width}w"
+                     for variant in variants)
@@ -0,0 +1,353 @@
+"""Bulk import a patient's meal logs and goals from another tool.
+
+Reads the same CSV and NDJSON layouts that exports.py writes: one record per
+row or line, with "record" set to "post" or "goal". Records are read and
+validated a batch at a time, so the file is never held in memory; valid rows
+go in with multi-row INSERTs, and every CHUNK_SIZE rows are committed along
+with the patient's weekly rating rollups. Rows that fail validation are
+counted and reported with their line number rather than stopping the import.
+
+Dietitians can POST a file to /patient/<id>/import, or run this file:
+
+    python3 journal_import.py --patient-id 3 meals.ndjson [--format csv]
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import re
+import time
+import zlib
+from datetime import datetime
+from itertools import islice
+
+from psycopg2.extras import execute_values
+
+from cache import months_cache
+from data_versions import bump_data_version
+from model import connect_to_db, db, Patient
+from rollups import update_weekly_ratings
+
+
+BATCH_SIZE = 1000
+CHUNK_SIZE = 10000
+
+# Rejected rows kept for the report; the rest are only counted.
+MAX_REJECTIONS_REPORTED = 100
+
+IMPORT_FORMATS = {"text/csv": "csv",
+                  "application/x-ndjson": "ndjson"}
+
+POST_COLUMNS = ["patient_id", "time_stamp", "edited", "meal_time",
+                "meal_setting", "TEB", "hunger", "fullness", "satisfaction",
+                "meal_notes", "img_path"]
+GOAL_COLUMNS = ["patient_id", "time_stamp", "edited", "goal_body"]
+
+RATING_FIELDS = ["hunger", "fullness", "satisfaction"]
+MAX_MEAL_SETTING_LENGTH = 200
+
+WHOLE_NUMBER = re.compile(r"-?[0-9]+")
+
+# What reading a file that isn't valid UTF-8 or gzip can raise.
+READ_ERRORS = (UnicodeDecodeError, OSError, EOFError, zlib.error, csv.Error)
+
+
+class ImportReport:
+    """Running totals for one import."""
+
+    def __init__(self):
+        self.posts = 0
+        self.goals = 0
+        self.rejected = 0
+        self.rejections = []
+        self.error = None
+        self.start = time.perf_counter()
+
+    def reject(self, line_number, reason):
+        self.rejected += 1
+
+        if len(self.rejections) < MAX_REJECTIONS_REPORTED:
+            self.rejections.append({"line": line_number, "reason": reason})
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.start
+
+    def to_dict(self):
+        seconds = self.seconds
+        num_rows = self.posts + self.goals + self.rejected
+
+        return {"posts": self.posts,
+                "goals": self.goals,
+                "rejected": self.rejected,
+                "rejections": self.rejections,
+                "error": self.error,
+                "seconds": round(seconds, 3),
+                "rows_per_second": round(num_rows / seconds) if seconds else 0}
+
+
+def read_records(text_file, import_format):
+    """Yield (line number, record) from a CSV or NDJSON file.
+
+    A line of NDJSON that isn't a JSON object is yielded as None.
+    """
+
+    if import_format == "csv":
+        reader = csv.DictReader(text_file)
+
+        for row in reader:
+            yield reader.line_num, row
+
+        return
+
+    for line_number, line in enumerate(text_file, 1):
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+
+        yield line_number, record if isinstance(record, dict) else None
+
+
+def read_until_error(records, report):
+    """Yield records until the file can't be read, noting why on the report.
+
+    The records read before a bad byte are still imported.
+    """
+
+    try:
+        yield from records
+    except READ_ERRORS as error:
+        report.error = f"The file couldn't be read: {error}"
+
+
+def parse_datetime(value, field):
+    """Return a datetime from an ISO 8601 string, or raise ValueError."""
+
+    if not value:
+        raise ValueError(f"{field} is required")
+
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f"{field} isn't an ISO 8601 date and time")
+
+
+def parse_rating(value, field):
+    """Return a 0-10 rating, or None if the value is blank."""
+
+    if value is None or value == "":
+        return None
+
+    # JSON may give an int or a float like 7.0, CSV only strings; true and
+    # 5.7 aren't ratings.
+    if isinstance(value, float) and value.is_integer():
+        rating = int(value)
+    elif isinstance(value, int) and not isinstance(value, bool):
+        rating = value
+    elif isinstance(value, str) and WHOLE_NUMBER.fullmatch(value.strip()):
+        rating = int(value)
+    else:
+        raise ValueError(f"{field} isn't a whole number")
+
+    if not 0 <= rating <= 10:
+        raise ValueError(f"{field} must be between 0 and 10")
+
+    return rating
+
+
+def parse_bool(value):
+    """Return a bool from a JSON bool or a CSV "True"/"False" string."""
+
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "t", "yes", "1")
+
+    return bool(value)
+
+
+def get_text(record, field):
+    """Return a text field, or None if it's missing or blank."""
+
+    value = record.get(field)
+
+    if value is None or value == "":
+        return None
+
+    value = str(value)
+
+    # PostgreSQL text can't hold NUL.
+    if "\x00" in value:
+        raise ValueError(f"{field} contains a NUL character")
+
+    return value
+
+
+def validate_post(patient_id, record):
+    """Return a row of POST_COLUMNS from a record, or raise ValueError."""
+
+    meal_time = parse_datetime(record.get("meal_time"), "meal_time")
+    time_stamp = (parse_datetime(record["time_stamp"], "time_stamp")
+                  if record.get("time_stamp") else meal_time)
+    meal_setting = get_text(record, "meal_setting")
+
+    if meal_setting and len(meal_setting) > MAX_MEAL_SETTING_LENGTH:
+        raise ValueError(f"meal_setting is over {MAX_MEAL_SETTING_LENGTH} "
+                         "characters")
+
+    ratings = [parse_rating(record.get(field), field)
+               for field in RATING_FIELDS]
+
+    return [patient_id, time_stamp, parse_bool(record.get("edited")),
+            meal_time, meal_setting, get_text(record, "TEB"), *ratings,
+            get_text(record, "meal_notes"), get_text(record, "img_path")]
+
+
+def validate_goal(patient_id, record):
+    """Return a row of GOAL_COLUMNS from a record, or raise ValueError."""
+
+    time_stamp = parse_datetime(record.get("time_stamp"), "time_stamp")
+    goal_body = get_text(record, "goal_body")
+
+    if not goal_body:
+        raise ValueError("goal_body is required")
+
+    return [patient_id, time_stamp, parse_bool(record.get("edited")),
+            goal_body]
+
+
+def validate_records(patient_id, records, report):
+    """Yield ("post" or "goal", row) for each valid record; reject the rest."""
+
+    for line_number, record in records:
+        if record is None:
+            report.reject(line_number, "not a JSON object")
+            continue
+
+        record_type = record.get("record") or "post"
+
+        try:
+            if record_type == "post":
+                yield "post", validate_post(patient_id, record)
+            elif record_type == "goal":
+                yield "goal", validate_goal(patient_id, record)
+            else:
+                raise ValueError(f"{record_type} records can't be imported")
+        except ValueError as error:
+            report.reject(line_number, str(error))
+
+
+def insert_rows(table, columns, rows):
+    """Insert rows with multi-row INSERTs in the session's transaction."""
+
+    cursor = db.session.connection().connection.cursor()
+    quoted_columns = ", ".join(f'"{column}"' for column in columns)
+
+    execute_values(cursor, f"INSERT INTO {table} ({quoted_columns}) VALUES %s",
+                   rows, page_size=BATCH_SIZE)
+
+
+def import_chunk(patient, rows, report):
+    """Insert one chunk of validated rows and commit it with its rollups."""
+
+    posts = [row for record_type, row in rows if record_type == "post"]
+    goals = [row for record_type, row in rows if record_type == "goal"]
+
+    for start in range(0, len(posts), BATCH_SIZE):
+        insert_rows("posts", POST_COLUMNS, posts[start:start + BATCH_SIZE])
+
+    for start in range(0, len(goals), BATCH_SIZE):
+        insert_rows("goals", GOAL_COLUMNS, goals[start:start + BATCH_SIZE])
+
+    meal_times = [row[POST_COLUMNS.index("meal_time")] for row in posts]
+    update_weekly_ratings(patient.patient_id, *meal_times)
+    db.session.commit()
+
+    report.posts += len(posts)
+    report.goals += len(goals)
+
+    # The new posts may add months to the feeds' date filters.
+    if posts:
+        months_cache.delete(("patient", patient.patient_id))
+        months_cache.delete(("dietitian", patient.dietitian_id))
+
+    bump_data_version(patient.patient_id)
+
+
+def import_journal(patient_id, binary_file, import_format, gzipped=False,
+                   progress=None):
+    """Import posts and goals for a patient from a CSV or NDJSON file.
+
+    progress, if given, is called with the report after each committed
+    chunk. Returns the ImportReport. If the file turns out not to be UTF-8
+    (or gzip, when gzipped), the rows read before the bad bytes are kept
+    and the report's error says why the import stopped.
+    """
+
+    patient = Patient.query.get(patient_id)
+    report = ImportReport()
+
+    if not patient:
+        raise ValueError(f"There's no patient {patient_id}")
+
+    if gzipped:
+        binary_file = gzip.GzipFile(fileobj=binary_file)
+
+    text_file = io.TextIOWrapper(binary_file, encoding="utf-8-sig",
+                                 newline="")
+    records = read_until_error(read_records(text_file, import_format), report)
+    rows = validate_records(patient_id, records, report)
+
+    while True:
+        chunk = list(islice(rows, CHUNK_SIZE))
+
+        if not chunk:
+            break
+
+        import_chunk(patient, chunk, report)
+
+        if progress:
+            progress(report)
+
+    return report
+
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    parser = argparse.ArgumentParser(
+        description="Import a patient's posts and goals from CSV or NDJSON.")
+    parser.add_argument("--patient-id", type=int, required=True)
+    parser.add_argument("--format", choices=["csv", "ndjson"],
+                        help="defaults to the file's extension")
+    parser.add_argument("path")
+    args = parser.parse_args()
+
+    gzipped = args.path.endswith(".gz")
+    name = args.path[:-3] if gzipped else args.path
+    import_format = args.format or ("csv" if name.endswith(".csv")
+                                    else "ndjson")
+
+    def print_progress(report):
+        print(f"{report.posts} posts, {report.goals} goals, "
+              f"{report.rejected} rejected "
+              f"({report.to_dict()['rows_per_second']} rows/s)")
+
+    with open(args.path, "rb") as import_file:
+        report = import_journal(args.patient_id, import_file, import_format,
+                                gzipped, print_progress)
+
+    for rejection in report.rejections:
+        print(f"line {rejection['line']}: {rejection['reason']}")
+
+    if report.error:
+        print(report.error)
+
+    print(json.dumps({key: value for key, value in report.to_dict().items()
+                      if key != "rejections"}))
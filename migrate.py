@@ -0,0 +1,93 @@
+"""Apply the versioned SQL migrations in migrations/ to the database."""
+
+import os
+
+from sqlalchemy import text
+
+from model import connect_to_db, db
+from server import app
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "migrations")
+
+
+def create_migrations_table(conn):
+    """Create the table that records which migrations have been applied."""
+
+    conn.execute(text("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                             version VARCHAR(255) PRIMARY KEY,
+                             applied_at TIMESTAMP NOT NULL DEFAULT now())"""))
+
+
+def get_applied_versions(conn):
+    """Return a set of the migration versions already applied."""
+
+    rows = conn.execute(text("SELECT version FROM schema_migrations"))
+
+    return {version for version, in rows}
+
+
+def get_migration_files():
+    """Return a list of (version, path) tuples sorted by version."""
+
+    filenames = sorted(filename for filename in os.listdir(MIGRATIONS_DIR)
+                       if filename.endswith(".sql"))
+
+    return [(filename[:-4], os.path.join(MIGRATIONS_DIR, filename))
+            for filename in filenames]
+
+
+def split_statements(sql):
+    """Split the contents of a migration file into single statements."""
+
+    lines = [line for line in sql.splitlines()
+             if not line.strip().startswith("--")]
+    statements = "\n".join(lines).split(";")
+
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def apply_migration(conn, version, path):
+    """Run every statement in a migration file and record the version.
+
+    CREATE INDEX CONCURRENTLY can't run inside a transaction block, so each
+    statement is sent on its own over an autocommit connection. Statements
+    should be idempotent (IF NOT EXISTS) so an interrupted migration can be
+    run again.
+    """
+
+    with open(path) as migration_file:
+        sql = migration_file.read()
+
+    for statement in split_statements(sql):
+        conn.execute(text(statement))
+
+    conn.execute(text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                 version=version)
+
+
+def run_migrations():
+    """Apply any migrations that haven't been applied yet, in order."""
+
+    conn = db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+    try:
+        create_migrations_table(conn)
+        applied = get_applied_versions(conn)
+
+        for version, path in get_migration_files():
+            if version in applied:
+                continue
+
+            print(f"Applying {version}...")
+            apply_migration(conn, version, path)
+
+    finally:
+        conn.close()
+
+
+
+if __name__ == "__main__":
+    connect_to_db(app)
+    run_migrations()
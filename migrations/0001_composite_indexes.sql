@@ -0,0 +1,20 @@
+-- Composite indexes for the feed, chart, goal and comment access paths.
+--
+-- Built CONCURRENTLY so posts can still be written while the indexes build.
+-- If a build is interrupted, Postgres leaves an INVALID index behind; drop it
+-- with DROP INDEX CONCURRENTLY before re-running this migration.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_patients_dietitian_id
+    ON patients (dietitian_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_patient_id_time_stamp
+    ON posts (patient_id, time_stamp);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_patient_id_meal_time
+    ON posts (patient_id, meal_time);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_goals_patient_id_time_stamp
+    ON goals (patient_id, time_stamp);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_comments_post_id
+    ON comments (post_id);
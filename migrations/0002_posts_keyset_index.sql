@@ -0,0 +1,7 @@
+-- Add post_id to the (patient_id, time_stamp) index so keyset pagination on
+-- (time_stamp, post_id) is answered entirely from the index.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_patient_id_time_stamp_post_id
+    ON posts (patient_id, time_stamp, post_id);
+
+DROP INDEX CONCURRENTLY IF EXISTS ix_posts_patient_id_time_stamp;
@@ -0,0 +1,7 @@
+-- Partial index over posts that have at least one rating, used to find the
+-- weeks with ratings data one index probe at a time.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_patient_id_rated_meal_time
+    ON posts (patient_id, meal_time)
+    WHERE hunger IS NOT NULL OR fullness IS NOT NULL
+          OR satisfaction IS NOT NULL;
@@ -0,0 +1,21 @@
+-- Per-patient, per-week rating rollups maintained by rollups.py.
+-- Populate existing data afterwards with: python3 rollups.py
+
+CREATE TABLE IF NOT EXISTS weekly_ratings (
+    patient_id INTEGER NOT NULL REFERENCES patients (patient_id),
+    week_start DATE NOT NULL,
+    post_count INTEGER NOT NULL DEFAULT 0,
+    hunger_count INTEGER NOT NULL DEFAULT 0,
+    hunger_sum INTEGER NOT NULL DEFAULT 0,
+    hunger_min INTEGER,
+    hunger_max INTEGER,
+    fullness_count INTEGER NOT NULL DEFAULT 0,
+    fullness_sum INTEGER NOT NULL DEFAULT 0,
+    fullness_min INTEGER,
+    fullness_max INTEGER,
+    satisfaction_count INTEGER NOT NULL DEFAULT 0,
+    satisfaction_sum INTEGER NOT NULL DEFAULT 0,
+    satisfaction_min INTEGER,
+    satisfaction_max INTEGER,
+    PRIMARY KEY (patient_id, week_start)
+);
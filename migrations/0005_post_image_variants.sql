@@ -0,0 +1,13 @@
+-- Resized copies of post images, generated by images.py.
+-- Create variants for existing posts afterwards with: python3 images.py
+
+CREATE TABLE IF NOT EXISTS post_image_variants (
+    variant_id SERIAL PRIMARY KEY,
+    post_id INTEGER NOT NULL REFERENCES posts (post_id),
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    img_path VARCHAR NOT NULL
+);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_post_image_variants_post_id
+    ON post_image_variants (post_id);
@@ -0,0 +1,18 @@
+-- Content-addressed, reference-counted images shared between posts.
+-- Posts saved before this migration keep a NULL image_sha256 and are never
+-- garbage collected.
+
+CREATE TABLE IF NOT EXISTS stored_images (
+    sha256 VARCHAR(64) PRIMARY KEY,
+    key VARCHAR NOT NULL,
+    img_path VARCHAR NOT NULL,
+    variants JSON NOT NULL,
+    ref_count INTEGER NOT NULL DEFAULT 0
+);
+
+ALTER TABLE posts
+    ADD COLUMN IF NOT EXISTS image_sha256 VARCHAR(64)
+    REFERENCES stored_images (sha256);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_posts_image_sha256
+    ON posts (image_sha256) WHERE image_sha256 IS NOT NULL;
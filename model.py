@@ -1,7 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy import desc
 
+from passwords import hash_password, verify_password
+
 db = SQLAlchemy()
 
 
@@ -21,10 +22,10 @@ class Dietitian(db.Model):
     zipcode = db.Column(db.String(11))
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
 
     def __repr__(self):
 
@@ -35,6 +36,7 @@ class Patient(db.Model):
     """A patient user."""
 
     __tablename__ = "patients"
+    __table_args__ = (db.Index("ix_patients_dietitian_id", "dietitian_id"),)
 
     patient_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     dietitian_id = db.Column(db.Integer, 
@@ -58,10 +60,10 @@ class Patient(db.Model):
     dietitian = db.relationship("Dietitian", backref=db.backref("patients"))
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
     
     def __repr__(self):
 
@@ -72,6 +74,8 @@ class Goal(db.Model):
     """A goal written by a dietitian for a particular patient."""
 
     __tablename__ = "goals"
+    __table_args__ = (db.Index("ix_goals_patient_id_time_stamp",
+                               "patient_id", "time_stamp"),)
 
     goal_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     patient_id = db.Column(db.Integer, 
@@ -92,6 +96,18 @@ class Post(db.Model):
     """A post made by a patient."""
 
     __tablename__ = "posts"
+    __table_args__ = (db.Index("ix_posts_patient_id_time_stamp_post_id",
+                               "patient_id", "time_stamp", "post_id"),
+                      db.Index("ix_posts_patient_id_meal_time",
+                               "patient_id", "meal_time"),
+                      db.Index("ix_posts_patient_id_rated_meal_time",
+                               "patient_id", "meal_time",
+                               postgresql_where=db.text(
+                                   "hunger IS NOT NULL OR fullness IS NOT NULL "
+                                   "OR satisfaction IS NOT NULL")),
+                      db.Index("ix_posts_image_sha256", "image_sha256",
+                               postgresql_where=db.text(
+                                   "image_sha256 IS NOT NULL")))
 
     post_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     patient_id = db.Column(db.Integer, 
@@ -106,6 +122,8 @@ class Post(db.Model):
     fullness = db.Column(db.Integer)
     satisfaction = db.Column(db.Integer)
     meal_notes = db.Column(db.Text)
+    image_sha256 = db.Column(db.String(64), 
+                             db.ForeignKey("stored_images.sha256"))
 
     # Define relationship to patient
     patient = db.relationship("Patient", backref=db.backref("posts"))
@@ -119,6 +137,7 @@ class Comment(db.Model):
     """A dietitian's comment on a patient's post."""
 
     __tablename__ = "comments"
+    __table_args__ = (db.Index("ix_comments_post_id", "post_id"),)
 
     comment_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey("posts.post_id"))
@@ -136,6 +155,73 @@ class Comment(db.Model):
         return f"""<Comment id={self.comment_id}, post={self.post_id}, time={self.time_stamp}>""" # pragma: no cover
 
 
+class StoredImage(db.Model):
+    """An uploaded image in storage, shared by every post with the same bytes."""
+
+    __tablename__ = "stored_images"
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    key = db.Column(db.String, nullable=False)
+    img_path = db.Column(db.String, nullable=False)
+    variants = db.Column(db.JSON, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+
+        return f"""<StoredImage sha256={self.sha256}, refs={self.ref_count}>""" # pragma: no cover
+
+
+class PostImageVariant(db.Model):
+    """A resized copy of a post's image, for serving smaller screens."""
+
+    __tablename__ = "post_image_variants"
+    __table_args__ = (db.Index("ix_post_image_variants_post_id", "post_id"),)
+
+    variant_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.post_id"),
+                        nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    img_path = db.Column(db.String, nullable=False)
+
+    # Define relationship to post
+    post = db.relationship("Post", 
+                           backref=db.backref("image_variants",
+                                              order_by=width))
+
+    def __repr__(self):
+
+        return f"""<PostImageVariant id={self.variant_id}, post={self.post_id}, width={self.width}>""" # pragma: no cover
+
+
+class WeeklyRating(db.Model):
+    """A patient's rating totals for one week, starting on Sunday."""
+
+    __tablename__ = "weekly_ratings"
+
+    patient_id = db.Column(db.Integer, 
+                           db.ForeignKey("patients.patient_id"),
+                           primary_key=True)
+    week_start = db.Column(db.Date, primary_key=True)
+    post_count = db.Column(db.Integer, default=0, nullable=False)
+    hunger_count = db.Column(db.Integer, default=0, nullable=False)
+    hunger_sum = db.Column(db.Integer, default=0, nullable=False)
+    hunger_min = db.Column(db.Integer)
+    hunger_max = db.Column(db.Integer)
+    fullness_count = db.Column(db.Integer, default=0, nullable=False)
+    fullness_sum = db.Column(db.Integer, default=0, nullable=False)
+    fullness_min = db.Column(db.Integer)
+    fullness_max = db.Column(db.Integer)
+    satisfaction_count = db.Column(db.Integer, default=0, nullable=False)
+    satisfaction_sum = db.Column(db.Integer, default=0, nullable=False)
+    satisfaction_min = db.Column(db.Integer)
+    satisfaction_max = db.Column(db.Integer)
+
+    def __repr__(self):
+
+        return f"""<WeeklyRating patient={self.patient_id}, week={self.week_start}>""" # pragma: no cover
+
+
 class UserType(db.Model):
     """Types of users."""
 
@@ -151,10 +237,13 @@ def load_test_data():
     db.create_all()
 
     # Empty out data from previous runs.
+    WeeklyRating.query.delete()
+    PostImageVariant.query.delete()
     Dietitian.query.delete()
     Patient.query.delete()
     Goal.query.delete()
     Post.query.delete()
+    StoredImage.query.delete()
     Comment.query.delete()
 
     # Create sample dietitian.
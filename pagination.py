@@ -0,0 +1,108 @@
+"""Keyset (cursor) pagination for queries shown newest first."""
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+class KeysetPage:
+    """A page of query results with opaque cursors to the adjacent pages."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __repr__(self):
+
+        return f"<KeysetPage items={len(self.items)}>" # pragma: no cover
+
+
+def encode_cursor(direction, time_stamp, row_id):
+    """Return an opaque, URL-safe cursor for a position in a feed."""
+
+    payload = json.dumps([direction, time_stamp.isoformat(), row_id])
+
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return (direction, time_stamp, row_id) from a cursor, or None."""
+
+    try:
+        payload = base64.urlsafe_b64decode(cursor.encode())
+        direction, time_stamp, row_id = json.loads(payload)
+        time_stamp = datetime.fromisoformat(time_stamp)
+        row_id = int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+    if direction not in ("next", "prev"):
+        return None
+
+    return direction, time_stamp, row_id
+
+
+def paginate_by_keyset(query, time_column, id_column, cursor, per_page=10):
+    """Return a KeysetPage of a query ordered by (time_column, id_column) desc.
+
+    Rather than an OFFSET and a COUNT(*), each page seeks straight to the
+    (time_stamp, id) of the row named by the cursor, so every page costs the
+    same as the first one. An invalid or missing cursor returns the first page.
+    """
+
+    position = decode_cursor(cursor) if cursor else None
+    keyset = tuple_(time_column, id_column)
+
+    if position and position[0] == "prev":
+        _, time_stamp, row_id = position
+        rows = (query.filter(keyset > tuple_(time_stamp, row_id))
+                     .order_by(time_column.asc(), id_column.asc())
+                     .limit(per_page + 1)
+                     .all())
+
+        # Everything newer was deleted since the cursor was handed out.
+        if not rows:
+            return paginate_by_keyset(query, time_column, id_column, None,
+                                      per_page)
+
+        items = rows[:per_page][::-1]
+        has_prev = len(rows) > per_page
+        has_next = True
+
+    else:
+        if position:
+            _, time_stamp, row_id = position
+            query = query.filter(keyset < tuple_(time_stamp, row_id))
+
+        rows = (query.order_by(time_column.desc(), id_column.desc())
+                     .limit(per_page + 1)
+                     .all())
+        items = rows[:per_page]
+        has_prev = position is not None
+        has_next = len(rows) > per_page
+
+    if not items:
+        return KeysetPage(items)
+
+    first, last = items[0], items[-1]
+    next_cursor = prev_cursor = None
+
+    if has_next:
+        next_cursor = encode_cursor("next", getattr(last, time_column.key),
+                                    getattr(last, id_column.key))
+    if has_prev:
+        prev_cursor = encode_cursor("prev", getattr(first, time_column.key),
+                                    getattr(first, id_column.key))
+
+    return KeysetPage(items, next_cursor, prev_cursor)
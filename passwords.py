@@ -0,0 +1,88 @@
+"""Password hashing and verification, run in a bounded process pool.
+
+PBKDF2 is tens of milliseconds of pure CPU per call, which would hold the GIL
+and stall every other request in the server process. Handing the work to a
+small pool of worker processes keeps request threads free while a burst of
+logins is checked. If a worker dies, the pool is rebuilt and the check
+retried (see worker_pools.py).
+
+The hash method and pool size are read from the environment (see secrets.sh):
+
+    PASSWORD_HASH_METHOD   Werkzeug method string, e.g. "pbkdf2:sha256:260000"
+    PASSWORD_HASH_WORKERS  worker processes; 0 hashes inline on the caller
+"""
+
+import os
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from worker_pools import WorkerPool
+
+
+DEFAULT_HASH_METHOD = "pbkdf2:sha256:150000"
+
+HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", DEFAULT_HASH_METHOD)
+SALT_LENGTH = 8
+WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+
+pool = WorkerPool(WORKERS)
+
+
+def run_in_pool(function, *args):
+    """Run a hashing function in the worker pool and wait for its result.
+
+    There's no timeout: in a burst of logins a check may queue behind many
+    others, and a worker that dies fails its jobs rather than hanging them.
+    """
+
+    if not WORKERS:
+        return function(*args)
+
+    return pool.run(function, *args)
+
+
+def hash_password(password, method=None):
+    """Return a salted hash of a password using the configured method."""
+
+    return run_in_pool(generate_password_hash, password,
+                       method or HASH_METHOD, SALT_LENGTH)
+
+
+def verify_password(password_hash, password):
+    """Return True if a password matches a stored hash."""
+
+    return run_in_pool(check_password_hash, password_hash, password)
+
+
+def parse_hash_method(method):
+    """Return (algorithm, digest, iterations) from a Werkzeug method string.
+
+    "pbkdf2:sha256:150000" becomes ("pbkdf2", "sha256", 150000); an omitted
+    PBKDF2 iteration count is Werkzeug's default, and plain digests get 0.
+    """
+
+    parts = method.split(":")
+
+    if parts[0] != "pbkdf2":
+        return parts[0], None, 0
+
+    digest = parts[1] if len(parts) > 1 else "sha256"
+    iterations = int(parts[2]) if len(parts) > 2 else 150000
+
+    return "pbkdf2", digest, iterations
+
+
+def needs_rehash(password_hash):
+    """Return True if a stored hash uses weaker settings than configured."""
+
+    stored_method, _, salt_and_hash = password_hash.partition("$")
+    salt = salt_and_hash.partition("$")[0]
+
+    algorithm, digest, iterations = parse_hash_method(stored_method)
+    wanted_algorithm, wanted_digest, wanted_iterations = parse_hash_method(
+        HASH_METHOD)
+
+    return (algorithm != wanted_algorithm or
+            digest != wanted_digest or
+            iterations < wanted_iterations or
+            len(salt) < SALT_LENGTH)
@@ -1,8 +1,18 @@
 from datetime import datetime, date
 from calendar import monthrange
+from sqlalchemy import func
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+from cache import months_cache
+from data_versions import bump_data_version
+from fragments import bump_post_version, note_post_versions
 from helpers import sort_date_asc
-from model import db, Patient, Dietitian, Post
-from users import get_user_type_from_session
+from jinja_filters import srcsetformat
+from model import db, Patient, Post
+from pagination import paginate_by_keyset
+from rollups import update_weekly_ratings
+from stored_images import release_post_image
+from uploads import queue_image_collection
+from users import get_user_type_from_session, get_patient
 
 
 def create_new_post(patient_id, img_path, form_data):
@@ -29,15 +39,21 @@ def create_new_post(patient_id, img_path, form_data):
                     meal_notes=meal_notes)
 
     db.session.add(new_post)
+    db.session.flush()
+    update_weekly_ratings(patient_id, meal_time)
     db.session.commit()
 
-    return "Success"
+    add_post_month_to_cache(new_post)
+    bump_data_version(patient_id)
+
+    return new_post
 
 
 def edit_post(post_id, img_path, form_data):
     """Save an edited post in the database."""
 
     post = Post.query.get(post_id)
+    old_meal_time = post.meal_time
 
     if img_path:
         post.img_path = img_path
@@ -56,8 +72,13 @@ def edit_post(post_id, img_path, form_data):
     post.satisfaction = satisfaction if satisfaction else None
     
     db.session.add(post)
+    db.session.flush()
+    update_weekly_ratings(post.patient_id, old_meal_time, post.meal_time)
     db.session.commit()
 
+    bump_data_version(post.patient_id)
+    bump_post_version(post_id)
+
     return "Success"
 
 
@@ -70,36 +91,60 @@ def delete_post(post_id):
     for comment in comments:
         db.session.delete(comment)
 
+    for variant in post.image_variants:
+        db.session.delete(variant)
+
+    patient = post.patient
+    time_stamp = post.time_stamp
+    unused_image_sha256 = release_post_image(post)
+
     db.session.delete(post)
+    db.session.flush()
+    update_weekly_ratings(patient.patient_id, post.meal_time)
     db.session.commit()
 
+    discard_post_month_from_cache(patient, time_stamp)
+    bump_data_version(patient.patient_id)
+
+    if unused_image_sha256:
+        queue_image_collection(unused_image_sha256)
+
     return "Success"
 
 
-def get_all_patients_posts(dietitian, page, filter_date):
+def get_all_patients_posts(dietitian, cursor, filter_date):
     """Get all of a dietitian's patient's posts."""
 
+    # Load each post's patient from the join, and all of the page's comments
+    # and image variants in one extra query each, so rendering the feed
+    # doesn't query once per post.
     q = (Post.query.filter(Patient.dietitian_id == dietitian.dietitian_id)
             .join(Patient)
-            .join(Dietitian))
+            .options(contains_eager(Post.patient),
+                     selectinload(Post.comments),
+                     selectinload(Post.image_variants)))
 
     if filter_date:
         q = add_filter_date_to_query(q, filter_date)
 
-    posts = q.order_by(Post.time_stamp.desc()).paginate(per_page=10, page=page)
+    note_post_versions()
+    posts = paginate_by_keyset(q, Post.time_stamp, Post.post_id, cursor)
 
     return posts
 
 
-def get_single_patients_posts(patient_id, page, filter_date):
+def get_single_patients_posts(patient_id, cursor, filter_date):
     """Get all of a particular patient's posts."""
 
-    q = Post.query.filter_by(patient_id=patient_id)
+    q = (Post.query.filter_by(patient_id=patient_id)
+            .options(joinedload(Post.patient), selectinload(Post.comments),
+                     selectinload(Post.image_variants)))
 
     if filter_date:
         q = add_filter_date_to_query(q, filter_date)
 
-    posts = q.order_by(Post.time_stamp.desc()).paginate(per_page=10, page=page)
+    note_post_versions()
+    posts = paginate_by_keyset(q, Post.time_stamp, Post.post_id, cursor)
 
     return posts
 
@@ -122,42 +167,99 @@ def add_filter_date_to_query(query, filter_date):
 def get_months_years_posts_for_dietitian(dietitian_id):
     """Return list of months, years where post data exists for a dietitian."""
 
-    post_time_stamps = (db.session.query(Post.time_stamp)
-                       .filter(Patient.dietitian_id == dietitian_id)
-                       .join(Patient).all())
+    key = ("dietitian", dietitian_id)
+    months_years = months_cache.get(key)
 
-    return get_months_years_with_posts(post_time_stamps)
+    if months_years is None:
+        month = func.date_trunc("month", Post.time_stamp)
+        q = (db.session.query(month).select_from(Post).join(Patient)
+                .filter(Patient.dietitian_id == dietitian_id))
+        months_years = query_months_years(q, month)
+        months_cache.set(key, months_years)
+
+    return list(months_years)
 
 
 def get_months_years_of_patient_posts(patient_id):
     """Return a list of months, years where meal posts exist for a patient."""
 
-    post_time_stamps = (db.session.query(Post.time_stamp)
-             .filter(Post.patient_id==patient_id).all())
+    key = ("patient", patient_id)
+    months_years = months_cache.get(key)
+
+    if months_years is None:
+        month = func.date_trunc("month", Post.time_stamp)
+        q = db.session.query(month).filter(Post.patient_id == patient_id)
+        months_years = query_months_years(q, month)
+        months_cache.set(key, months_years)
+
+    return list(months_years)
+
+
+def query_months_years(query, month):
+    """Return the distinct months from a query, newest first."""
+
+    rows = query.distinct().order_by(month.desc()).all()
+
+    return [month_year for month_year, in rows]
+
+
+def get_month_bounds(time_stamp):
+    """Return the first moment of a time_stamp's month and of the next month."""
+
+    start = datetime(time_stamp.year, time_stamp.month, 1)
+
+    if time_stamp.month == 12:
+        end = datetime(time_stamp.year + 1, 1, 1)
+    else:
+        end = datetime(time_stamp.year, time_stamp.month + 1, 1)
+
+    return start, end
+
+
+def add_post_month_to_cache(post):
+    """Add a new post's month to the cached month lists that lack it."""
+
+    month, _ = get_month_bounds(post.time_stamp)
+    patient = get_patient(post.patient_id)
+
+    for key in [("patient", patient.patient_id),
+                ("dietitian", patient.dietitian_id)]:
+        months_years = months_cache.get(key)
+
+        if months_years is not None and month not in months_years:
+            months_years = sorted(months_years + [month], reverse=True)
+            months_cache.set(key, months_years)
 
-    return get_months_years_with_posts(post_time_stamps)
 
+def discard_post_month_from_cache(patient, time_stamp):
+    """Drop a month from the cached month lists once it has no posts left."""
 
-def get_months_years_with_posts(post_time_stamps):
-    """Convert time_stamps to a unique list of months and years."""
+    start, end = get_month_bounds(time_stamp)
+    in_month = (Post.time_stamp >= start) & (Post.time_stamp < end)
 
-    months_years = set()
+    remaining_posts = {
+        ("patient", patient.patient_id):
+            (db.session.query(Post.post_id)
+               .filter(Post.patient_id == patient.patient_id, in_month)),
+        ("dietitian", patient.dietitian_id):
+            (db.session.query(Post.post_id).join(Patient)
+               .filter(Patient.dietitian_id == patient.dietitian_id, in_month))}
 
-    for time_stamp, in post_time_stamps:
-        month_year_str = time_stamp.strftime("%b%Y")
-        month_year_dt = datetime.strptime(month_year_str, "%b%Y")
-        months_years.add(month_year_dt)
+    for key, remaining in remaining_posts.items():
+        months_years = months_cache.get(key)
 
-    months_years = list(months_years)
-    months_years.sort(reverse=True)
+        if months_years is None or start not in months_years:
+            continue
 
-    return months_years
+        if not remaining.first():
+            months_years = [month for month in months_years if month != start]
+            months_cache.set(key, months_years)
 
 
 def save_customized_patient_post_form(patient_id, form_data):
     """Save which form fields the dietitian selected for a specific patient."""
 
-    patient = Patient.query.get(patient_id)
+    patient = get_patient(patient_id)
 
     patient.hunger_visible = bool(form_data.get("hunger-visible"))
     patient.fullness_visible = bool(form_data.get("fullness-visible"))
@@ -215,6 +317,7 @@ def create_post_dict(patient_id, post_obj):
                           "time_stamp": post_obj.time_stamp.isoformat(),
                           "edited": edited,
                           "img_path": post_obj.img_path,
+                          "img_srcset": srcsetformat(post_obj.image_variants),
                           "meal_time": post_obj.meal_time.isoformat(),
                           "meal_setting": post_obj.meal_setting,
                           "TEB": post_obj.TEB,
@@ -238,7 +341,7 @@ def add_comments_to_post_dict(patient_id, comments, post_dict):
     """Add comments to a dictionary containing a post object."""
 
     sorted_comments = sort_date_asc(comments)
-    patient = Patient.query.get(patient_id)
+    patient = get_patient(patient_id)
 
     for comment in sorted_comments:
         if comment.author_type == "diet":
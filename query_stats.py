@@ -0,0 +1,165 @@
+"""Count the SQL statements issued while handling each request.
+
+Along with the number of statements, each request keeps the number of rows
+they returned and the time spent waiting on them, in total and per distinct
+statement. server.py reports these in Server-Timing and X-Query-Count
+headers, and logs requests over budget with their costliest statements.
+The budgets can be set in secrets.sh:
+
+    export SLOW_REQUEST_MS=500
+    export SLOW_REQUEST_QUERIES=50
+"""
+
+import json
+import os
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 500))
+SLOW_REQUEST_QUERIES = int(os.environ.get("SLOW_REQUEST_QUERIES", 50))
+
+# Statements listed in a slow request's log line, and how much of each.
+TOP_STATEMENTS = 5
+MAX_STATEMENT_LENGTH = 300
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """Add one to the current request's query count and start its timer."""
+
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+        conn.info.setdefault("query_start_times", []).append(
+            time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    """Add a statement's duration and returned rows to the request's totals."""
+
+    start_times = conn.info.get("query_start_times")
+
+    if not has_request_context() or not start_times:
+        return
+
+    seconds = time.perf_counter() - start_times.pop()
+
+    # Only statements that return rows count; rowcount is -1 for streamed
+    # results, whose rows aren't known up front.
+    rows = (cursor.rowcount
+            if cursor.description is not None and cursor.rowcount > 0 else 0)
+
+    g.query_seconds = g.get("query_seconds", 0.0) + seconds
+    g.query_rows = g.get("query_rows", 0) + rows
+
+    # Statements differ only by their bound parameters, so repeats of one
+    # query (an N+1 loop, say) add up under one entry.
+    statements = g.setdefault("query_statements", {})
+    totals = statements.setdefault(statement,
+                                   {"count": 0, "seconds": 0.0, "rows": 0})
+    totals["count"] += 1
+    totals["seconds"] += seconds
+    totals["rows"] += rows
+
+
+@event.listens_for(Engine, "handle_error")
+def drop_failed_query_timer(exception_context):
+    """Forget the start time of a statement that raised."""
+
+    connection = exception_context.connection
+
+    if connection is not None and connection.info.get("query_start_times"):
+        connection.info["query_start_times"].pop()
+
+
+def start_request_timer():
+    """Note when the current request started."""
+
+    g.request_start = time.perf_counter()
+
+
+def get_query_count():
+    """Return the number of queries issued so far in this request."""
+
+    return g.get("query_count", 0)
+
+
+def get_query_stats():
+    """Return this request's query count, rows returned and seconds spent."""
+
+    return {"queries": get_query_count(),
+            "rows": g.get("query_rows", 0),
+            "seconds": g.get("query_seconds", 0.0)}
+
+
+def get_request_seconds():
+    """Return the seconds since the current request started."""
+
+    return time.perf_counter() - g.get("request_start", time.perf_counter())
+
+
+def shorten_statement(statement):
+    """Return a statement on one line, cut to MAX_STATEMENT_LENGTH.
+
+    Long column lists fill the start of most ORM statements, so the end,
+    with the FROM and WHERE clauses, is kept too.
+    """
+
+    statement = " ".join(statement.split())
+
+    if len(statement) <= MAX_STATEMENT_LENGTH:
+        return statement
+
+    half = (MAX_STATEMENT_LENGTH - 5) // 2
+
+    return f"{statement[:half]} ... {statement[-half:]}"
+
+
+def get_top_statements(limit=TOP_STATEMENTS):
+    """Return this request's statements that took longest, in total."""
+
+    statements = sorted(g.get("query_statements", {}).items(),
+                        key=lambda item: item[1]["seconds"], reverse=True)
+
+    return [{"statement": shorten_statement(statement),
+             "count": totals["count"],
+             "rows": totals["rows"],
+             "ms": round(totals["seconds"] * 1000, 2)}
+            for statement, totals in statements[:limit]]
+
+
+def get_server_timing(request_seconds):
+    """Return a Server-Timing header value for the SQL and whole request."""
+
+    stats = get_query_stats()
+
+    return (f'db;dur={stats["seconds"] * 1000:.1f};'
+            f'desc="{stats["queries"]} queries, {stats["rows"]} rows", '
+            f'app;dur={request_seconds * 1000:.1f}')
+
+
+def get_slow_request_log(response, request_seconds):
+    """Return a JSON log line if the request was over a budget, else None."""
+
+    stats = get_query_stats()
+    milliseconds = request_seconds * 1000
+
+    if (milliseconds <= SLOW_REQUEST_MS and
+            stats["queries"] <= SLOW_REQUEST_QUERIES):
+        return None
+
+    return json.dumps({"event": "slow_request",
+                       "method": request.method,
+                       "path": request.path,
+                       "route": request.url_rule.rule if request.url_rule
+                                else None,
+                       "status": response.status_code,
+                       "ms": round(milliseconds, 1),
+                       "queries": stats["queries"],
+                       "rows": stats["rows"],
+                       "sql_ms": round(stats["seconds"] * 1000, 1),
+                       "top_statements": get_top_statements()})
@@ -1,70 +1,73 @@
-from datetime import timedelta, date
-from model import db, Post, Patient
+from sqlalchemy import text
+from model import db, Post
 
 
-def query_for_ratings(patient_obj, post_rating, from_date, to_date):
-    """Query the database for ratings made by a patient over a date range."""
+def query_for_all_ratings(patient_id, from_date, to_date):
+    """Query the database for all three ratings made over a date range."""
 
-    dates_ratings_tuples = (db.session.query(Post.meal_time, post_rating)
-                             .filter(Post.patient == patient_obj, 
-                             post_rating != None, 
-                             Post.meal_time.between(from_date, to_date))
-                             .order_by(Post.time_stamp.desc())
-                             .all())
-
-    dates_ratings_dicts = []
-
-    for meal_time, rating in dates_ratings_tuples:
-        dates_ratings_dicts.append({"meal_time": meal_time.isoformat(),
-                                    "rating": rating})
-
-    return dates_ratings_dicts
+    return (db.session.query(Post.meal_time, Post.hunger, Post.fullness, 
+                             Post.satisfaction)
+              .filter(Post.patient_id == patient_id,
+                      ( (Post.hunger != None) | (Post.fullness != None) |
+                        (Post.satisfaction != None) ),
+                      Post.meal_time.between(from_date, to_date))
+              .order_by(Post.time_stamp.desc())
+              .all())
 
 
 def get_ratings_dict(patient_id, from_date_isoformat, from_date, to_date):
     """Get a dictionary of ratings a patient made over a specific date range."""
 
-    patient = Patient.query.get(patient_id)
+    ratings = {"hunger": [], "fullness": [], "satisfaction": []}
 
-    hunger_ratings = query_for_ratings(patient, Post.hunger, from_date, to_date)
-    
-    fullness_ratings = query_for_ratings(patient, Post.fullness, 
-                                         from_date, to_date)
-    
-    satisfaction_ratings = query_for_ratings(patient, Post.satisfaction,
-                                             from_date, to_date)
-
-    return {"data": {"hunger": hunger_ratings,
-                     "fullness": fullness_ratings,
-                     "satisfaction": satisfaction_ratings,
-                     "chart_start_date": from_date_isoformat}}
+    # Split each row into the series it has a rating for.
+    for meal_time, hunger, fullness, satisfaction in query_for_all_ratings(
+            patient_id, from_date, to_date):
+        meal_time_isoformat = meal_time.isoformat()
 
+        for rating_name, rating in [("hunger", hunger),
+                                    ("fullness", fullness),
+                                    ("satisfaction", satisfaction)]:
+            if rating is not None:
+                ratings[rating_name].append({"meal_time": meal_time_isoformat,
+                                             "rating": rating})
 
-def get_sundays_with_data(patient_id):
-    """Get a list of past Sundays where the following week has ratings data."""
-
-    patient = Patient.query.get(patient_id)
+    return {"data": {"hunger": ratings["hunger"],
+                     "fullness": ratings["fullness"],
+                     "satisfaction": ratings["satisfaction"],
+                     "chart_start_date": from_date_isoformat}}
 
-    dates_with_data = (db.session.query(Post.meal_time)
-                         .filter(Post.patient==patient, 
-                          ( (Post.hunger != None) | (Post.fullness !=None) | 
-                            (Post.satisfaction != None) ))).all()
 
-    sundays_with_data = set()
+# Walk backwards one week at a time: each step asks the rated-posts index for
+# the latest meal before the current week, so the cost grows with the number
+# of weeks that have ratings rather than with the number of posts.
+SUNDAYS_WITH_DATA_SQL = text("""
+    WITH RECURSIVE sundays(sunday) AS (
+        SELECT date_trunc('week', max(meal_time) + interval '1 day')
+               - interval '1 day'
+        FROM posts
+        WHERE patient_id = :patient_id
+          AND (hunger IS NOT NULL OR fullness IS NOT NULL
+               OR satisfaction IS NOT NULL)
+      UNION ALL
+        SELECT (SELECT date_trunc('week', max(meal_time) + interval '1 day')
+                       - interval '1 day'
+                FROM posts
+                WHERE patient_id = :patient_id
+                  AND (hunger IS NOT NULL OR fullness IS NOT NULL
+                       OR satisfaction IS NOT NULL)
+                  AND meal_time < sundays.sunday)
+        FROM sundays
+        WHERE sundays.sunday IS NOT NULL
+    )
+    SELECT sunday::date FROM sundays WHERE sunday IS NOT NULL
+    ORDER BY sunday DESC
+""")
 
-    for day, in dates_with_data:
-        
-        # Get the previous Sunday.
-        idx = (day.date().weekday() + 1) % 7
-        previous_sunday = day.date() - timedelta(idx)
-        
-        # If the previous Sunday is not in the set, add it.
-        if previous_sunday not in sundays_with_data:
-            sundays_with_data.add(previous_sunday.isoformat())
 
-    sundays_with_data_list = list(sundays_with_data)
-    sorted_data = sorted(sundays_with_data_list)
-    
-    return sorted_data[::-1]
+def get_sundays_with_data(patient_id):
+    """Get a list of past Sundays where the following week has ratings data."""
 
+    rows = db.session.execute(SUNDAYS_WITH_DATA_SQL, {"patient_id": patient_id})
 
+    return [sunday.isoformat() for sunday, in rows]
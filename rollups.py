@@ -0,0 +1,186 @@
+"""Maintain the weekly_ratings rollup table from patients' posts.
+
+Weeks start on Sunday, matching the ratings chart. Rows are refreshed inside
+the same transaction as the post write that changed them; run this file to
+rebuild the whole table from existing posts.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from model import connect_to_db, db, WeeklyRating
+
+
+RATINGS = ["hunger", "fullness", "satisfaction"]
+
+ROLLUP_COLUMNS = ["post_count"] + [f"{rating}_{stat}" for rating in RATINGS
+                                   for stat in ["count", "sum", "min", "max"]]
+
+ROLLUP_AGGREGATES = ["count(*)"] + [aggregate for rating in RATINGS
+                                    for aggregate in [f"count({rating})",
+                                                      f"coalesce(sum({rating}), 0)",
+                                                      f"min({rating})",
+                                                      f"max({rating})"]]
+
+COLUMNS_SQL = ", ".join(ROLLUP_COLUMNS)
+AGGREGATES_SQL = ", ".join(ROLLUP_AGGREGATES)
+UPSERT_SQL = ", ".join(f"{column} = excluded.{column}" 
+                       for column in ROLLUP_COLUMNS)
+
+REFRESH_WEEK_SQL = text(f"""
+    INSERT INTO weekly_ratings (patient_id, week_start, {COLUMNS_SQL})
+    SELECT :patient_id, :week_start, {AGGREGATES_SQL}
+    FROM posts
+    WHERE patient_id = :patient_id
+      AND meal_time >= :week_start AND meal_time < :week_end
+    HAVING count(*) > 0
+    ON CONFLICT (patient_id, week_start) DO UPDATE
+    SET {UPSERT_SQL}
+""")
+
+DELETE_EMPTY_WEEK_SQL = text("""
+    DELETE FROM weekly_ratings
+    WHERE patient_id = :patient_id AND week_start = :week_start
+      AND NOT EXISTS (SELECT 1 FROM posts
+                      WHERE patient_id = :patient_id
+                        AND meal_time >= :week_start
+                        AND meal_time < :week_end)
+""")
+
+BACKFILL_SQL = text(f"""
+    INSERT INTO weekly_ratings (patient_id, week_start, {COLUMNS_SQL})
+    SELECT patient_id,
+           (date_trunc('week', meal_time + interval '1 day')
+            - interval '1 day')::date,
+           {AGGREGATES_SQL}
+    FROM posts
+    GROUP BY 1, 2
+""")
+
+
+def get_week_start(meal_time):
+    """Return the Sunday on or before a meal time (a datetime or ISO string)."""
+
+    if isinstance(meal_time, str):
+        meal_time = datetime.fromisoformat(meal_time)
+
+    day = meal_time.date()
+
+    return day - timedelta(days=(day.weekday() + 1) % 7)
+
+
+def refresh_weekly_rating(patient_id, week_start):
+    """Recompute one patient's rollup row for one week from their posts.
+
+    Min and max can't be undone when a post is edited or deleted, so the
+    week's row is rebuilt from that week's posts (found with the patient_id,
+    meal_time index). A transaction-scoped advisory lock makes concurrent
+    writers to the same week take turns, so each one sees the other's post.
+    """
+
+    params = {"patient_id": patient_id,
+              "week_start": week_start,
+              "week_end": week_start + timedelta(days=7)}
+
+    db.session.execute(text("SELECT pg_advisory_xact_lock(:patient_id, :week)"),
+                       {"patient_id": patient_id,
+                        "week": week_start.toordinal()})
+    db.session.execute(REFRESH_WEEK_SQL, params)
+    db.session.execute(DELETE_EMPTY_WEEK_SQL, params)
+
+
+def update_weekly_ratings(patient_id, *meal_times):
+    """Refresh the rollup rows for the weeks containing the given meal times.
+
+    Call after the post changes have been flushed and before the commit, so
+    the rollup is written in the same transaction as the posts.
+    """
+
+    week_starts = {get_week_start(meal_time) for meal_time in meal_times
+                   if meal_time}
+
+    # Lock weeks in a consistent order so two writers can't deadlock.
+    for week_start in sorted(week_starts):
+        refresh_weekly_rating(patient_id, week_start)
+
+
+def backfill_weekly_ratings():
+    """Rebuild the whole rollup table from existing posts in one statement."""
+
+    db.session.execute(text("DELETE FROM weekly_ratings"))
+    db.session.execute(BACKFILL_SQL)
+    db.session.commit()
+
+    return WeeklyRating.query.count()
+
+
+def create_weekly_rating_dict(week, previous_week=None):
+    """Return a dictionary summarizing a week of ratings."""
+
+    week_dict = {"week_start": week.week_start.isoformat(),
+                 "post_count": week.post_count}
+
+    for rating in RATINGS:
+        count = getattr(week, f"{rating}_count")
+        average = get_average(week, rating)
+        previous_average = get_average(previous_week, rating)
+
+        change = None
+        if average is not None and previous_average is not None:
+            change = round(average - previous_average, 2)
+
+        week_dict[rating] = {"count": count,
+                             "min": getattr(week, f"{rating}_min"),
+                             "max": getattr(week, f"{rating}_max"),
+                             "average": average,
+                             "change": change}
+
+    return week_dict
+
+
+def get_average(week, rating):
+    """Return a week's average for one rating, or None if it has none."""
+
+    if not week:
+        return None
+
+    count = getattr(week, f"{rating}_count")
+
+    if not count:
+        return None
+
+    return round(getattr(week, f"{rating}_sum") / count, 2)
+
+
+def get_weekly_ratings_summary(patient_id, num_weeks=12):
+    """Get a patient's most recent weekly rating summaries, newest first."""
+
+    # Fetch one extra week so the oldest week shown has a change to report.
+    weeks = (WeeklyRating.query.filter_by(patient_id=patient_id)
+                         .order_by(WeeklyRating.week_start.desc())
+                         .limit(num_weeks + 1)
+                         .all())
+
+    summaries = []
+
+    for i, week in enumerate(weeks[:num_weeks]):
+        previous_week = weeks[i + 1] if i + 1 < len(weeks) else None
+
+        # Only compare against the week directly before this one.
+        if (previous_week and
+            previous_week.week_start != week.week_start - timedelta(days=7)):
+            previous_week = None
+
+        summaries.append(create_weekly_rating_dict(week, previous_week))
+
+    return {"weeks": summaries}
+
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    num_rows = backfill_weekly_ratings()
+    print(f"Rebuilt {num_rows} weekly rating rows.")
@@ -1,5 +1,6 @@
 from model import (connect_to_db, db, Dietitian, Patient,
                    Goal, Post, UserType, Comment)
+from rollups import backfill_weekly_ratings
 from server import app
 
 
@@ -147,6 +148,7 @@ if __name__ == "__main__":
     load_posts(post_filename)
     load_user_types(user_type_filename)
     load_comments(comment_filename)
+    backfill_weekly_ratings()
 
 
 
@@ -2,34 +2,41 @@
 from datetime import datetime, timedelta
 import os
 
-import boto3
 from flask import (Flask, render_template, request, flash, redirect,
-                   session, jsonify, Markup)
-from jinja2 import StrictUndefined
+                   session, jsonify, Markup, Response, stream_with_context)
+from jinja2 import FileSystemBytecodeCache, StrictUndefined
 from sqlalchemy import desc
-from werkzeug.utils import secure_filename
 
 from comments import (add_post_comment, edit_post_comment, delete_comment,
                       create_comment_dict)
 from decorators import (dietitian_auth, dietitians_only, 
                         patient_or_dietitian_auth, patient_belongs_to_dietitian,
-                        patient_auth, dietitian_redirect)
+                        patient_auth, dietitian_redirect, patient_data_etag)
 from goals import (edit_patient_goal, delete_goal, create_goal_dict,
                    add_goal_and_get_dict, get_patients_goals_dict)
 from helpers import sort_date_desc
+from exports import generate_export, EXPORT_MIMETYPES
+from fragments import render_post_card
+from journal_import import import_journal, IMPORT_FORMATS
 from jinja_filters import (datetimeformat, datecommaformat, dateformat,
-                           htmldateformat, monthyearformat)
+                           htmldateformat, monthyearformat, srcsetformat)
 from model import connect_to_db, db, Dietitian, Patient, Goal, Post, Comment
 from posts import (create_new_post, edit_post, delete_post,
                    get_all_patients_posts, save_customized_patient_post_form,
                    get_post_object, create_post_dict, get_single_patients_posts,
                    get_months_years_of_patient_posts, 
                    get_months_years_posts_for_dietitian)
+from query_stats import (start_request_timer, get_query_count,
+                         get_request_seconds, get_server_timing,
+                         get_slow_request_log)
 from ratings import get_ratings_dict, get_sundays_with_data
+from rollups import get_weekly_ratings_summary
+from uploads import spool_image, queue_post_image, requeue_spooled_images
 from users import (create_new_dietitian_account, update_dietitian_account,
                    create_new_patient_account, update_patient_account,
                    reset_password, get_current_dietitian, get_current_patient,
-                   get_user_type_from_session, get_dietitian_and_patients_list)
+                   get_patient, get_user_type_from_session, 
+                   get_dietitian_and_patients_list, check_login_password)
 
 
 
@@ -41,12 +48,40 @@ app.jinja_env.filters["datecomma"] = datecommaformat
 app.jinja_env.filters["date"] = dateformat
 app.jinja_env.filters["htmldatetime"] = htmldateformat
 app.jinja_env.filters["monthyear"] = monthyearformat
+app.jinja_env.filters["srcset"] = srcsetformat
+app.jinja_env.globals["post_card"] = render_post_card
 app.jinja_env.undefined = StrictUndefined
 
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", "template_cache")
+
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024
 
 
+app.before_request(start_request_timer)
+
+
+@app.after_request
+def report_query_stats(response):
+    """Report the request's SQL cost in headers, and log it if over budget."""
+
+    query_count = get_query_count()
+    request_seconds = get_request_seconds()
+
+    response.headers["X-Query-Count"] = str(query_count)
+    response.headers["Server-Timing"] = get_server_timing(request_seconds)
+
+    slow_request_log = get_slow_request_log(response, request_seconds)
+
+    if slow_request_log:
+        app.logger.warning(slow_request_log)
+    elif app.debug:
+        app.logger.debug(f"{request.method} {request.path}: "
+                         f"{query_count} queries")
+
+    return response
+
+
 @app.route("/", methods=["GET"])
 def index():
     """Show homepage and login form."""
@@ -76,7 +111,7 @@ def handle_patient_login():
                   to create or update your account.""")
         return redirect("/")
 
-    if not patient.check_password(password):
+    if not check_login_password(password, patient):
         flash("Incorrect password.")
         return redirect("/")
 
@@ -98,7 +133,7 @@ def handle_dietitian_login():
                   a new dietitian account.""")
         return redirect("/")
 
-    if not dietitian.check_password(password):
+    if not check_login_password(password, dietitian):
         flash("Incorrect password.")
         return redirect("/")
 
@@ -152,12 +187,13 @@ def handle_dietitian_registration():
 def show_dietitian_homepage(dietitian_id):
     """Show a dietitian's homepage."""
 
-    page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor", None)
 
     diet_and_pats = get_dietitian_and_patients_list()
     filter_date = request.args.get("date", None)
     filter_dates = get_months_years_posts_for_dietitian(dietitian_id)
-    posts = get_all_patients_posts(diet_and_pats["dietitian"], page, filter_date)
+    posts = get_all_patients_posts(diet_and_pats["dietitian"], cursor, 
+                                   filter_date)
 
     return render_template("dietitian-home-posts.html",
                             dietitian=diet_and_pats["dietitian"],
@@ -259,7 +295,7 @@ def show_single_patient_overview(patient_id):
     """Show information about a single patient."""
 
     user_type = get_user_type_from_session()
-    patient = Patient.query.get(patient_id)
+    patient = get_patient(patient_id)
 
     if user_type == "dietitian":
         diet_and_pats = get_dietitian_and_patients_list()
@@ -278,7 +314,7 @@ def view_edit_patient_information_form(patient_id):
     """Edit a patient's basic information."""
 
     user_type = get_user_type_from_session()
-    patient = Patient.query.get(patient_id)
+    patient = get_patient(patient_id)
 
     if user_type == "dietitian":
         diet_and_pats = get_dietitian_and_patients_list()
@@ -317,7 +353,7 @@ def reset_patient_password(patient_id):
     """Process reset of a patient's password."""
 
     password = request.form.get("password")
-    patient = Patient.query.get(patient_id)
+    patient = get_patient(patient_id)
     reset = reset_password(password, patient)
 
     flash("Password successfully reset.")
@@ -330,7 +366,7 @@ def customize_patient_post_form(patient_id):
     """Allow dietitian to select form fields available on a patient's post."""
 
     diet_and_pats = get_dietitian_and_patients_list()
-    patient = Patient.query.get(patient_id)
+    patient = get_patient(patient_id)
 
     return render_template("dietitian-customize-post-form.html",
                             dietitian=diet_and_pats["dietitian"],
@@ -356,7 +392,7 @@ def show_patient_goals(patient_id):
     user_type = get_user_type_from_session()
     page = request.args.get("page", 1, type=int)
     goals = get_patients_goals_dict(patient_id, page)
-    patient = Patient.query.get(patient_id)
+    patient = get_patient(patient_id)
 
     if user_type == "dietitian":
         diet_and_pats = get_dietitian_and_patients_list()
@@ -410,11 +446,11 @@ def show_single_patient_posts(patient_id):
     """Show a patient's posts."""
 
     user_type = get_user_type_from_session()
-    page = request.args.get("page", 1, type=int)
+    cursor = request.args.get("cursor", None)
     filter_date = request.args.get("date", None)
     filter_dates = get_months_years_of_patient_posts(patient_id)
-    posts = get_single_patients_posts(patient_id, page, filter_date)
-    patient = Patient.query.get(patient_id)
+    posts = get_single_patients_posts(patient_id, cursor, filter_date)
+    patient = get_patient(patient_id)
 
     if user_type == "dietitian":
         diet_and_pats = get_dietitian_and_patients_list()
@@ -491,14 +527,18 @@ def show_patient_homepage(patient_id):
 def process_new_post_form():
     """Handle adding a new post."""
     
-    img_path = save_image()
+    spool_path = save_image()
     patient_id = session.get("patient_id")
 
-    if img_path == "Bad Extension":
+    if spool_path == "Bad Extension":
         flash("Only .png, .jpg, or .jpeg images are accepted.")
         return redirect(f"/patient/{patient_id}")
 
-    create_new_post(patient_id, img_path, request.form)
+    # The image is uploaded in the background; img_path is set when it's done.
+    post = create_new_post(patient_id, None, request.form)
+
+    if spool_path:
+        queue_post_image(post.post_id, spool_path)
 
     flash(Markup(f"""Post added successfully. 
                      <a href='/patient/{patient_id}/posts'>
@@ -510,15 +550,18 @@ def process_new_post_form():
 def handle_edit_post_form(post_id):
     """Handle edits made to a patient's post."""
 
-    img_path = save_image()
+    spool_path = save_image()
     post = Post.query.get(post_id)
     patient_id = post.patient.patient_id
 
-    if img_path == "Bad Extension":
+    if spool_path == "Bad Extension":
         flash("Only .png, .jpg, or .jpeg images are accepted.")
         return redirect(f"/patient/{patient_id}/posts")
 
-    edit_post(post_id, img_path, request.form)
+    edit_post(post_id, None, request.form)
+
+    if spool_path:
+        queue_post_image(post_id, spool_path)
 
     flash("Post updated successfully.")
     return redirect(f"/patient/{patient_id}/posts")
@@ -540,7 +583,7 @@ def get_ratings_chart_template(patient_id):
     """Shows page containing rating chart div."""
 
     user_type = get_user_type_from_session()
-    patient = Patient.query.get(patient_id)
+    patient = get_patient(patient_id)
 
     if user_type == "dietitian":
         diet_and_pats = get_dietitian_and_patients_list()
@@ -555,6 +598,7 @@ def get_ratings_chart_template(patient_id):
 
 
 @app.route("/patient/<int:patient_id>/recent-ratings.json")
+@patient_data_etag
 def get_patients_recent_ratings(patient_id):
     """Get a patient's hunger/fullness/satisfaction ratings from last 7 days."""
 
@@ -582,6 +626,7 @@ def get_patients_recent_ratings(patient_id):
 
 
 @app.route("/patient/<int:patient_id>/past-ratings.json")
+@patient_data_etag
 def get_patients_past_ratings(patient_id):
     """Get hunger/fullness/satisfaction ratings from a previous week."""
 
@@ -596,6 +641,66 @@ def get_patients_past_ratings(patient_id):
     return jsonify(past_ratings_dict)
 
 
+@app.route("/patient/<int:patient_id>/weekly-ratings.json")
+@patient_or_dietitian_auth
+@patient_data_etag
+def get_patients_weekly_ratings(patient_id):
+    """Get week-over-week hunger/fullness/satisfaction summaries."""
+
+    num_weeks = min(max(request.args.get("weeks", 12, type=int), 1), 104)
+    weekly_ratings_dict = get_weekly_ratings_summary(patient_id, num_weeks)
+
+    return jsonify(weekly_ratings_dict)
+
+
+@app.route("/patient/<int:patient_id>/export.<any(csv, ndjson):export_format>")
+@patient_or_dietitian_auth
+def export_patient_journal(patient_id, export_format):
+    """Stream a patient's posts, comments and goals as a download."""
+
+    gzip = "gzip" in request.accept_encodings
+    chunks = generate_export(patient_id, export_format, gzip)
+    filename = f"nourish-patient-{patient_id}.{export_format}"
+
+    response = Response(stream_with_context(chunks),
+                        mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers["Content-Disposition"] = (f"attachment; "
+                                               f"filename={filename}")
+    # Let nginx pass chunks on as they come rather than buffering them.
+    response.headers["X-Accel-Buffering"] = "no"
+    response.vary.add("Accept-Encoding")
+
+    if gzip:
+        response.headers["Content-Encoding"] = "gzip"
+
+    return response
+
+
+@app.route("/patient/<int:patient_id>/import", methods=["POST"])
+@patient_belongs_to_dietitian
+def import_patient_journal(patient_id):
+    """Import posts and goals from a CSV or NDJSON request body."""
+
+    import_format = IMPORT_FORMATS.get(request.mimetype)
+
+    if not import_format:
+        return jsonify({"error": "Send text/csv or application/x-ndjson."}), 415
+
+    def log_progress(report):
+        app.logger.info(f"Importing for patient {patient_id}: "
+                        f"{report.posts} posts, {report.goals} goals, "
+                        f"{report.rejected} rejected")
+
+    report = import_journal(patient_id, request.stream, import_format,
+                            gzipped=request.content_encoding == "gzip",
+                            progress=log_progress)
+
+    if report.error:
+        return jsonify(report.to_dict()), 400
+
+    return jsonify(report.to_dict())
+
+
 @app.route("/patient/<int:patient_id>/get-post.json")
 def get_post_from_chart(patient_id):
     """Get a post as JSON from clicking on a point on the ratings chart."""
@@ -616,7 +721,7 @@ def allowed_image(filename):
 
 
 def save_image():
-    """Save uploaded image to upload folder and return filepath."""
+    """Spool uploaded image to disk for uploading and return its path."""
 
     if not request.files:
         return None
@@ -630,18 +735,43 @@ def save_image():
     if not allowed_image(file.filename):
         return "Bad Extension"
 
-    if file:
-        filename = secure_filename(file.filename)
-        s3_resource = boto3.resource("s3")
-        my_bucket = s3_resource.Bucket("nourish-post-images")
-        my_bucket.Object(filename).put(Body=file)
-        img_path = f"https://nourish-post-images.s3-us-west-1.amazonaws.com/{filename}"
+    return spool_image(file)
+
+
+
+
+def use_template_cache():
+    """Keep compiled templates in TEMPLATE_CACHE_DIR.
+
+    A restarted server then loads them rather than compiling each one again
+    on its first request. If the directory can't be created or written to,
+    templates are only kept in memory.
+    """
+
+    try:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    except OSError:
+        pass
+
+    if not os.access(TEMPLATE_CACHE_DIR, os.W_OK):
+        app.logger.warning(f"Can't write to {TEMPLATE_CACHE_DIR}; templates "
+                           "won't be cached on disk")
+        return
+
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
 
-    return img_path
+def warm_up_templates():
+    """Load every template now, so no request pays to compile one."""
 
+    for template_name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(template_name)
 
 
 
 if __name__ == "__main__":
     connect_to_db(app)
+    use_template_cache()
+    warm_up_templates()
+    requeue_spooled_images(app)
     app.run(port=5000, host="0.0.0.0")
@@ -79,7 +79,8 @@ const config_chart = (hungerData, fullnessData, satisfactionData) => {
 
 const getModal = (res) => {
     const postTimeStamp = (moment(res.post.time_stamp).format("MMM D, YYYY [at] h:mm A"));
-    const imgPath = (res.post.img_path) ? `<img src="${res.post.img_path}" class="post-image">` : "";
+    const srcset = (res.post.img_srcset) ? ` srcset="${res.post.img_srcset}" sizes="(max-width: 576px) 100vw, 500px"` : "";
+    const imgPath = (res.post.img_path) ? `<img src="${res.post.img_path}"${srcset} class="post-image">` : "";
     const mealTime = (moment(res.post.meal_time).format("MMM D, YYYY [at] h:mm A"));
     const hunger = (res.post.hunger) ? `<p><b>Hunger:</b> ${res.post.hunger}</p>` : "";
     const fullness = (res.post.fullness) ? `<p><b>Fullness:</b> ${res.post.fullness}</p>` : "";
@@ -0,0 +1,242 @@
+"""Object storage for post images.
+
+Two backends share one small interface: S3Storage for S3 and S3-compatible
+services, and FilesystemStorage, which keeps files on local disk so the app
+and its load tests can run offline. Each one records how many bytes it wrote
+and how long the uploads took.
+
+The backend is chosen from the environment (see secrets.sh):
+
+    UPLOAD_BACKEND    "s3" (default) or "filesystem"
+    S3_BUCKET         bucket to store images in
+    S3_PUBLIC_URL     base URL images are served from
+    S3_ENDPOINT_URL   point the S3 client at a local stand-in such as MinIO
+"""
+
+import mimetypes
+import os
+from abc import ABC, abstractmethod
+import shutil
+import time
+from threading import Lock
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+UPLOAD_BACKEND = os.environ.get("UPLOAD_BACKEND", "s3")
+S3_BUCKET = os.environ.get("S3_BUCKET", "nourish-post-images")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+S3_PUBLIC_URL = os.environ.get(
+    "S3_PUBLIC_URL", "https://nourish-post-images.s3-us-west-1.amazonaws.com")
+LOCAL_UPLOAD_DIR = "static/images/uploads"
+LOCAL_URL = "/static/images/uploads"
+
+# Every upload thread can hold a connection, with some to spare.
+MAX_POOL_CONNECTIONS = 10
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+STORAGE_ERRORS = (BotoCoreError, ClientError, OSError)
+
+_storage = None
+_storage_lock = Lock()
+
+
+class StorageStats:
+    """Running totals of the uploads made through a storage backend."""
+
+    def __init__(self):
+        self.uploads = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self._lock = Lock()
+
+    def record(self, num_bytes, seconds):
+        with self._lock:
+            self.uploads += 1
+            self.bytes += num_bytes
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self):
+        with self._lock:
+            average = self.seconds / self.uploads if self.uploads else 0.0
+
+            return {"uploads": self.uploads,
+                    "bytes": self.bytes,
+                    "seconds": round(self.seconds, 4),
+                    "average_seconds": round(average, 4),
+                    "max_seconds": round(self.max_seconds, 4)}
+
+
+class Storage(ABC):
+    """Interface shared by the storage backends.
+
+    Subclasses implement write, download, delete and url; save wraps write
+    to record the upload's size and latency. A backend missing one of them
+    can't be created.
+    """
+
+    def __init__(self):
+        self.stats = StorageStats()
+
+    def save(self, key, fileobj):
+        """Store a binary file object under key and return its URL."""
+
+        num_bytes = get_file_size(fileobj)
+        start = time.perf_counter()
+
+        self.write(key, fileobj)
+
+        self.stats.record(num_bytes, time.perf_counter() - start)
+
+        return self.url(key)
+
+    def save_file(self, key, path):
+        """Store the file at a local path under key and return its URL."""
+
+        with open(path, "rb") as fileobj:
+            return self.save(key, fileobj)
+
+    def get_key(self, url):
+        """Return the key stored at a URL, or None if it isn't ours."""
+
+        prefix = self.url("")
+
+        if not url or not url.startswith(prefix):
+            return None
+
+        return url[len(prefix):]
+
+    @abstractmethod
+    def write(self, key, fileobj):
+        """Store a binary file object under key."""
+
+    @abstractmethod
+    def download(self, key, path):
+        """Copy the file stored under key to a local path."""
+
+    @abstractmethod
+    def delete(self, key):
+        """Delete the file stored under key, if there is one."""
+
+    @abstractmethod
+    def url(self, key):
+        """Return the URL the file stored under key is served from."""
+
+
+class S3Storage(Storage):
+    """Store files in an S3 (or S3-compatible) bucket.
+
+    All uploads share one client, and with it one connection pool. Files
+    over MULTIPART_THRESHOLD are streamed up in parts rather than sent in a
+    single request.
+    """
+
+    def __init__(self, bucket, public_url, endpoint_url=None):
+        super().__init__()
+
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/")
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNK_SIZE,
+            max_concurrency=4)
+
+    def write(self, key, fileobj):
+        content_type = mimetypes.guess_type(key)[0] or "binary/octet-stream"
+
+        self.client.upload_fileobj(fileobj, self.bucket, key,
+                                   ExtraArgs={"ContentType": content_type},
+                                   Config=self.transfer_config)
+
+    def download(self, key, path):
+        self.client.download_file(self.bucket, key, path,
+                                  Config=self.transfer_config)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def url(self, key):
+        return f"{self.public_url}/{key}"
+
+
+class FilesystemStorage(Storage):
+    """Store files in a local directory served at url_prefix."""
+
+    def __init__(self, root, url_prefix):
+        super().__init__()
+
+        self.root = root
+        self.url_prefix = url_prefix.rstrip("/")
+
+    def write(self, key, fileobj):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "wb") as stored_file:
+            shutil.copyfileobj(fileobj, stored_file)
+
+    def download(self, key, path):
+        shutil.copyfile(os.path.join(self.root, key), path)
+
+    def delete(self, key):
+        try:
+            os.remove(os.path.join(self.root, key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key):
+        return f"{self.url_prefix}/{key}"
+
+
+def get_file_size(fileobj):
+    """Return the number of bytes left to read in a seekable file object."""
+
+    position = fileobj.tell()
+    size = fileobj.seek(0, os.SEEK_END) - position
+    fileobj.seek(position)
+
+    return size
+
+
+def create_storage():
+    """Return a new storage backend as configured by the environment."""
+
+    if UPLOAD_BACKEND == "filesystem":
+        return FilesystemStorage(LOCAL_UPLOAD_DIR, LOCAL_URL)
+
+    if S3_ENDPOINT_URL and "S3_PUBLIC_URL" not in os.environ:
+        public_url = f"{S3_ENDPOINT_URL.rstrip('/')}/{S3_BUCKET}"
+    else:
+        public_url = S3_PUBLIC_URL
+
+    return S3Storage(S3_BUCKET, public_url, S3_ENDPOINT_URL)
+
+
+def get_storage():
+    """Return the process-wide storage backend, creating it on first use."""
+
+    global _storage
+
+    with _storage_lock:
+        if _storage is None:
+            _storage = create_storage()
+
+        return _storage
+
+
+def set_storage(storage):
+    """Replace the process-wide storage backend, e.g. in tests."""
+
+    global _storage
+
+    with _storage_lock:
+        _storage = storage
@@ -0,0 +1,183 @@
+"""Content-addressed, reference-counted storage for post images.
+
+Images are keyed by the SHA-256 of their bytes, so a photo uploaded twice
+(or re-sent with an edit) is stored once and shared. Each StoredImage row
+counts the posts using it. When the count drops to zero the row is kept
+until collect_stored_image removes it and its objects from storage, under a
+row lock, so an upload reusing the same bytes at that moment can't be left
+pointing at deleted objects.
+
+Run this file to collect every image no post uses any more.
+"""
+
+import hashlib
+import os
+
+from sqlalchemy.dialects.postgresql import insert
+
+from data_versions import bump_data_version
+from fragments import bump_post_version
+from images import (store_post_image, get_original_key,
+                    replace_post_image_variants)
+from model import connect_to_db, db, Post, StoredImage
+from storage import get_storage, STORAGE_ERRORS
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    """Return the hex SHA-256 of a file, read in chunks."""
+
+    sha256 = hashlib.sha256()
+
+    with open(path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def lock_stored_image(sha256):
+    """Return a StoredImage locked for update, or None if it doesn't exist."""
+
+    return (StoredImage.query.filter_by(sha256=sha256)
+                             .with_for_update()
+                             .populate_existing()
+                             .first())
+
+
+def attach_post_image(post_id, source_path):
+    """Point a post at the stored copy of an image, storing it if it's new.
+
+    Call inside an app context. If identical bytes are already stored, the
+    upload is skipped. Returns the post's new img_path, or None if the post
+    was deleted in the meantime.
+    """
+
+    sha256 = hash_file(source_path)
+
+    while True:
+        stored_image = StoredImage.query.get(sha256)
+
+        # Don't hold a transaction open during the upload.
+        db.session.rollback()
+
+        if not stored_image:
+            key = sha256 + os.path.splitext(source_path)[1].lower()
+            img_path, variants = store_post_image(source_path, key)
+
+            db.session.execute(
+                insert(StoredImage.__table__)
+                .values(sha256=sha256, key=key, img_path=img_path,
+                        variants=variants, ref_count=0)
+                .on_conflict_do_nothing())
+
+        stored_image = lock_stored_image(sha256)
+
+        # Collected between the check and the lock; store it again.
+        if stored_image:
+            break
+
+        db.session.rollback()
+
+    post = Post.query.get(post_id)
+
+    if not post:
+        db.session.commit()
+        collect_stored_image(sha256)
+        return None
+
+    released_sha256 = None
+
+    if post.image_sha256 != sha256:
+        released_sha256 = release_post_image(post)
+        stored_image.ref_count += 1
+
+    post.image_sha256 = sha256
+    post.img_path = stored_image.img_path
+    replace_post_image_variants(post, stored_image.variants)
+    db.session.commit()
+
+    bump_data_version(post.patient_id)
+    bump_post_version(post_id)
+
+    if released_sha256:
+        collect_stored_image(released_sha256)
+
+    return post.img_path
+
+
+def release_post_image(post):
+    """Drop a post's reference to its stored image. The caller commits.
+
+    Returns the image's sha256 if nothing uses it any more, so the caller
+    can collect it after committing.
+    """
+
+    if not post.image_sha256:
+        return None
+
+    stored_image = lock_stored_image(post.image_sha256)
+    post.image_sha256 = None
+
+    if not stored_image:
+        return None
+
+    stored_image.ref_count -= 1
+
+    if stored_image.ref_count > 0:
+        return None
+
+    return stored_image.sha256
+
+
+def collect_stored_image(sha256):
+    """Delete an image from storage and the database if no post uses it."""
+
+    stored_image = lock_stored_image(sha256)
+
+    if not stored_image or stored_image.ref_count > 0:
+        db.session.rollback()
+        return False
+
+    storage = get_storage()
+    keys = [get_original_key(stored_image.key)] + [
+        storage.get_key(variant["img_path"])
+        for variant in stored_image.variants]
+
+    # Deleting while holding the lock means a concurrent upload of the same
+    # bytes waits, then finds the row gone and stores the image afresh.
+    try:
+        for key in keys:
+            if key:
+                storage.delete(key)
+    except STORAGE_ERRORS:
+        # Leave the row for collect_unreferenced_images to retry.
+        db.session.rollback()
+        return False
+
+    db.session.delete(stored_image)
+    db.session.commit()
+
+    return True
+
+
+def collect_unreferenced_images():
+    """Collect every stored image with no posts; return how many were."""
+
+    unreferenced = (db.session.query(StoredImage.sha256)
+                              .filter(StoredImage.ref_count <= 0)
+                              .all())
+    db.session.rollback()
+
+    return sum(collect_stored_image(sha256) for sha256, in unreferenced)
+
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    num_collected = collect_unreferenced_images()
+    print(f"Deleted {num_collected} unused images.")
@@ -0,0 +1,366 @@
+"""Generate a large, realistic dataset for load and scaling tests.
+
+Builds dietitians, patients, posts, comments and goals on the model.py
+schema and streams them into an empty database with COPY, using the
+bulk_seed.py helpers. Texts and image URLs are drawn from the files in
+seed_data/, and the shape of the data follows real use:
+
+- a few dietitians have many patients and a few patients post a lot
+  (Pareto-weighted shares)
+- patients join at different times and log more often the longer
+  they've stayed, so recent months are busier than old ones
+- meals cluster around breakfast, lunch, dinner and snacks, and are
+  usually logged shortly after eating
+- ratings are only recorded for the scales a patient's dietitian enabled,
+  and hunger runs low while fullness and satisfaction run high
+- most posts have no comments; the rest get a reply or a short thread
+
+The output depends only on the options, so a seed and end date reproduce
+the same dataset; the end date defaults to a fixed day, not today. Every
+user's password is "password", under one shared hash whose salt is the only
+thing that differs between runs.
+
+    python3 synthetic_data.py --dietitians 500 --patients 50000 \\
+        --posts 20000000 --seed 1 --end-date 2020-03-01
+"""
+
+import argparse
+import os
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from bulk_seed import copy_rows, read_batches, reset_sequence
+from model import connect_to_db, db
+from passwords import hash_password
+from rollups import backfill_weekly_ratings
+
+
+BATCH_SIZE = 50000
+
+FIRST_NAMES = ["Alex", "Ana", "Ben", "Carmen", "Dana", "Eli", "Fatima",
+               "Grace", "Hiro", "Imani", "Jon", "Kai", "Lena", "Maya", "Noah",
+               "Omar", "Priya", "Quinn", "Rosa", "Sam", "Tara", "Uma",
+               "Victor", "Wen", "Yusuf", "Zoe"]
+LAST_NAMES = ["Adams", "Baker", "Chen", "Diaz", "Evans", "Fischer", "Garcia",
+              "Huang", "Ibrahim", "Jones", "Kim", "Lopez", "Martin", "Nguyen",
+              "Okafor", "Patel", "Rossi", "Smith", "Tanaka", "Wright"]
+CITIES = [("San Francisco", "CA", "94110"), ("Oakland", "CA", "94612"),
+          ("Portland", "OR", "97205"), ("Seattle", "WA", "98101"),
+          ("Austin", "TX", "78701"), ("Denver", "CO", "80202"),
+          ("Chicago", "IL", "60601"), ("Boston", "MA", "02108")]
+
+# (hour of the meal, share of posts).
+MEAL_HOURS = [(8, 0.27), (12.5, 0.3), (15.5, 0.1), (19, 0.28), (21.5, 0.05)]
+
+# Mean and standard deviation of each rating, on the 0-10 scale.
+RATING_SHAPES = {"hunger": (3.5, 2.0),
+                 "fullness": (6.5, 1.8),
+                 "satisfaction": (6.8, 2.0)}
+RATING_VISIBLE_SHARE = 0.7
+RATING_RECORDED_SHARE = 0.85
+IMAGE_SHARE = 0.35
+NOTES_SHARE = 0.2
+
+# Number of comments on a post, and how often each occurs.
+COMMENT_COUNTS = [0, 1, 2, 3, 4]
+COMMENT_WEIGHTS = [0.55, 0.3, 0.1, 0.04, 0.01]
+
+GOAL_DAYS = 10
+
+# The default last day with posts. It's fixed, so the same options always
+# produce the same data.
+END_DATE = date(2020, 3, 1)
+
+TABLE_ORDER = ["dietitians", "patients", "posts", "comments", "goals"]
+
+DIETITIAN_COLUMNS = ["dietitian_id", "fname", "lname", "email",
+                     "password_hash", "street_address", "city", "state",
+                     "zipcode"]
+PATIENT_COLUMNS = ["patient_id", "dietitian_id", "fname", "lname", "email",
+                   "password_hash", "street_address", "city", "state",
+                   "zipcode", "phone", "birthdate", "hunger_visible",
+                   "fullness_visible", "satisfaction_visible"]
+POST_COLUMNS = ["post_id", "patient_id", "time_stamp", "edited", "meal_time",
+                "img_path", "meal_setting", "TEB", "hunger", "fullness",
+                "satisfaction", "meal_notes"]
+COMMENT_COLUMNS = ["comment_id", "post_id", "author_id", "author_type",
+                   "time_stamp", "edited", "comment_body"]
+GOAL_COLUMNS = ["goal_id", "patient_id", "time_stamp", "edited", "goal_body"]
+
+
+def load_texts(data_dir):
+    """Return lists of sample texts and image URLs from the seed files."""
+
+    def column(filename, index):
+        path = os.path.join(data_dir, filename)
+        values = {row[index] for batch in read_batches(path, BATCH_SIZE)
+                  for row in batch if row[index]}
+        return sorted(values)
+
+    return {"meal_setting": column("u.post", 4),
+            "TEB": column("u.post", 5),
+            "img_path": column("u.post", 3),
+            "comment_body": column("u.comment", 4),
+            "goal_body": column("u.goal", 2)}
+
+
+def get_shares(rng, count, alpha):
+    """Return count Pareto-distributed weights that sum to 1."""
+
+    weights = [rng.paretovariate(alpha) for _ in range(count)]
+    total = sum(weights)
+
+    return [weight / total for weight in weights]
+
+
+def split_total(total, shares):
+    """Split total into whole numbers in proportion to shares."""
+
+    counts = [int(total * share) for share in shares]
+
+    # Hand the remainder to the largest shares.
+    by_share = sorted(range(len(shares)), key=shares.__getitem__, reverse=True)
+    for index in by_share[:total - sum(counts)]:
+        counts[index] += 1
+
+    return counts
+
+
+class RowWriter:
+    """Buffer rows per table and COPY them in batches.
+
+    Tables are copied in TABLE_ORDER, so rows are always copied after the
+    rows they reference. Each table's first column is its id, whose
+    sequence is moved past the copied rows at the end.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.columns = {}
+        self.rows = {}
+        self.counts = {}
+
+    def add(self, table, columns, row):
+        self.columns[table] = columns
+        rows = self.rows.setdefault(table, [])
+        rows.append(row)
+
+        if len(rows) >= BATCH_SIZE:
+            self.flush(table)
+
+    def flush(self, table):
+        """Copy a table's buffered rows, and first those of its parents."""
+
+        for flushed_table in TABLE_ORDER[:TABLE_ORDER.index(table) + 1]:
+            rows = self.rows.get(flushed_table)
+
+            if rows:
+                copy_rows(self.cursor, flushed_table,
+                          self.columns[flushed_table], rows)
+                self.counts[flushed_table] = (self.counts.get(flushed_table, 0)
+                                              + len(rows))
+                rows.clear()
+
+    def finish(self):
+        """Copy what's left, move the id sequences on, and commit."""
+
+        self.flush(TABLE_ORDER[-1])
+
+        for table in TABLE_ORDER:
+            if table in self.columns:
+                reset_sequence(self.cursor, table, self.columns[table][0])
+
+        self.conn.commit()
+
+
+def format_time(value):
+    return value.isoformat(sep=" ", timespec="seconds")
+
+
+def make_person(rng, kind, number, password_hash):
+    """Return the name, email and address columns shared by both users."""
+
+    fname = rng.choice(FIRST_NAMES)
+    lname = rng.choice(LAST_NAMES)
+    city, state, zipcode = rng.choice(CITIES)
+
+    return [fname, lname, f"{kind}{number}@example.com", password_hash,
+            f"{rng.randint(1, 9999)} Main St.", city, state, zipcode]
+
+
+def make_rating(rng, rating):
+    mean, deviation = RATING_SHAPES[rating]
+
+    return min(10, max(0, round(rng.gauss(mean, deviation))))
+
+
+def make_meal_time(rng, day):
+    hour = rng.choices([hour for hour, _ in MEAL_HOURS],
+                       [share for _, share in MEAL_HOURS])[0]
+    minutes = int(hour * 60 + rng.gauss(0, 40))
+
+    return (datetime.combine(day, datetime.min.time()) +
+            timedelta(minutes=min(max(minutes, 0), 24 * 60 - 1)))
+
+
+def get_post_days(rng, num_posts, start, end):
+    """Return the days of a patient's posts, busier toward the end."""
+
+    span = max((end - start).days, 1)
+
+    # The square root of a uniform draw leans toward 1, so later days are
+    # likelier than early ones.
+    return sorted(start + timedelta(days=int(span * rng.random() ** 0.5))
+                  for _ in range(num_posts))
+
+
+def write_patient(writer, rng, texts, ids, patient_id, dietitian_id,
+                  num_posts, start, end, password_hash):
+    """Write one patient with their posts, comments and goals."""
+
+    visible = {rating: rng.random() < RATING_VISIBLE_SHARE
+               for rating in RATING_SHAPES}
+    birthdate = date(rng.randint(1950, 2004), rng.randint(1, 12),
+                     rng.randint(1, 28))
+
+    writer.add("patients", PATIENT_COLUMNS,
+               [patient_id, dietitian_id] +
+               make_person(rng, "patient", patient_id, password_hash) +
+               [f"555{rng.randint(1000000, 9999999)}", birthdate,
+                visible["hunger"], visible["fullness"],
+                visible["satisfaction"]])
+
+    for day in get_post_days(rng, num_posts, start, end):
+        ids["posts"] += 1
+        meal_time = make_meal_time(rng, day)
+        time_stamp = meal_time + timedelta(
+            minutes=int(rng.expovariate(1 / 45)))
+        ratings = [make_rating(rng, rating)
+                   if visible[rating] and rng.random() < RATING_RECORDED_SHARE
+                   else None
+                   for rating in RATING_SHAPES]
+
+        writer.add("posts", POST_COLUMNS,
+                   [ids["posts"], patient_id, format_time(time_stamp), False,
+                    format_time(meal_time),
+                    rng.choice(texts["img_path"])
+                    if rng.random() < IMAGE_SHARE else None,
+                    rng.choice(texts["meal_setting"]),
+                    rng.choice(texts["TEB"]), *ratings,
+                    rng.choice(texts["TEB"])
+                    if rng.random() < NOTES_SHARE else None])
+
+        comment_time = time_stamp
+        for number in range(rng.choices(COMMENT_COUNTS, COMMENT_WEIGHTS)[0]):
+            ids["comments"] += 1
+            comment_time += timedelta(minutes=int(rng.expovariate(1 / 300)))
+            from_dietitian = number % 2 == 0
+
+            writer.add("comments", COMMENT_COLUMNS,
+                       [ids["comments"], ids["posts"],
+                        dietitian_id if from_dietitian else patient_id,
+                        "diet" if from_dietitian else "pat",
+                        format_time(comment_time), False,
+                        rng.choice(texts["comment_body"])])
+
+    goal_day = start
+    while goal_day < end:
+        ids["goals"] += 1
+        goal_time = make_meal_time(rng, goal_day)
+
+        writer.add("goals", GOAL_COLUMNS,
+                   [ids["goals"], patient_id, format_time(goal_time), False,
+                    rng.choice(texts["goal_body"])])
+
+        goal_day += timedelta(days=rng.randint(GOAL_DAYS // 2, GOAL_DAYS * 2))
+
+
+def generate(conn, seed, num_dietitians, num_patients, num_posts, years,
+             end, data_dir):
+    """Write the whole dataset and return the number of rows per table."""
+
+    rng = random.Random(seed)
+    texts = load_texts(data_dir)
+    password_hash = hash_password("password")
+    writer = RowWriter(conn)
+    writer.cursor.execute("SELECT EXISTS (SELECT 1 FROM patients)")
+
+    if writer.cursor.fetchone()[0]:
+        raise SystemExit("The database already has patients; "
+                         "synthetic_data.py needs empty tables.")
+
+    copy_rows(writer.cursor, "user_types", ["type_code", "user_type_name"],
+              [["diet", "dietitian"], ["pat", "patient"]])
+
+    for dietitian_id in range(1, num_dietitians + 1):
+        writer.add("dietitians", DIETITIAN_COLUMNS,
+                   [dietitian_id] + make_person(rng, "dietitian",
+                                                dietitian_id, password_hash))
+
+    dietitian_shares = get_shares(rng, num_dietitians, 1.5)
+    dietitian_ids = rng.choices(range(1, num_dietitians + 1),
+                                dietitian_shares, k=num_patients)
+    post_counts = split_total(num_posts, get_shares(rng, num_patients, 2.0))
+    first_day = end - timedelta(days=int(365 * years))
+    ids = {"posts": 0, "comments": 0, "goals": 0}
+
+    for patient_id, (dietitian_id, patient_posts) in enumerate(
+            zip(dietitian_ids, post_counts), 1):
+        # Each patient gets their own generator, so one patient's data
+        # doesn't depend on how many rows came before it.
+        patient_rng = random.Random(f"{seed}-{patient_id}")
+        start = first_day + timedelta(
+            days=int((end - first_day).days * patient_rng.random()))
+
+        write_patient(writer, patient_rng, texts, ids, patient_id,
+                      dietitian_id, patient_posts, start, end, password_hash)
+
+    writer.finish()
+
+    return writer.counts
+
+
+
+if __name__ == "__main__":
+    from server import app
+
+    parser = argparse.ArgumentParser(
+        description="Generate a large synthetic dataset in an empty database.")
+    parser.add_argument("--db-uri", default="postgresql:///nourish")
+    parser.add_argument("--dietitians", type=int, default=20)
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--posts", type=int, default=200000)
+    parser.add_argument("--years", type=float, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--end-date", type=date.fromisoformat,
+                        default=END_DATE,
+                        help=f"last day with posts (default {END_DATE})")
+    parser.add_argument("--data-dir", default="seed_data")
+    args = parser.parse_args()
+
+    connect_to_db(app, db_uri=args.db_uri)
+    db.create_all()
+
+    conn = db.engine.raw_connection()
+    start = time.perf_counter()
+
+    try:
+        counts = generate(conn, args.seed, args.dietitians, args.patients,
+                          args.posts, args.years, args.end_date,
+                          args.data_dir)
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - start
+    num_rows = sum(counts.values())
+
+    for table, num_table_rows in counts.items():
+        print(f"{table}: {num_table_rows} rows")
+    print(f"{num_rows} rows in {elapsed:.1f}s ({num_rows / elapsed:.0f} rows/s)")
+
+    start = time.perf_counter()
+    num_weeks = backfill_weekly_ratings()
+    print(f"weekly_ratings: {num_weeks} rows in "
+          f"{time.perf_counter() - start:.2f}s")
@@ -1,19 +1,104 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import signal
+import tempfile
+import time
 import unittest
+from datetime import datetime
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from PIL import Image
 from server import app
+import server
 
+from cache import clear_all_caches, LRUCache
 from comments import (edit_post_comment, delete_comment,
                       create_comment_dict)
-from model import (db, Dietitian, Patient, Comment, Goal, Post, connect_to_db,
+from model import (db, Dietitian, Patient, Comment, Goal, Post,
+                   PostImageVariant, StoredImage, WeeklyRating, connect_to_db,
                    load_test_data)
 from users import (create_new_dietitian_account, update_dietitian_account,
                    create_new_patient_account, update_patient_account,
                    reset_password)
+from passwords import hash_password, needs_rehash
+import passwords
+from query_stats import get_query_stats
+import query_stats
+from fragments import post_cards
+from jinja_filters import format_date, datetimeformat
+import images
+from images import (backfill_image_variants, encode_image,
+                    encode_image_variants)
 from goals import (create_new_goal, edit_patient_goal, delete_goal,
                    create_goal_dict, add_goal_and_get_dict)
 from posts import (create_new_post, edit_post, delete_post,
                    get_all_patients_posts, save_customized_patient_post_form,
-                   get_rating_label_to_search, get_post_object)
-from ratings import query_for_ratings, get_ratings_dict, get_sundays_with_data
+                   get_rating_label_to_search, get_post_object,
+                   get_single_patients_posts, get_months_years_of_patient_posts,
+                   get_months_years_posts_for_dietitian)
+from ratings import (query_for_all_ratings, get_ratings_dict,
+                     get_sundays_with_data)
+from rollups import backfill_weekly_ratings, get_weekly_ratings_summary
+from storage import FilesystemStorage, Storage, get_storage, set_storage
+from synthetic_data import generate, TABLE_ORDER, END_DATE
+import uploads
+
+
+def capture_queries(fn):
+    """Return the SQL statements executed while calling fn."""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    # Listen on every engine, since the session may still be bound to the
+    # engine from an earlier connect_to_db call.
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+
+    try:
+        fn()
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+
+    return statements
+
+
+def count_queries(fn):
+    """Return the number of SQL statements executed while calling fn."""
+
+    return len(capture_queries(fn))
+
+
+def kill_pool_worker(worker_pool):
+    """Kill one of a WorkerPool's processes and wait until the pool breaks.
+
+    Returns the broken executor.
+    """
+
+    executor = worker_pool.get_executor()
+    os.kill(next(iter(executor._processes)), signal.SIGKILL)
+
+    deadline = time.monotonic() + 10
+    while not executor._broken and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    return executor
+
+
+def create_test_image(width, height, image_format="JPEG"):
+    """Return the bytes of a solid-color image of the given size."""
+
+    image_file = io.BytesIO()
+    Image.new("RGB", (width, height), "orange").save(image_file, image_format)
+
+    return image_file.getvalue()
+
 
 class BasicTests(unittest.TestCase):
     """Test routes that don't require access to the database or session."""
@@ -40,6 +125,74 @@ class BasicTests(unittest.TestCase):
         self.assertIn(b"Dietitian Registration", result.data)
 
 
+    def test_memoizing_date_filters(self):
+        """Test that the date filters format each date once."""
+
+        format_date.cache_clear()
+        time_stamps = [datetime(2020, 2, day, 9, 5) for day in range(1, 8)]
+
+        for time_stamp in time_stamps + time_stamps:
+            datetimeformat(time_stamp)
+
+        self.assertEqual(format_date.cache_info().currsize, 7)
+        self.assertEqual(format_date.cache_info().hits, 7)
+        self.assertEqual(datetimeformat(time_stamps[0]),
+                         "Feb 1, 2020 at 9:05 AM")
+
+
+    def test_lru_cache_evicts_by_size(self):
+        """Test that the least recently used entries are evicted to fit."""
+
+        cache = LRUCache(10)
+        cache.set("a", "1234")
+        cache.set("b", "1234")
+        cache.get("a")
+        cache.set("c", "1234")
+
+        self.assertEqual(cache.get("a"), "1234")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.size, 8)
+
+        cache.set("d", "x" * 11)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.size, 8)
+
+
+    def test_template_cache_skipped_when_unwritable(self):
+        """Test that templates are compiled in memory if the cache dir fails."""
+
+        cache_parent = tempfile.mkdtemp()
+        not_a_dir = os.path.join(cache_parent, "file")
+        open(not_a_dir, "w").close()
+
+        try:
+            server.TEMPLATE_CACHE_DIR = os.path.join(not_a_dir, "cache")
+            with self.assertLogs(app.logger, "WARNING"):
+                server.use_template_cache()
+            self.assertIsNone(app.jinja_env.bytecode_cache)
+
+            server.TEMPLATE_CACHE_DIR = os.path.join(cache_parent, "cache")
+            server.use_template_cache()
+            self.assertTrue(os.path.isdir(server.TEMPLATE_CACHE_DIR))
+            self.assertIsNotNone(app.jinja_env.bytecode_cache)
+
+        finally:
+            app.jinja_env.bytecode_cache = None
+            server.TEMPLATE_CACHE_DIR = "template_cache"
+            shutil.rmtree(cache_parent)
+
+
+    def test_incomplete_storage_backend(self):
+        """Test that a backend missing a method can't be created."""
+
+        class WriteOnlyStorage(Storage):
+            def write(self, key, fileobj):
+                pass
+
+        with self.assertRaises(TypeError):
+            WriteOnlyStorage()
+
+
 
 class DietitianSessionTests(unittest.TestCase):
     """Test routes that require a logged-in dietitian."""
@@ -83,6 +236,7 @@ class DatabaseTests(unittest.TestCase):
         # Create the tables and add the sample data.
         db.create_all()
         load_test_data()
+        clear_all_caches()
         
 
     def tearDown(self):
@@ -114,6 +268,36 @@ class DatabaseTests(unittest.TestCase):
         self.assertIn(b"No account with", result.data)
 
 
+    def test_synthetic_data_is_deterministic(self):
+        """Test that the same seed and end date generate the same rows."""
+
+        def generate_rows():
+            db.session.close()
+            db.drop_all()
+            db.create_all()
+
+            conn = db.engine.raw_connection()
+            try:
+                generate(conn, 7, 2, 10, 300, 1, END_DATE, "seed_data")
+            finally:
+                conn.close()
+
+            # The shared password hash has a random salt.
+            return {table: [row for row in db.session.execute(
+                                f"SELECT * FROM {table} ORDER BY 1")]
+                    for table in TABLE_ORDER}
+
+        first_rows = generate_rows()
+        second_rows = generate_rows()
+
+        for table in ["dietitians", "patients"]:
+            for rows in [first_rows[table], second_rows[table]]:
+                rows[:] = [{**row, "password_hash": None} for row in rows]
+
+        self.assertEqual(len(first_rows["posts"]), 300)
+        self.assertEqual(first_rows, second_rows)
+
+
     def test_patient_login(self):
         """Make sure login works for a patient."""
 
@@ -136,6 +320,38 @@ class DatabaseTests(unittest.TestCase):
         self.assertIn(b"No account with", result.data)
 
 
+    def test_login_after_password_worker_dies(self):
+        """Make sure logins still work after a hashing worker is killed."""
+
+        passwords.verify_password(hash_password("password"), "password")
+        executor = kill_pool_worker(passwords.pool)
+
+        data = {"email": "jsmith@gmail.com", "password": "password"}
+        result = self.client.post("/patient-login", data=data,
+                                  follow_redirects=True)
+        self.assertIn(b"Patient Dashboard", result.data)
+        self.assertIsNot(passwords.pool.get_executor(), executor)
+
+
+    def test_login_upgrades_weak_password_hash(self):
+        """Make sure an outdated password hash is replaced at login."""
+
+        patient = Patient.query.get(1)
+        patient.password_hash = hash_password("password", "pbkdf2:sha256:1000")
+        db.session.commit()
+        self.assertTrue(needs_rehash(patient.password_hash))
+
+        data = {"email": "jsmith@gmail.com", "password": "pass"}
+        self.client.post("/patient-login", data=data)
+        self.assertIn("pbkdf2:sha256:1000$", Patient.query.get(1).password_hash)
+
+        data = {"email": "jsmith@gmail.com", "password": "password"}
+        self.client.post("/patient-login", data=data)
+        patient = Patient.query.get(1)
+        self.assertFalse(needs_rehash(patient.password_hash))
+        self.assertTrue(patient.check_password("password"))
+
+
     def test_dietitian_registration(self):
         """Test that registration route works correctly with POST method."""
 
@@ -170,11 +386,54 @@ class DatabaseTests(unittest.TestCase):
         """Test that route returns correct JSON."""
 
         result = self.client.get("/patient/1/past-ratings.json?chart-date=2020-02-20")
-        
+
         self.assertEqual(result.status_code, 200)
         self.assertIn(b"fullness", result.data)
 
 
+    def test_ratings_conditional_get(self):
+        """Test that unchanged ratings are answered with 304 and no queries."""
+
+        url = "/patient/1/past-ratings.json?chart-date=2020-02-16"
+        result = self.client.get(url)
+        etag = result.headers["ETag"]
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("no-cache", result.headers["Cache-Control"])
+
+        headers = {"If-None-Match": etag}
+        results = []
+        query_count = count_queries(
+            lambda: results.append(self.client.get(url, headers=headers)))
+        self.assertEqual(results[0].status_code, 304)
+        self.assertEqual(results[0].headers["ETag"], etag)
+        self.assertEqual(query_count, 0)
+
+        # Another week of the same patient's data has its own ETag.
+        other_week = self.client.get("/patient/1/past-ratings.json"
+                                     "?chart-date=2020-02-23")
+        self.assertNotEqual(other_week.headers["ETag"], etag)
+
+        form_data = {"meal-time": "2020-02-18 08:00:00", "hunger": 4}
+        create_new_post(1, None, form_data)
+
+        result = self.client.get(url, headers=headers)
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers["ETag"], etag)
+        self.assertIn(b"2020-02-18T08:00:00", result.data)
+
+
+    def test_getting_patients_weekly_ratings(self):
+        """Test that route returns weekly summaries as JSON."""
+
+        with self.client.session_transaction() as sess:
+            sess["dietitian_id"] = 1
+        backfill_weekly_ratings()
+
+        result = self.client.get("/patient/1/weekly-ratings.json")
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json["weeks"][0]["fullness"]["max"], 8)
+
+
     def test_getting_post_from_chart(self):
         """Test that route returns correct JSON."""
 
@@ -333,16 +592,155 @@ class DatabaseTests(unittest.TestCase):
         self.assertEqual(post, None)
 
 
+    def test_backfilling_image_variants(self):
+        """Test creating resized variants for existing post images."""
+
+        upload_dir = tempfile.mkdtemp()
+        set_storage(FilesystemStorage(upload_dir, "/static/images/uploads"))
+
+        # Post 1's image is in storage; post 2's image is missing.
+        with open(os.path.join(upload_dir, "4.jpg"), "wb") as image:
+            image.write(create_test_image(1000, 500))
+
+        try:
+            self.assertEqual(backfill_image_variants(), (1, 1))
+
+            post = Post.query.get(1)
+            self.assertEqual([(variant.width, variant.height)
+                              for variant in post.image_variants],
+                             [(320, 160), (640, 320), (1000, 500)])
+            self.assertEqual(post.image_variants[1].img_path,
+                             "/static/images/uploads/4-640w.webp")
+            self.assertEqual(post.img_path,
+                             "/static/images/uploads/4-1000w.webp")
+            self.assertTrue(os.path.exists(os.path.join(upload_dir, "4.jpg")))
+            self.assertEqual(Post.query.get(2).image_variants, [])
+
+            # Posts that already have variants aren't redone.
+            self.assertEqual(backfill_image_variants(), (0, 1))
+
+            delete_post(1)
+            self.assertEqual(PostImageVariant.query.count(), 0)
+
+        finally:
+            set_storage(None)
+            shutil.rmtree(upload_dir)
+
+
+    def test_transcoding_images(self):
+        """Test that image copies are upright, stripped, and within budget."""
+
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90 degrees
+        exif[0x010F] = "Phone Maker"
+
+        image_file = io.BytesIO()
+        Image.effect_noise((800, 600), 64).convert("RGB").save(
+            image_file, "JPEG", quality=95, exif=exif.tobytes())
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            source_path = os.path.join(work_dir, "photo.jpg")
+            with open(source_path, "wb") as source_file:
+                source_file.write(image_file.getvalue())
+
+            variants = encode_image_variants(source_path, "photo.jpg",
+                                             work_dir)
+            self.assertEqual([(width, height) for width, height, _ in variants],
+                             [(320, 427), (600, 800)])
+
+            with Image.open(variants[-1][2]) as variant:
+                self.assertEqual(variant.format, "WEBP")
+                self.assertEqual(variant.size, (600, 800))
+                self.assertEqual(dict(variant.getexif()), {})
+
+        noise = Image.effect_noise((400, 400), 64).convert("RGB")
+        full_quality = encode_image(noise, "JPEG", 95)
+        budget = len(full_quality) // 2
+        self.assertLessEqual(len(encode_image(noise, "JPEG", 95, budget)),
+                             budget)
+
+
+    def test_encoding_after_image_worker_dies(self):
+        """Test that images are still encoded after a worker is killed."""
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            source_path = os.path.join(work_dir, "photo.jpg")
+            with open(source_path, "wb") as source_file:
+                source_file.write(create_test_image(500, 400))
+
+            encode_image_variants(source_path, "photo.jpg", work_dir)
+            executor = kill_pool_worker(images.pool)
+
+            variants = encode_image_variants(source_path, "photo.jpg",
+                                             work_dir)
+            self.assertEqual([(width, height) for width, height, _ in variants],
+                             [(320, 256), (500, 400)])
+            self.assertIsNot(images.pool.get_executor(), executor)
+
+
     def test_getting_all_patient_posts(self):
         """Test that query returns a list of a patient's posts."""
 
         dietitian = Dietitian.query.get(1)
-        posts = get_all_patients_posts(dietitian, 1, None)
+        posts = get_all_patients_posts(dietitian, None, None)
 
         self.assertIn("At work", posts.items[0].meal_setting)
         self.assertIn("Home alone", posts.items[1].meal_setting)
 
 
+    def test_paginating_posts_by_cursor(self):
+        """Test that cursors walk forward and back through a patient's feed."""
+
+        for day in range(10, 20):
+            db.session.add(Post(patient_id=1, time_stamp=f"2020-03-{day} 09:00:00",
+                                meal_time=f"2020-03-{day} 08:00:00",
+                                meal_setting="Test", TEB="Test"))
+        db.session.commit()
+
+        first_page = get_single_patients_posts(1, None, None)
+        self.assertEqual(len(first_page.items), 10)
+        self.assertFalse(first_page.has_prev)
+        self.assertTrue(first_page.has_next)
+
+        second_page = get_single_patients_posts(1, first_page.next_cursor, None)
+        self.assertEqual([post.post_id for post in second_page.items], [2, 1])
+        self.assertFalse(second_page.has_next)
+
+        back_page = get_single_patients_posts(1, second_page.prev_cursor, None)
+        self.assertEqual([post.post_id for post in back_page.items],
+                         [post.post_id for post in first_page.items])
+        self.assertFalse(back_page.has_prev)
+
+        bad_cursor_page = get_single_patients_posts(1, "not-a-cursor", None)
+        self.assertEqual(bad_cursor_page.items, first_page.items)
+
+
+    def test_getting_months_years_with_posts(self):
+        """Test that month lists are cached and kept current on writes."""
+
+        february = datetime(2020, 2, 1)
+        self.assertEqual(get_months_years_of_patient_posts(1), [february])
+        self.assertEqual(get_months_years_posts_for_dietitian(1), [february])
+
+        form_data = {"meal-time": "2020-02-25 08:00:00",
+                     "meal-setting": "At home!", "TEB": "Some thoughts.."}
+        create_new_post(1, None, form_data)
+        this_month = datetime.now().replace(day=1, hour=0, minute=0,
+                                            second=0, microsecond=0)
+
+        self.assertEqual(get_months_years_of_patient_posts(1),
+                         [this_month, february])
+        self.assertEqual(get_months_years_posts_for_dietitian(1),
+                         [this_month, february])
+
+        delete_post(3)
+        self.assertEqual(get_months_years_of_patient_posts(1), [february])
+        self.assertEqual(get_months_years_posts_for_dietitian(1), [february])
+
+        delete_post(1)
+        self.assertEqual(get_months_years_of_patient_posts(1), [february])
+
+
     def test_saving_customized_patient_post_form(self):
         """Test that function saves correct information in the database."""
 
@@ -402,12 +800,11 @@ class DatabaseTests(unittest.TestCase):
     def test_querying_for_ratings(self):
         """Test that query for ratings returns correct list of data."""
 
-        patient = Patient.query.get(1)
-        dates_ratings = query_for_ratings(patient, Post.hunger, 
-                             "2020-02-19 08:00:00", "2020-02-21 08:00:00")
+        dates_ratings = query_for_all_ratings(1, "2020-02-19 08:00:00",
+                                              "2020-02-21 08:00:00")
 
         self.assertIsInstance(dates_ratings, list)
-        self.assertEqual(dates_ratings[0]["rating"], 2)
+        self.assertEqual(dates_ratings[0].hunger, 2)
 
 
     def test_getting_ratings_dict(self):
@@ -420,6 +817,27 @@ class DatabaseTests(unittest.TestCase):
         self.assertEqual(ratings_dict["data"]["fullness"][0]["rating"], 8)
 
 
+    def test_getting_ratings_dict_in_one_query(self):
+        """Test that all three ratings series come from a single query."""
+
+        edit_post(2, None, {"meal-time": "2020-02-22 09:00:00",
+                            "meal-setting": "At work.", "TEB": "Tired.",
+                            "satisfaction": 7})
+        db.session.expire_all()
+
+        query_count = count_queries(lambda: get_ratings_dict(
+            1, "2020-02-19T00:00:00", "2020-02-19 00:00:00",
+            "2020-02-26 00:00:00"))
+        ratings_dict = get_ratings_dict(1, "2020-02-19T00:00:00",
+                                        "2020-02-19 00:00:00",
+                                        "2020-02-26 00:00:00")
+
+        self.assertEqual(query_count, 1)
+        self.assertEqual(len(ratings_dict["data"]["hunger"]), 1)
+        self.assertEqual([rating["rating"] for rating 
+                          in ratings_dict["data"]["satisfaction"]], [7, 5])
+
+
     def test_getting_sundays_with_data(self):
         """Test that function returns correct list of dates."""
 
@@ -428,6 +846,74 @@ class DatabaseTests(unittest.TestCase):
         self.assertIn(data[0], "2020-02-16")
 
 
+    def test_getting_sundays_with_data_across_weeks(self):
+        """Test that week starts are distinct, newest first and skip gaps."""
+
+        for meal_time, hunger in [("2020-03-01 07:00:00", 3),
+                                  ("2020-03-07 21:00:00", 4),
+                                  ("2020-03-21 12:00:00", 5),
+                                  ("2020-03-23 12:00:00", None)]:
+            db.session.add(Post(patient_id=1, time_stamp=meal_time,
+                                meal_time=meal_time, meal_setting="Test",
+                                TEB="Test", hunger=hunger))
+        db.session.commit()
+
+        self.assertEqual(get_sundays_with_data(1),
+                         ["2020-03-15", "2020-03-01", "2020-02-16"])
+        self.assertEqual(get_sundays_with_data(2), [])
+
+
+    def test_weekly_ratings_rollup(self):
+        """Test that the weekly rollup follows post writes and backfills."""
+
+        backfill_weekly_ratings()
+        week = WeeklyRating.query.get((1, datetime(2020, 2, 16).date()))
+        self.assertEqual(week.post_count, 2)
+        self.assertEqual((week.hunger_count, week.hunger_sum), (1, 2))
+
+        form_data = {"meal-time": "2020-02-21T12:00", "meal-setting": "Work",
+                     "TEB": "Thoughts", "hunger": 6, "fullness": 4}
+        create_new_post(1, None, form_data)
+        week = WeeklyRating.query.get((1, datetime(2020, 2, 16).date()))
+        self.assertEqual((week.hunger_count, week.hunger_sum), (2, 8))
+        self.assertEqual((week.fullness_min, week.fullness_max), (4, 8))
+
+        # Moving a post to another week updates both weeks.
+        form_data["meal-time"] = "2020-03-02T12:00"
+        edit_post(3, None, form_data)
+        week = WeeklyRating.query.get((1, datetime(2020, 2, 16).date()))
+        self.assertEqual((week.fullness_min, week.fullness_max), (8, 8))
+        week = WeeklyRating.query.get((1, datetime(2020, 3, 1).date()))
+        self.assertEqual(week.hunger_sum, 6)
+
+        delete_post(3)
+        self.assertIsNone(WeeklyRating.query.get((1, datetime(2020, 3, 1).date())))
+
+        summary = get_weekly_ratings_summary(1)
+        self.assertEqual(summary["weeks"][0]["week_start"], "2020-02-16")
+        self.assertEqual(summary["weeks"][0]["hunger"]["average"], 2)
+
+        backfill_weekly_ratings()
+        self.assertEqual(get_weekly_ratings_summary(1), summary)
+
+
+    def test_composite_indexes_exist(self):
+        """Test that the hot access paths are covered by composite indexes."""
+
+        inspector = inspect(db.engine)
+        post_indexes = {index["name"]: index["column_names"]
+                        for index in inspector.get_indexes("posts")}
+        goal_indexes = {index["name"]: index["column_names"]
+                        for index in inspector.get_indexes("goals")}
+
+        self.assertEqual(post_indexes["ix_posts_patient_id_time_stamp_post_id"],
+                         ["patient_id", "time_stamp", "post_id"])
+        self.assertEqual(post_indexes["ix_posts_patient_id_meal_time"],
+                         ["patient_id", "meal_time"])
+        self.assertEqual(goal_indexes["ix_goals_patient_id_time_stamp"],
+                         ["patient_id", "time_stamp"])
+
+
 class DietitianDatabaseTests(unittest.TestCase):
     """Test functions that require a logged-in dietitian and the database."""
 
@@ -450,6 +936,7 @@ class DietitianDatabaseTests(unittest.TestCase):
         # Create the tables and add the sample data.
         db.create_all()
         load_test_data()
+        clear_all_caches()
         
 
     def tearDown(self):
@@ -703,6 +1190,250 @@ class DietitianDatabaseTests(unittest.TestCase):
         self.assertIn(b"not authorized", result.data)
 
 
+    def test_feed_query_count_constant_with_comments(self):
+        """Test that feed pages don't issue a query per post or comment."""
+
+        def get_feeds():
+            self.client.get("/dietitian/1")
+            self.client.get("/patient/1/posts")
+
+        # Warm the month dropdown caches so both counts measure the same work.
+        get_feeds()
+        query_count = count_queries(get_feeds)
+
+        for day in range(23, 28):
+            post = Post(patient_id=1, time_stamp=f"2020-02-{day} 09:00:00",
+                        meal_time=f"2020-02-{day} 08:00:00",
+                        meal_setting="At home.", TEB="Some thoughts.")
+            db.session.add(post)
+
+            for hour in range(10, 15):
+                post.comments.append(Comment(author_id=1, author_type="diet",
+                                             time_stamp=f"2020-02-{day} {hour}:00:00",
+                                             comment_body="Another comment."))
+        db.session.commit()
+
+        self.assertGreater(query_count, 0)
+        self.assertEqual(count_queries(get_feeds), query_count)
+
+
+    def test_exporting_patient_journal(self):
+        """Test streaming a patient's journal as CSV and gzipped NDJSON."""
+
+        result = self.client.get("/patient/1/export.csv")
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.is_streamed)
+        self.assertIn("attachment", result.headers["Content-Disposition"])
+
+        rows = list(csv.DictReader(io.StringIO(result.data.decode())))
+        self.assertEqual([row["record"] for row in rows],
+                         ["post", "post", "comment", "goal", "goal"])
+        self.assertEqual(rows[0]["meal_time"], "2020-02-20T08:00:00")
+        self.assertEqual(rows[2]["post_id"], "1")
+
+        result = self.client.get("/patient/1/export.ndjson",
+                                 headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(result.headers["Content-Encoding"], "gzip")
+
+        records = [json.loads(line) for line
+                   in gzip.decompress(result.data).decode().splitlines()]
+        self.assertEqual(len(records), 5)
+        self.assertEqual(records[3]["goal_body"],
+                         "Keep up the great work with your 3-3-3 meal plan.")
+
+        result = self.client.get("/patient/4/export.csv",
+                                 follow_redirects=True)
+        self.assertIn(b"not authorized", result.data)
+
+
+    def test_importing_patient_journal(self):
+        """Test bulk importing posts and goals, rejecting invalid rows."""
+
+        lines = [{"record": "post", "meal_time": "2019-06-02T08:00:00",
+                  "meal_setting": "Cafe", "TEB": "Calm.", "hunger": 3},
+                 {"meal_time": "2019-06-03T12:30:00", "fullness": "7"},
+                 {"record": "post", "meal_time": "yesterday"},
+                 {"record": "post", "meal_time": "2019-06-04T08:00:00",
+                  "hunger": 11},
+                 {"record": "goal", "time_stamp": "2019-06-01T09:00:00",
+                  "goal_body": "Eat breakfast every day."},
+                 {"record": "comment", "comment_body": "Nice."}]
+        body = "\n".join(json.dumps(line) for line in lines) + "\nnot json\n"
+
+        # Fill the month cache, which the import has to update.
+        get_months_years_of_patient_posts(1)
+
+        result = self.client.post("/patient/1/import",
+                                  data=gzip.compress(body.encode()),
+                                  content_type="application/x-ndjson",
+                                  headers={"Content-Encoding": "gzip"})
+        report = result.get_json()
+
+        self.assertEqual((report["posts"], report["goals"], report["rejected"]),
+                         (2, 1, 4))
+        self.assertEqual([rejection["line"]
+                          for rejection in report["rejections"]],
+                         [3, 4, 6, 7])
+        self.assertIn("between 0 and 10", report["rejections"][1]["reason"])
+
+        self.assertEqual(Post.query.filter_by(patient_id=1).count(), 4)
+        self.assertEqual(Goal.query.filter_by(patient_id=1).count(), 3)
+        week = WeeklyRating.query.filter_by(patient_id=1,
+                                            week_start="2019-06-02").one()
+        self.assertEqual((week.post_count, week.hunger_sum), (2, 3))
+        self.assertIn(datetime(2019, 6, 1),
+                      get_months_years_of_patient_posts(1))
+
+        result = self.client.post("/patient/1/import", data="meal_time\n",
+                                  content_type="text/plain")
+        self.assertEqual(result.status_code, 415)
+
+
+    def test_importing_rejects_bad_values_and_unreadable_files(self):
+        """Test that odd ratings and NULs are rejected, and bad bytes stop."""
+
+        lines = [{"meal_time": "2019-06-02T08:00:00", "hunger": 5.7},
+                 {"meal_time": "2019-06-02T09:00:00", "hunger": True},
+                 {"meal_time": "2019-06-02T10:00:00", "TEB": "a\u0000b"},
+                 {"meal_time": "2019-06-02T11:00:00", "hunger": 4.0}]
+        body = "\n".join(json.dumps(line) for line in lines) + "\n"
+
+        result = self.client.post("/patient/1/import", data=body,
+                                  content_type="application/x-ndjson")
+        report = result.get_json()
+
+        self.assertEqual((report["posts"], report["rejected"]), (1, 3))
+        self.assertIn("whole number", report["rejections"][0]["reason"])
+        self.assertIn("whole number", report["rejections"][1]["reason"])
+        self.assertIn("NUL", report["rejections"][2]["reason"])
+
+        body = "meal_time,hunger\n2019-06-03T08:00:00,5.5\n"
+        result = self.client.post("/patient/1/import", data=body,
+                                  content_type="text/csv")
+        self.assertEqual(result.get_json()["rejected"], 1)
+
+        body = (json.dumps({"meal_time": "2019-06-04T08:00:00"}).encode() +
+                b'\n{"meal_time": "\xff"}\n')
+        result = self.client.post("/patient/1/import", data=body,
+                                  content_type="application/x-ndjson")
+        self.assertEqual(result.status_code, 400)
+        self.assertIn("couldn't be read", result.get_json()["error"])
+
+        result = self.client.post("/patient/1/import", data=b"\x1f\x8bnot gzip",
+                                  content_type="application/x-ndjson",
+                                  headers={"Content-Encoding": "gzip"})
+        self.assertEqual(result.status_code, 400)
+
+
+    def test_feed_cards_cached_until_comment_changes(self):
+        """Test that post cards are reused until a comment on them changes."""
+
+        self.client.get("/patient/1/posts")
+        post_1_keys = [key for key in post_cards._data
+                       if key.startswith("post-card:1:")]
+        self.assertEqual(len(post_1_keys), 1)
+
+        # A cache hit serves the stored HTML without rendering the card.
+        post_cards.set(post_1_keys[0], "<p>From the card cache</p>")
+        result = self.client.get("/patient/1/posts")
+        self.assertIn(b"From the card cache", result.data)
+
+        edit_post_comment(1, {"comment": "A freshly edited comment."})
+
+        result = self.client.get("/patient/1/posts")
+        self.assertNotIn(b"From the card cache", result.data)
+        self.assertIn(b"A freshly edited comment.", result.data)
+
+
+    def test_patient_loaded_once_per_request(self):
+        """Test that decorators and views share one load of each row."""
+
+        app.debug = True
+
+        try:
+            responses = []
+            statements = capture_queries(
+                lambda: responses.append(self.client.get("/patient/1/posts")))
+            result = responses[0]
+        finally:
+            app.debug = False
+
+        patient_loads = [statement for statement in statements
+                         if "FROM patients \nWHERE patients.patient_id" 
+                         in statement]
+        dietitian_loads = [statement for statement in statements
+                           if "FROM dietitians \nWHERE dietitians.dietitian_id"
+                           in statement]
+
+        self.assertEqual(len(patient_loads), 1)
+        self.assertEqual(len(dietitian_loads), 1)
+        self.assertEqual(result.headers["X-Query-Count"], str(len(statements)))
+
+
+    def test_authorization_in_one_query(self):
+        """Test that checking access to a patient takes a single query."""
+
+        query_count = count_queries(
+            lambda: self.client.get("/patient/4/account"))
+        self.assertEqual(query_count, 1)
+
+        responses = []
+        statements = capture_queries(
+            lambda: responses.append(self.client.get("/patient/1/ratings-chart")))
+        result = responses[0]
+
+        patient_loads = [statement for statement in statements
+                         if "FROM patients \nWHERE patients.patient_id"
+                         in statement]
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(patient_loads), 1)
+        self.assertIn("patients.dietitian_id", patient_loads[0])
+
+
+    def test_query_stats_count_rows_and_time(self):
+        """Test that a request's query stats add up its rows and SQL time."""
+
+        with app.test_request_context():
+            Post.query.filter_by(patient_id=1).all()
+            Goal.query.filter_by(patient_id=1).all()
+            stats = get_query_stats()
+
+        self.assertEqual(stats["queries"], 2)
+        self.assertEqual(stats["rows"], 4)
+        self.assertGreater(stats["seconds"], 0)
+
+
+    def test_query_stats_headers_and_slow_request_log(self):
+        """Test that responses report SQL cost and slow requests are logged."""
+
+        responses = []
+        statements = capture_queries(
+            lambda: responses.append(self.client.get("/patient/1/posts")))
+        result = responses[0]
+
+        self.assertEqual(result.headers["X-Query-Count"], str(len(statements)))
+        self.assertRegex(result.headers["Server-Timing"],
+                         r'^db;dur=[\d.]+;desc="\d+ queries, \d+ rows", '
+                         r'app;dur=[\d.]+$')
+
+        query_budget = query_stats.SLOW_REQUEST_QUERIES
+        query_stats.SLOW_REQUEST_QUERIES = 0
+
+        try:
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                result = self.client.get("/patient/1/posts")
+        finally:
+            query_stats.SLOW_REQUEST_QUERIES = query_budget
+
+        log_line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(log_line["event"], "slow_request")
+        self.assertEqual(log_line["route"], "/patient/<int:patient_id>/posts")
+        self.assertEqual(str(log_line["queries"]),
+                         result.headers["X-Query-Count"])
+        self.assertTrue(log_line["top_statements"])
+
+
     def test_adding_comment(self):
         """Test that adding new comment route works with POST method."""
 
@@ -782,6 +1513,7 @@ class PatientDatabaseTests(unittest.TestCase):
         # Create the tables and add the sample data.
         db.create_all()
         load_test_data()
+        clear_all_caches()
         
 
     def tearDown(self):
@@ -891,6 +1623,158 @@ class PatientDatabaseTests(unittest.TestCase):
         self.assertIn(b"Post added successfully", result.data)
 
 
+    def test_uploading_post_image_in_background(self):
+        """Test that a new post's image is uploaded after the response."""
+
+        upload_dir = tempfile.mkdtemp()
+        uploads.SPOOL_DIR = os.path.join(upload_dir, "spool")
+        set_storage(FilesystemStorage(os.path.join(upload_dir, "stored"),
+                                      "/uploads"))
+
+        image_bytes = create_test_image(800, 600)
+        data = {"meal-time": "2020-02-25 08:00:00", "meal-setting": "At home!",
+                "TEB": "Some thoughts..", "meal-notes": "Some notes.",
+                "meal-image": (io.BytesIO(image_bytes), "lunch.jpg")}
+
+        try:
+            result = self.client.post("/post/new-post", data=data,
+                                      content_type="multipart/form-data")
+            self.assertEqual(result.status_code, 302)
+
+            uploads.wait_for_uploads(timeout=10)
+
+            sha256 = hashlib.sha256(image_bytes).hexdigest()
+            post = Post.query.order_by(Post.post_id.desc()).first()
+            db.session.refresh(post)
+            self.assertEqual(post.image_sha256, sha256)
+            self.assertEqual(post.img_path, f"/uploads/{sha256}-800w.webp")
+            self.assertEqual(os.listdir(uploads.SPOOL_DIR), [])
+
+            # The upload is archived untouched.
+            original = os.path.join(upload_dir, "stored", "originals",
+                                    f"{sha256}.jpg")
+            with open(original, "rb") as image:
+                self.assertEqual(image.read(), image_bytes)
+
+            self.assertEqual([(variant.width, variant.height)
+                              for variant in post.image_variants],
+                             [(320, 240), (640, 480), (800, 600)])
+            self.assertEqual(post.image_variants[-1].img_path, post.img_path)
+
+            stats = get_storage().stats.to_dict()
+            self.assertEqual(stats["uploads"], 4)
+
+        finally:
+            uploads.SPOOL_DIR = "upload_spool"
+            set_storage(None)
+            shutil.rmtree(upload_dir)
+
+
+    def test_deduplicating_post_images(self):
+        """Test that identical images are stored once and deleted safely."""
+
+        upload_dir = tempfile.mkdtemp()
+        stored_dir = os.path.join(upload_dir, "stored")
+        uploads.SPOOL_DIR = os.path.join(upload_dir, "spool")
+        set_storage(FilesystemStorage(stored_dir, "/uploads"))
+
+        image_bytes = create_test_image(500, 400)
+        sha256 = hashlib.sha256(image_bytes).hexdigest()
+
+        def post_image(url, filename):
+            data = {"meal-time": "2020-02-25 08:00:00",
+                    "meal-setting": "At home!", "TEB": "Some thoughts..",
+                    "meal-image": (io.BytesIO(image_bytes), filename)}
+            self.client.post(url, data=data,
+                             content_type="multipart/form-data")
+            uploads.wait_for_uploads(timeout=10)
+            db.session.expire_all()
+
+        try:
+            post_image("/post/new-post", "lunch.jpg")
+            post_image("/post/new-post", "image.jpg")
+            stored_files = sorted(os.listdir(stored_dir))
+
+            # The second upload was skipped; both posts share the copies.
+            self.assertEqual(get_storage().stats.to_dict()["uploads"], 3)
+            self.assertEqual(StoredImage.query.get(sha256).ref_count, 2)
+            new_posts = Post.query.filter_by(image_sha256=sha256).all()
+            self.assertEqual(len(new_posts), 2)
+            self.assertEqual(new_posts[0].img_path, new_posts[1].img_path)
+            post_ids = [post.post_id for post in new_posts]
+
+            # Re-sending the same photo with an edit doesn't add a reference.
+            post_image(f"/post/edit/{post_ids[0]}", "lunch.jpg")
+            self.assertEqual(StoredImage.query.get(sha256).ref_count, 2)
+
+            with app.app_context():
+                delete_post(post_ids[0])
+            uploads.wait_for_uploads(timeout=10)
+            db.session.expire_all()
+            self.assertEqual(StoredImage.query.get(sha256).ref_count, 1)
+            self.assertEqual(sorted(os.listdir(stored_dir)), stored_files)
+
+            with app.app_context():
+                delete_post(post_ids[1])
+            uploads.wait_for_uploads(timeout=10)
+            db.session.expire_all()
+            self.assertIsNone(StoredImage.query.get(sha256))
+            self.assertEqual(os.listdir(stored_dir), ["originals"])
+            self.assertEqual(os.listdir(os.path.join(stored_dir, "originals")),
+                             [])
+
+        finally:
+            uploads.SPOOL_DIR = "upload_spool"
+            set_storage(None)
+            shutil.rmtree(upload_dir)
+
+
+    def test_requeueing_spooled_post_images(self):
+        """Test that unfinished uploads are retried and failed jobs logged."""
+
+        upload_dir = tempfile.mkdtemp()
+        uploads.SPOOL_DIR = os.path.join(upload_dir, "spool")
+        os.makedirs(uploads.SPOOL_DIR)
+        set_storage(FilesystemStorage(os.path.join(upload_dir, "stored"),
+                                      "/uploads"))
+
+        def spool(filename, contents, age):
+            spool_path = os.path.join(uploads.SPOOL_DIR, filename)
+            with open(spool_path, "wb") as spool_file:
+                spool_file.write(contents)
+            modified = os.path.getmtime(spool_path) - age
+            os.utime(spool_path, (modified, modified))
+
+        new_image = create_test_image(400, 300)
+        spool("post-1-a-old.jpg", create_test_image(300, 200), 60)
+        spool("post-1-b-new.jpg", new_image, 30)
+        spool("c-never-queued.jpg", new_image, 2 * 60 * 60)
+
+        def fail_job(app):
+            raise RuntimeError("The database went away.")
+
+        try:
+            self.assertEqual(uploads.requeue_spooled_images(app), 1)
+            uploads.wait_for_uploads(timeout=10)
+
+            post = Post.query.get(1)
+            self.assertEqual(post.image_sha256,
+                             hashlib.sha256(new_image).hexdigest())
+            self.assertEqual(os.listdir(uploads.SPOOL_DIR), [])
+
+            with self.assertLogs(app.logger, "ERROR") as logs:
+                uploads.submit_job(fail_job, app)
+                uploads.wait_for_uploads(timeout=10)
+
+            self.assertIn("fail_job failed", logs.output[0])
+            self.assertIn("The database went away.", logs.output[0])
+
+        finally:
+            uploads.SPOOL_DIR = "upload_spool"
+            set_storage(None)
+            shutil.rmtree(upload_dir)
+
+
     def test_editing_patient_posts(self):
         """Test that editing a patient post route works with POST method."""
 
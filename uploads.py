@@ -0,0 +1,245 @@
+"""Store post images in the background.
+
+A request only writes the uploaded image to a local spool directory and
+queues it. A small pool of worker threads then pushes each spooled file to
+storage along with its transcoded copies (see images.py and
+stored_images.py), retrying failures, and fills in the post's img_path once
+the image is stored.
+
+Once queued, a spooled file is named after its post, so the spool directory
+itself records which uploads haven't finished. The server re-queues them
+when it starts, and running this file retries them, for instance from cron
+after a storage outage:
+
+    python3 uploads.py
+
+Settings are read from the environment (see secrets.sh):
+
+    UPLOAD_SPOOL_DIR  where images wait to be uploaded
+    UPLOAD_WORKERS    number of upload threads
+"""
+
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from threading import Lock
+from uuid import uuid4
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from model import connect_to_db
+from storage import get_storage, STORAGE_ERRORS
+from stored_images import attach_post_image, collect_stored_image
+
+
+SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR", "upload_spool")
+WORKERS = int(os.environ.get("UPLOAD_WORKERS", 4))
+
+MAX_ATTEMPTS = 4
+RETRY_DELAY_SECONDS = 1
+
+# Spooled files of a post are named "post-<post_id>-<uuid>-<filename>".
+POST_SPOOL_NAME = re.compile(r"post-(\d+)-")
+
+# A file spooled by a request that never queued it (its post wasn't saved)
+# is deleted after an hour; a post's file is given up on after a week.
+MAX_UNQUEUED_AGE_SECONDS = 60 * 60
+MAX_PENDING_AGE_SECONDS = 7 * 24 * 60 * 60
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS,
+                               thread_name_prefix="image-upload")
+_pending = set()
+_pending_lock = Lock()
+
+
+def spool_image(file):
+    """Save an uploaded file to the spool directory and return its path.
+
+    The stored name gets a random prefix, so two patients uploading
+    "lunch.jpg" don't overwrite each other's images.
+    """
+
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+
+    filename = f"{uuid4().hex}-{secure_filename(file.filename)}"
+    spool_path = os.path.join(SPOOL_DIR, filename)
+    file.save(spool_path)
+
+    return spool_path
+
+
+def upload_post_image(app, post_id, spool_path):
+    """Store a post's spooled image, retrying, then save its img_path.
+
+    Runs on an upload thread. Returns the image URL, or None if the post
+    was deleted or every attempt failed. After a failure, or an error other
+    than storage's, the spooled file is kept for requeue_spooled_images.
+    """
+
+    storage = get_storage()
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            with app.app_context():
+                img_path = attach_post_image(post_id, spool_path)
+            break
+        except STORAGE_ERRORS:
+            if attempt == MAX_ATTEMPTS:
+                app.logger.exception(f"Couldn't upload {spool_path} for "
+                                     f"post {post_id}; it will be retried")
+                return None
+
+            time.sleep(RETRY_DELAY_SECONDS * 2 ** (attempt - 1))
+
+    app.logger.debug(f"Stored {spool_path} for post {post_id}; "
+                     f"storage totals: {storage.stats.to_dict()}")
+
+    os.remove(spool_path)
+
+    return img_path
+
+
+def collect_unused_image(app, sha256):
+    """Delete a stored image no post uses any more. Runs on an upload thread."""
+
+    with app.app_context():
+        return collect_stored_image(sha256)
+
+
+def submit_job(function, app, *args):
+    """Run function(app, *args) on an upload thread.
+
+    The job is tracked for wait_for_uploads, and logged if it raises.
+    """
+
+    future = _executor.submit(function, app, *args)
+
+    with _pending_lock:
+        _pending.add(future)
+
+    future.add_done_callback(partial(finish_job, app, function.__name__))
+
+    return future
+
+
+def queue_post_image(post_id, spool_path):
+    """Queue a spooled image to be uploaded and attached to a post.
+
+    The file is first renamed after the post, so it's retried if the upload
+    doesn't finish.
+    """
+
+    app = current_app._get_current_object()
+    post_spool_path = os.path.join(
+        os.path.dirname(spool_path),
+        f"post-{post_id}-{os.path.basename(spool_path)}")
+    os.replace(spool_path, post_spool_path)
+
+    return submit_job(upload_post_image, app, post_id, post_spool_path)
+
+
+def queue_image_collection(sha256):
+    """Queue a stored image to be deleted if no post uses it any more."""
+
+    app = current_app._get_current_object()
+
+    return submit_job(collect_unused_image, app, sha256)
+
+
+def finish_job(app, name, future):
+    """Forget a finished job, logging the error if it raised."""
+
+    with _pending_lock:
+        _pending.discard(future)
+
+    error = None if future.cancelled() else future.exception()
+
+    if error:
+        app.logger.error(f"Background job {name} failed",
+                         exc_info=(type(error), error, error.__traceback__))
+
+
+def requeue_spooled_images(app, min_age_seconds=0):
+    """Queue the spooled images of posts whose uploads never finished.
+
+    Only each post's newest file is queued; older ones were replaced by a
+    later edit. Files younger than min_age_seconds are skipped, as they may
+    still be uploading. Returns the number of images queued.
+    """
+
+    if not os.path.isdir(SPOOL_DIR):
+        return 0
+
+    now = time.time()
+    newest_files = {}
+
+    for filename in os.listdir(SPOOL_DIR):
+        spool_path = os.path.join(SPOOL_DIR, filename)
+        age = now - os.path.getmtime(spool_path)
+        match = POST_SPOOL_NAME.match(filename)
+
+        if not match:
+            if age > MAX_UNQUEUED_AGE_SECONDS:
+                os.remove(spool_path)
+            continue
+
+        if age > MAX_PENDING_AGE_SECONDS:
+            app.logger.error(f"Gave up uploading {spool_path}")
+            os.remove(spool_path)
+            continue
+
+        if age < min_age_seconds:
+            continue
+
+        post_id = int(match.group(1))
+        newest = newest_files.get(post_id)
+
+        if newest and os.path.getmtime(newest) >= os.path.getmtime(spool_path):
+            os.remove(spool_path)
+            continue
+
+        if newest:
+            os.remove(newest)
+
+        newest_files[post_id] = spool_path
+
+    for post_id, spool_path in newest_files.items():
+        submit_job(upload_post_image, app, post_id, spool_path)
+
+    return len(newest_files)
+
+
+def wait_for_uploads(timeout=None):
+    """Block until every queued job has finished or timeout passes."""
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    # A job is pending until its done callback has run, which can be just
+    # after wait() sees it finish.
+    while True:
+        with _pending_lock:
+            pending = list(_pending)
+
+        remaining = None if deadline is None else deadline - time.monotonic()
+
+        if not pending or (remaining is not None and remaining <= 0):
+            return
+
+        done, _ = wait(pending, timeout=remaining)
+
+        if len(done) == len(pending):
+            time.sleep(0.01)
+
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app)
+
+    # Leave files the server may be uploading right now alone.
+    num_queued = requeue_spooled_images(app, min_age_seconds=10 * 60)
+    wait_for_uploads()
+    print(f"Retried {num_queued} spooled images.")
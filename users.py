@@ -1,6 +1,7 @@
-from flask import session
+from flask import g, has_request_context, session
 from helpers import alphabetize_by_lname
 from model import db, Dietitian, Patient
+from passwords import needs_rehash
 
 
 def create_new_dietitian_account(form_data):
@@ -115,18 +116,113 @@ def reset_password(password, user_object):
     return "Success"
 
 
+def check_login_password(password, user_object):
+    """Check a user's password at login, upgrading an outdated hash."""
+
+    if not user_object.check_password(password):
+        return False
+
+    # The plain-text password is only available here, so this is the one
+    # chance to re-hash it with the current method and cost.
+    if needs_rehash(user_object.password_hash):
+        user_object.set_password(password)
+        db.session.commit()
+
+    return True
+
+
 def get_current_dietitian():
     """Returns dietitian object for current dietitian_id."""
 
     dietitian_id = session.get("dietitian_id")
-    return Dietitian.query.get(dietitian_id)
+    return get_dietitian(dietitian_id)
 
 
 def get_current_patient():
     """Returns patient object for current patient_id."""
 
     patient_id = session.get("patient_id")
-    return Patient.query.get(patient_id)
+    return get_patient(patient_id)
+
+
+def get_dietitian(dietitian_id):
+    """Returns dietitian object, loaded at most once per request."""
+
+    return get_request_cached(Dietitian, dietitian_id)
+
+
+def get_patient(patient_id):
+    """Returns patient object, loaded at most once per request."""
+
+    return get_request_cached(Patient, patient_id)
+
+
+def get_request_cached(model, row_id):
+    """Return a row by primary key, caching it on flask.g for the request.
+
+    Decorators and views look up the same dietitian and patient several
+    times per request; this makes every lookup after the first one free.
+    """
+
+    if row_id is None:
+        return None
+
+    if not has_request_context():
+        return model.query.get(row_id)
+
+    entity_cache = g.setdefault("entity_cache", {})
+    key = (model.__tablename__, row_id)
+
+    if key not in entity_cache:
+        entity_cache[key] = model.query.get(row_id)
+
+    return entity_cache[key]
+
+
+def get_authorized_patient(patient_id):
+    """Return a patient the logged in user may view, or None if they may not.
+
+    Answers are memoized for the request, and an authorized patient is left
+    in the request cache so the view can use it without another query.
+    """
+
+    authorized_patients = g.setdefault("authorized_patients", {})
+
+    if patient_id not in authorized_patients:
+        authorized_patients[patient_id] = load_authorized_patient(patient_id)
+
+    return authorized_patients[patient_id]
+
+
+def load_authorized_patient(patient_id):
+    """Check whether the logged in user may view a patient and load them."""
+
+    user_type = get_user_type_from_session()
+
+    if user_type == "patient":
+        if not check_patient_authorization(patient_id):
+            return None
+        return get_patient(patient_id)
+
+    if user_type != "dietitian":
+        return None
+
+    dietitian_id = session.get("dietitian_id")
+    entity_cache = g.setdefault("entity_cache", {})
+    key = (Patient.__tablename__, patient_id)
+    patient = entity_cache.get(key)
+
+    if patient:
+        return patient if patient.dietitian_id == dietitian_id else None
+
+    # One primary key lookup both checks ownership and loads the patient.
+    patient = Patient.query.filter_by(patient_id=patient_id,
+                                      dietitian_id=dietitian_id).first()
+
+    if patient:
+        entity_cache[key] = patient
+
+    return patient
 
 
 def get_user_type_from_session():
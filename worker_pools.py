@@ -0,0 +1,64 @@
+"""Process pools for CPU-bound work that survive a worker dying.
+
+A worker killed by a signal (the OOM killer, say) leaves a
+ProcessPoolExecutor broken for good: every later job raises
+BrokenProcessPool. A WorkerPool starts its executor on first use and
+replaces a broken one, so a dead worker only costs the jobs it had in
+flight one retry.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+
+class WorkerPool:
+    """A lazily started process pool, rebuilt whenever it breaks."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = Lock()
+
+    def get_executor(self):
+        """Return the current executor, starting one if there's none."""
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers)
+
+            return self._executor
+
+    def discard_executor(self, executor):
+        """Drop a broken executor, unless another thread already replaced it."""
+
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+        executor.shutdown(wait=False)
+
+    def run_all(self, function, arg_lists):
+        """Return [function(*args) for args in arg_lists], run in the pool.
+
+        If the pool breaks, it's replaced and the whole batch runs once more.
+        """
+
+        for attempt in range(2):
+            executor = self.get_executor()
+
+            try:
+                futures = [executor.submit(function, *args)
+                           for args in arg_lists]
+                return [future.result() for future in futures]
+            except BrokenProcessPool:
+                self.discard_executor(executor)
+
+                if attempt:
+                    raise
+
+    def run(self, function, *args):
+        """Return function(*args), run in the pool."""
+
+        return self.run_all(function, [args])[0]